@@ -3,6 +3,7 @@ import subprocess
 
 from django.apps import AppConfig
 from django.conf import settings
+from django.core.signals import request_started
 
 
 class ApiConfig(AppConfig):
@@ -12,3 +13,19 @@ class ApiConfig(AppConfig):
     def ready(self):
         if settings.DEBUG and os.environ.get("RUN_MAIN"):
             subprocess.Popen("redis-server --port 6379", shell=True)
+        if settings.REFRESH_TOKEN_REAPER_INTERVAL:
+            # started by the first request, so that only processes
+            # serving requests (not management commands) run it
+            request_started.connect(
+                start_refresh_token_reaper,
+                dispatch_uid="start_refresh_token_reaper",
+            )
+
+
+def start_refresh_token_reaper(**kwargs):
+    from api.reaper import start_reaper
+
+    start_reaper(
+        settings.REFRESH_TOKEN_REAPER_INTERVAL,
+        settings.REFRESH_TOKEN_REAPER_BATCH_SIZE,
+    )
@@ -0,0 +1,281 @@
+"""
+Async implementations of api endpoints, served instead of the DRF ones
+when API_ASYNC_VIEWS is enabled (meant for running under an ASGI server).
+
+DRF doesn't support async views, so these are plain Django views
+mirroring requests and responses of their counterparts from api.views.
+"""
+
+from http import HTTPStatus
+from typing import Optional, Union
+
+import api.serializers as serializers
+from api.authentication import JWTAuthentication
+from api.hashing import HashingUnavailable
+from api.models import RefreshToken
+from api.renderers import JsonResponse, loads
+from api.routers import replica_reads
+from api.stateless import RevocationUnavailable
+from api.throttling import (
+    LoginThrottle,
+    RefreshThrottle,
+    RegisterThrottle,
+    TokenBucketThrottle,
+)
+from api.utils import parse_uuid
+from api.views import (
+    RetrieveUpdateUser,
+    issue_refresh_token,
+    stateless_logout,
+    stateless_refresh,
+    update_user,
+    user_data,
+    user_etag,
+    verification_response,
+    with_etag,
+)
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.auth import aauthenticate
+from django.utils.cache import get_conditional_response
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST, require_http_methods
+
+from rest_framework.exceptions import AuthenticationFailed, Throttled
+
+
+def parse_json(request) -> Optional[dict]:
+    """Returns json-object from request body or None if it is not one"""
+    try:
+        data = loads(request.body or b"{}")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def parse_error() -> JsonResponse:
+    return JsonResponse(
+        {"detail": "JSON parse error"}, status=HTTPStatus.BAD_REQUEST
+    )
+
+
+def unavailable(
+    exc: Union[HashingUnavailable, RevocationUnavailable],
+) -> JsonResponse:
+    return JsonResponse(
+        {"detail": exc.detail},
+        status=exc.status_code,
+        headers={"Retry-After": str(exc.wait)},
+    )
+
+
+async def throttle(
+    throttle: TokenBucketThrottle, request, data: dict
+) -> Optional[JsonResponse]:
+    """Returns 429 response if request is throttled, None otherwise"""
+    allowed = await sync_to_async(throttle.check, thread_sensitive=False)(
+        throttle.get_ident(request), data
+    )
+    if allowed:
+        return None
+    exc = Throttled(throttle.wait())
+    return JsonResponse(
+        {"detail": exc.detail},
+        status=exc.status_code,
+        headers={"Retry-After": str(exc.wait)},
+    )
+
+
+@csrf_exempt
+@require_POST
+async def register_view(request):
+    data = parse_json(request)
+    if data is None:
+        return parse_error()
+    throttled = await throttle(RegisterThrottle(), request, data)
+    if throttled is not None:
+        return throttled
+
+    def register():
+        ser = serializers.UserRegisterSerializer(data=data)
+        if ser.is_valid():
+            ser.save()
+            return ser.data, HTTPStatus.CREATED
+        return ser.errors, HTTPStatus.BAD_REQUEST
+
+    try:
+        data, status = await sync_to_async(register)()
+    except HashingUnavailable as exc:
+        return unavailable(exc)
+    return JsonResponse(data, status=status)
+
+
+@csrf_exempt
+@require_POST
+async def login_view(request):
+    data = parse_json(request)
+    if data is None:
+        return parse_error()
+    throttled = await throttle(LoginThrottle(), request, data)
+    if throttled is not None:
+        return throttled
+    credentials = serializers.LoginSerializer(
+        data={"email": data.get("email"), "password": data.get("password")}
+    )
+    if credentials.is_valid():
+        try:
+            user = await aauthenticate(
+                email=credentials.validated_data["email"],
+                password=credentials.validated_data["password"],
+            )
+        except HashingUnavailable as exc:
+            return unavailable(exc)
+        if user:
+            refresh = await sync_to_async(issue_refresh_token)(user)
+            return JsonResponse(
+                {
+                    "refresh_token": refresh,
+                    "access_token": RefreshToken.create_access_token(user),
+                },
+                status=HTTPStatus.OK,
+            )
+
+        return JsonResponse(
+            {"error": "invalid credentials: user not found"},
+            status=HTTPStatus.UNAUTHORIZED,
+        )
+    return JsonResponse(
+        {
+            "error": "invalid credentials: "
+            "email omitted or invalid/password omitted"
+        },
+        status=HTTPStatus.BAD_REQUEST,
+    )
+
+
+@csrf_exempt
+@require_POST
+async def refresh_view(request):
+    data = parse_json(request)
+    if data is None:
+        return parse_error()
+    throttled = await throttle(RefreshThrottle(), request, data)
+    if throttled is not None:
+        return throttled
+    if settings.REFRESH_TOKEN_STATELESS:
+        try:
+            data, status = await sync_to_async(stateless_refresh)(
+                data.get("refresh_token")
+            )
+        except RevocationUnavailable as exc:
+            return unavailable(exc)
+        return JsonResponse(data, status=status)
+    token = parse_uuid(data.get("refresh_token"))
+    if token is None:
+        return JsonResponse(
+            {
+                "error": "invalid 'refresh_token' value "
+                "- valid uuid must be provided"
+            },
+            status=HTTPStatus.BAD_REQUEST,
+        )
+    rotated = await sync_to_async(RefreshToken.rotate)(token)
+    if rotated is None:
+        deleted, _ = await RefreshToken.objects.filter(token=token).adelete()
+        if deleted:
+            return JsonResponse(
+                {"error": "Refresh token expired"},
+                status=HTTPStatus.UNAUTHORIZED,
+            )
+        return JsonResponse(
+            {"error": "refresh token doesn't exist"},
+            status=HTTPStatus.UNAUTHORIZED,
+        )
+    refresh, user = rotated
+    return JsonResponse(
+        {
+            "access_token": RefreshToken.create_access_token(user),
+            "refresh_token": refresh.token,
+        },
+        status=HTTPStatus.OK,
+    )
+
+
+@csrf_exempt
+@require_POST
+async def logout_view(request):
+    data = parse_json(request)
+    if data is None:
+        return parse_error()
+    if not data.get("refresh_token"):
+        return JsonResponse(
+            {"error": "token not provided"}, status=HTTPStatus.BAD_REQUEST
+        )
+    if settings.REFRESH_TOKEN_STATELESS:
+        try:
+            data, status = await sync_to_async(stateless_logout)(
+                data.get("refresh_token")
+            )
+        except RevocationUnavailable as exc:
+            return unavailable(exc)
+        return JsonResponse(data, status=status)
+    token = parse_uuid(data.get("refresh_token"))
+    deleted = 0
+    if token is not None:
+        deleted, _ = await RefreshToken.objects.filter(token=token).adelete()
+    if not deleted:
+        return JsonResponse(
+            {"error": "invalid token"}, status=HTTPStatus.UNAUTHORIZED
+        )
+    return JsonResponse({"success": "user logged out"}, status=HTTPStatus.OK)
+
+
+@csrf_exempt
+@require_http_methods(["GET", "PUT", "OPTIONS"])
+async def me_view(request):
+    if request.method == "OPTIONS":
+        return await sync_to_async(RetrieveUpdateUser.as_view())(request)
+
+    try:
+        authenticated = await JWTAuthentication().aauthenticate(request)
+    except AuthenticationFailed as exc:
+        return JsonResponse(
+            {"detail": exc.detail}, status=HTTPStatus.FORBIDDEN
+        )
+    if authenticated is None:
+        return JsonResponse(
+            {"detail": "Authentication credentials were not provided."},
+            status=HTTPStatus.FORBIDDEN,
+        )
+    user, _ = authenticated
+
+    current = user_data(user)
+    etag = user_etag(current)
+    # 304 for GET with If-None-Match, 412 for PUT with stale If-Match
+    conditional = get_conditional_response(request, etag=etag)
+    if request.method == "GET":
+        response = conditional or JsonResponse(current, status=HTTPStatus.OK)
+        return with_etag(response, etag)
+    if conditional is not None:
+        return conditional
+
+    data = parse_json(request)
+    if data is None:
+        return parse_error()
+    data, status = await sync_to_async(update_user)(user, data)
+    response = JsonResponse(data, status=status)
+    if status == HTTPStatus.OK:
+        with_etag(response, user_etag(data))
+    return response
+
+
+@csrf_exempt
+@replica_reads
+async def verify_view(request):
+    try:
+        authenticated = await JWTAuthentication().aauthenticate(request)
+    except AuthenticationFailed:
+        authenticated = None
+    return verification_response(authenticated)
@@ -1,6 +1,13 @@
+import copy
+import hmac
+
+from api import metrics, routers, user_cache
+from api.keys import key_ring
 from api.models import CustomUser
+from api.token_cache import token_cache
 
 from django.conf import settings
+from django.utils.functional import LazyObject, empty
 
 import jwt
 
@@ -9,26 +16,170 @@ from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import BasePermission
 
 
+def authentication_failed(reason: str) -> AuthenticationFailed:
+    """Returns exception to be raised, counting the failure reason"""
+    metrics.AUTHENTICATION_FAILURES.labels(reason=reason).inc()
+    return AuthenticationFailed(reason)
+
+
+class ClaimsUser(LazyObject):
+    """
+    User built from access token claims.
+
+    Fields carried by the token (id, username and email) are served
+    straight from its claims; user row is loaded from the database only
+    when any other attribute is accessed (or the user is modified).
+    """
+
+    claim_fields = {
+        "id": "uid",
+        "pk": "uid",
+        "username": "username",
+        "email": "sub",
+        "token_version": "ver",
+    }
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, claims: dict):
+        self.__dict__["_claims"] = claims
+        super().__init__()
+
+    def _setup(self):
+        self._wrapped = user_cache.get_user_by_id(self._claims["uid"])
+
+    def __getattr__(self, name):
+        if self._wrapped is empty:
+            if name in self.claim_fields:
+                return self._claims[self.claim_fields[name]]
+            self._setup()
+        return getattr(self._wrapped, name)
+
+    def __copy__(self):
+        if self._wrapped is empty:
+            return type(self)(self._claims)
+        return copy.copy(self._wrapped)
+
+
+def get_token_user(payload: dict):
+    """Returns user the access token was issued for;
+    raises AuthenticationFailed if the token was revoked"""
+    if settings.ACCESS_TOKEN_CLAIMS_AUTH and "uid" in payload:
+        version = user_cache.get_token_version(payload["uid"])
+        if version is None:
+            raise CustomUser.DoesNotExist
+        user = ClaimsUser(payload)
+    else:
+        user = user_cache.get_user_by_email(payload["sub"])
+        version = user.token_version
+    if payload.get("ver", version) != version:
+        raise authentication_failed("Token revoked")
+    return user
+
+
+def check_token_version(payload: dict, user_id) -> None:
+    """Raises AuthenticationFailed if a cached token was revoked; version
+    is read from the shared cache, so revocation by any worker applies"""
+    version = user_cache.get_token_version(user_id)
+    if version is None:
+        raise CustomUser.DoesNotExist
+    if payload.get("ver", version) != version:
+        raise authentication_failed("Token revoked")
+
+
+async def acheck_token_version(payload: dict, user_id) -> None:
+    """See check_token_version()"""
+    version = await user_cache.aget_token_version(user_id)
+    if version is None:
+        raise CustomUser.DoesNotExist
+    if payload.get("ver", version) != version:
+        raise authentication_failed("Token revoked")
+
+
+async def aget_token_user(payload: dict):
+    """See get_token_user()"""
+    if settings.ACCESS_TOKEN_CLAIMS_AUTH and "uid" in payload:
+        version = await user_cache.aget_token_version(payload["uid"])
+        if version is None:
+            raise CustomUser.DoesNotExist
+        user = ClaimsUser(payload)
+    else:
+        user = await user_cache.aget_user_by_email(payload["sub"])
+        version = user.token_version
+    if payload.get("ver", version) != version:
+        raise authentication_failed("Token revoked")
+    return user
+
+
+def bearer_token(auth_header: str) -> str:
+    """Returns token of "Bearer <token>" Authorization header;
+    raises AuthenticationFailed for any other value"""
+    parts = auth_header.split()
+    if len(parts) != 2 or parts[0].lower() != "bearer":
+        raise authentication_failed("Invalid authorization header")
+    return parts[1]
+
+
 class JWTAuthentication(BaseAuthentication):
+    """Authenticates with access tokens; token payload becomes
+    request.auth"""
+
     def authenticate(self, request):
         auth_header = request.headers.get("Authorization")
         if not auth_header:
             return None
 
+        token = bearer_token(auth_header)
         try:
-            prefix, token = auth_header.split()
+            cached = token_cache.get(token)
+            if cached is not None:
+                payload, user = cached
+                routers.follow_user(payload.get("uid"))
+                # entry outlives invalidation done by other workers
+                check_token_version(payload, user.pk)
+                return user, payload
 
-            payload = jwt.decode(
-                token, settings.SECRET_KEY, algorithms=["HS256"]
-            )
-            user = CustomUser.objects.get(email=payload["sub"])
-            return user, None
+            payload = key_ring().verify(token)
+            # user is looked up on the primary after writing
+            routers.follow_user(payload.get("uid"))
+            user = get_token_user(payload)
+            token_cache.set(token, payload, user)
+            return user, payload
         except jwt.ExpiredSignatureError:
-            raise AuthenticationFailed("Token expired")
-        except jwt.DecodeError:
-            raise AuthenticationFailed("Invalid token")
+            raise authentication_failed("Token expired")
+        except jwt.InvalidTokenError:
+            raise authentication_failed("Invalid token")
         except CustomUser.DoesNotExist:
-            raise AuthenticationFailed("Invalid credentials")
+            raise authentication_failed("Invalid credentials")
+
+    async def aauthenticate(self, request):
+        """See authenticate(); for async views, which DRF doesn't run"""
+        auth_header = request.headers.get("Authorization")
+        if not auth_header:
+            return None
+
+        token = bearer_token(auth_header)
+        try:
+            cached = token_cache.get(token)
+            if cached is not None:
+                payload, user = cached
+                routers.follow_user(payload.get("uid"))
+                # entry outlives invalidation done by other workers
+                await acheck_token_version(payload, user.pk)
+                return user, payload
+
+            payload = key_ring().verify(token)
+            # user is looked up on the primary after writing
+            routers.follow_user(payload.get("uid"))
+            user = await aget_token_user(payload)
+            token_cache.set(token, payload, user)
+            return user, payload
+        except jwt.ExpiredSignatureError:
+            raise authentication_failed("Token expired")
+        except jwt.InvalidTokenError:
+            raise authentication_failed("Invalid token")
+        except CustomUser.DoesNotExist:
+            raise authentication_failed("Invalid credentials")
 
 
 class AllowOptionsOrAuthenticated(BasePermission):
@@ -36,3 +187,19 @@ class AllowOptionsOrAuthenticated(BasePermission):
         if request.method == "OPTIONS":
             return True
         return request.user and request.user.is_authenticated
+
+
+class IsGateway(BasePermission):
+    """Grants access to API gateways, sending one of INTROSPECTION_SECRETS
+    as bearer token; everyone is denied while none is set"""
+
+    def has_permission(self, request, view):
+        prefix, _, secret = request.headers.get("Authorization", "").partition(
+            " "
+        )
+        if prefix.lower() != "bearer" or not secret:
+            return False
+        return any(
+            hmac.compare_digest(secret.encode(), known.encode())
+            for known in settings.INTROSPECTION_SECRETS
+        )
@@ -0,0 +1,54 @@
+from api import hashing, user_cache
+from api.models import CustomUser
+
+from django.contrib.auth.backends import ModelBackend
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend looking users up through the shared user cache;
+    passwords are checked by the hashing executor. Users logging in are
+    read from the database, as password hashes aren't cached"""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(CustomUser.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+        try:
+            user = CustomUser._default_manager.get(email=username)
+        except CustomUser.DoesNotExist:
+            # Run the default password hasher once to reduce the timing
+            # difference between an existing and a nonexistent user.
+            hashing.make_password(password)
+        else:
+            if hashing.check_password(
+                user, password
+            ) and self.user_can_authenticate(user):
+                # requests with the issued tokens find it cached
+                user_cache.cache_user(user)
+                return user
+
+    async def aauthenticate(
+        self, request, username=None, password=None, **kwargs
+    ):
+        if username is None:
+            username = kwargs.get(CustomUser.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+        try:
+            user = await CustomUser._default_manager.aget(email=username)
+        except CustomUser.DoesNotExist:
+            await hashing.amake_password(password)
+        else:
+            if await hashing.acheck_password(
+                user, password
+            ) and self.user_can_authenticate(user):
+                await user_cache.acache_user(user)
+                return user
+
+    def get_user(self, user_id):
+        try:
+            user = user_cache.get_user_by_id(user_id)
+        except CustomUser.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+
+from constance import settings as constance_settings
+from constance.signals import config_updated
+from constance.utils import get_values
+
+from django.conf import settings
+from django.dispatch import receiver
+
+import redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = f"{constance_settings.REDIS_PREFIX}updates"
+
+
+def uses_redis() -> bool:
+    return constance_settings.BACKEND.startswith("constance.backends.redisd.")
+
+
+def redis_client() -> redis.Redis:
+    """Client for the same redis server constance stores settings in"""
+    if isinstance(constance_settings.REDIS_CONNECTION, str):
+        return redis.from_url(constance_settings.REDIS_CONNECTION)
+    return redis.Redis(**constance_settings.REDIS_CONNECTION)
+
+
+class ConfigSnapshot:
+    """
+    In-process copy of constance settings.
+
+    All CONSTANCE_CONFIG values are fetched with a single request and then
+    served from memory. When any worker changes a value, it is announced
+    over redis pub/sub and every worker reloads its snapshot; in case an
+    announcement is lost, the listener thread also reloads it every
+    max_age seconds, so changes are picked up within a bounded time.
+    Requests never wait for redis past the first load; only without the
+    listener (other constance backends) an outdated snapshot is reloaded
+    on access.
+    """
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._values = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def __getattr__(self, key):
+        if key not in settings.CONSTANCE_CONFIG:
+            raise AttributeError(key)
+        self._start_listener()
+        values = self._values
+        if values is None or (
+            self._listener_pid != os.getpid()
+            and time.monotonic() - self._loaded_at > self.max_age
+        ):
+            values = self.reload()
+        return values[key]
+
+    def reload(self) -> dict:
+        with self._lock:
+            self._values = get_values()
+            self._loaded_at = time.monotonic()
+            return self._values
+
+    def update(self, key, value) -> None:
+        with self._lock:
+            if self._values is not None:
+                self._values = {**self._values, key: value}
+
+    def _start_listener(self) -> None:
+        """Starts pub/sub listener once per process (forked workers
+        don't inherit threads, so each of them starts its own)"""
+        if self._listener_pid == os.getpid() or not uses_redis():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+        threading.Thread(
+            target=self._listen, name="constance-snapshot", daemon=True
+        ).start()
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # anything published while we weren't subscribed is lost
+                self.reload()
+                while True:
+                    # reloaded on announcements, and at least every
+                    # max_age seconds (not spinning for 0) in case one
+                    # is lost
+                    pubsub.get_message(timeout=max(self.max_age, 1))
+                    self.reload()
+            except RedisError:
+                logger.warning(
+                    "constance updates subscription lost", exc_info=True
+                )
+                time.sleep(1)
+
+
+config_snapshot = ConfigSnapshot(settings.CONSTANCE_SNAPSHOT_MAX_AGE)
+
+
+@receiver(config_updated)
+def announce_config_update(sender, key, old_value, new_value, **kwargs):
+    config_snapshot.update(key, new_value)
+    if uses_redis():
+        try:
+            redis_client().publish(CHANNEL, key)
+        except RedisError:
+            logger.warning("failed to announce config update", exc_info=True)
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from api import metrics
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class HashingUnavailable(APIException):
+    """Raised when hashing queue is full; DRF turns `wait` into
+    Retry-After header of the 503 response"""
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Server is busy, try again later."
+    default_code = "hashing_unavailable"
+
+    def __init__(self, wait: int, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class HashingExecutor:
+    """
+    Thread pool running password hashing with bounded backlog.
+
+    PBKDF2 (hashlib.pbkdf2_hmac) releases the GIL, so hashes are computed
+    in parallel with request handling instead of holding the interpreter.
+    At most `workers` hashes are computed at once and `queue_size` more
+    may wait for a free thread; anything above that is rejected at once
+    with HashingUnavailable rather than queued until it times out.
+    """
+
+    def __init__(self, workers: int, queue_size: int, retry_after: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # pool threads don't survive fork, so each worker process
+        # creates its own pool
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="hashing"
+                    )
+                    self.in_flight = 0
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _release(self, future: Future) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """Schedules fn(*args); raises HashingUnavailable if backlog is full"""
+        executor = self._get_executor()
+        with self._lock:
+            if self.in_flight >= self.workers + self.queue_size:
+                self.rejected += 1
+                metrics.PASSWORD_HASHING_REJECTED.inc()
+                raise HashingUnavailable(self.retry_after)
+            self.in_flight += 1
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn: Callable, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn: Callable, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+            }
+
+
+hashing_executor = HashingExecutor(
+    settings.PASSWORD_HASHING_WORKERS,
+    settings.PASSWORD_HASHING_QUEUE_SIZE,
+    settings.PASSWORD_HASHING_RETRY_AFTER,
+)
+
+
+def timed(operation: str, fn: Callable) -> Callable:
+    """Wraps fn to observe its duration in hash duration histogram"""
+
+    def run(*args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            metrics.PASSWORD_HASH_DURATION.labels(operation=operation).observe(
+                time.perf_counter() - started
+            )
+
+    return run
+
+
+_make = timed("make", hashers.make_password)
+_check = timed("check", hashers.check_password)
+
+
+def make_password(password: Optional[str]) -> str:
+    """Same as django.contrib.auth.hashers.make_password(),
+    computed by the hashing executor"""
+    if password is None:
+        # unusable password, nothing to hash
+        return hashers.make_password(None)
+    return hashing_executor.run(_make, password)
+
+
+async def amake_password(password: Optional[str]) -> str:
+    if password is None:
+        return hashers.make_password(None)
+    return await hashing_executor.arun(_make, password)
+
+
+def set_password(user, password: Optional[str]) -> None:
+    """Same as user.set_password(), computed by the hashing executor"""
+    user.password = make_password(password)
+    user._password = password
+
+
+def check_password(user, password: str) -> bool:
+    """Same as user.check_password(), computed by the hashing executor"""
+    # outdated hash is upgraded here rather than by the setter, which
+    # would save user from the pool thread
+    outdated = []
+    verified = hashing_executor.run(
+        _check, password, user.password, outdated.append
+    )
+    if outdated:
+        user.password = make_password(password)
+        user.save(update_fields=["password"])
+    return verified
+
+
+async def acheck_password(user, password: str) -> bool:
+    outdated = []
+    verified = await hashing_executor.arun(
+        _check, password, user.password, outdated.append
+    )
+    if outdated:
+        user.password = await amake_password(password)
+        await user.asave(update_fields=["password"])
+    return verified
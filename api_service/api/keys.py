@@ -0,0 +1,170 @@
+"""
+Keys signing and verifying access tokens.
+
+Every "<kid>.pem" file of ACCESS_TOKEN_KEYS_DIR is an Ed25519 (EdDSA) or
+RSA (RS256) key, published at /.well-known/jwks.json so that other
+services verify access tokens locally; files holding only a public key
+serve retired keys, kept until tokens signed with them expire. Tokens are
+signed with ACCESS_TOKEN_SIGNING_KID key (its kid is put in token
+header), or with HS256 and SECRET_KEY when it isn't set.
+"""
+
+import base64
+import functools
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from django.conf import settings
+from django.core.checks import Error, register
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET
+
+import jwt
+from jwt.algorithms import get_default_algorithms
+
+ALGORITHMS = {
+    ed25519.Ed25519PublicKey: "EdDSA",
+    rsa.RSAPublicKey: "RS256",
+}
+
+
+def load_key(data: bytes):
+    """Returns (private key or None, public key) pair of a PEM file"""
+    try:
+        private = serialization.load_pem_private_key(data, password=None)
+    except ValueError:
+        return None, serialization.load_pem_public_key(data)
+    return private, private.public_key()
+
+
+def algorithm_of(public_key) -> str:
+    for key_type, algorithm in ALGORITHMS.items():
+        if isinstance(public_key, key_type):
+            return algorithm
+    raise ImproperlyConfigured(
+        f"unsupported signing key type: {type(public_key).__name__}"
+    )
+
+
+class KeyRing:
+    """
+    Keys by kid with their verifiers built once, rather than on each
+    verification; JWKS document and its ETag are built once as well.
+    """
+
+    def __init__(
+        self, keys_dir: Optional[str], signing_kid: Optional[str], secret: str
+    ):
+        self.signing_kid = signing_kid or None
+        self.verifiers: Dict[Optional[str], jwt.PyJWK] = {}
+        self._secret = secret
+        self._signing_key = None
+        if self.signing_kid is None:
+            # tokens without kid are signed with SECRET_KEY
+            self.verifiers[None] = jwt.PyJWK(
+                {
+                    "kty": "oct",
+                    "alg": "HS256",
+                    "k": base64.urlsafe_b64encode(secret.encode())
+                    .rstrip(b"=")
+                    .decode(),
+                }
+            )
+        jwks = []
+        paths = sorted(Path(keys_dir).glob("*.pem")) if keys_dir else []
+        for path in paths:
+            kid = path.stem
+            private, public = load_key(path.read_bytes())
+            algorithm = algorithm_of(public)
+            jwk = {
+                **get_default_algorithms()[algorithm].to_jwk(
+                    public, as_dict=True
+                ),
+                "kid": kid,
+                "alg": algorithm,
+                "use": "sig",
+            }
+            jwks.append(jwk)
+            self.verifiers[kid] = jwt.PyJWK(jwk)
+            if kid == self.signing_kid:
+                if private is None:
+                    raise ImproperlyConfigured(
+                        f"signing key {path} has no private key"
+                    )
+                self._signing_key = (private, algorithm)
+        if self.signing_kid is not None and self._signing_key is None:
+            raise ImproperlyConfigured(
+                f"signing key {self.signing_kid!r} not found in {keys_dir}"
+            )
+        self.jwks = json.dumps({"keys": jwks}).encode()
+        self.etag = quote_etag(hashlib.sha256(self.jwks).hexdigest()[:32])
+
+    def sign(self, payload: dict) -> str:
+        if self._signing_key is None:
+            return jwt.encode(payload, self._secret, algorithm="HS256")
+        private, algorithm = self._signing_key
+        return jwt.encode(
+            payload,
+            private,
+            algorithm=algorithm,
+            headers={"kid": self.signing_kid},
+        )
+
+    def verify(self, token: str) -> dict:
+        """Returns payload of a valid token; raises
+        jwt.ExpiredSignatureError if it has expired and
+        jwt.InvalidTokenError if it is invalid otherwise (including
+        tokens signed by unknown keys)"""
+        kid = jwt.get_unverified_header(token).get("kid")
+        verifier = None
+        if kid is None or isinstance(kid, str):
+            verifier = self.verifiers.get(kid)
+        if verifier is None:
+            raise jwt.InvalidSignatureError("Unknown signing key")
+        # algorithm is the one of the key, whatever token header says
+        return jwt.decode(token, verifier)
+
+
+@functools.lru_cache
+def load_key_ring(
+    keys_dir: Optional[str], signing_kid: Optional[str], secret: str
+) -> KeyRing:
+    return KeyRing(keys_dir, signing_kid, secret)
+
+
+def key_ring() -> KeyRing:
+    return load_key_ring(
+        settings.ACCESS_TOKEN_KEYS_DIR,
+        settings.ACCESS_TOKEN_SIGNING_KID,
+        settings.SECRET_KEY,
+    )
+
+
+@register()
+def check_key_ring(app_configs, **kwargs):
+    try:
+        key_ring()
+    except (ImproperlyConfigured, OSError, ValueError) as exc:
+        return [Error(f"access token keys: {exc}", id="api.E001")]
+    return []
+
+
+@require_GET
+def jwks_view(request):
+    """Public keys of the key ring; downstream services cache them for
+    JWKS_MAX_AGE seconds and revalidate with If-None-Match"""
+    ring = key_ring()
+    response = get_conditional_response(
+        request, etag=ring.etag
+    ) or HttpResponse(ring.jwks, content_type="application/json")
+    response["ETag"] = ring.etag
+    patch_cache_control(response, public=True, max_age=settings.JWKS_MAX_AGE)
+    return response
@@ -0,0 +1,58 @@
+import datetime
+import os
+import uuid
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+KEY_GENERATORS = {
+    "EdDSA": ed25519.Ed25519PrivateKey.generate,
+    "RS256": lambda: rsa.generate_private_key(
+        public_exponent=65537, key_size=2048
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = "Generates a new access token signing key in ACCESS_TOKEN_KEYS_DIR"
+    # configuration being fixed may be the key ring itself
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--algorithm", choices=list(KEY_GENERATORS), default="EdDSA"
+        )
+        parser.add_argument(
+            "--kid", help="Key id; defaults to date and a random suffix"
+        )
+        parser.add_argument(
+            "--keys-dir",
+            default=settings.ACCESS_TOKEN_KEYS_DIR,
+            help="Defaults to ACCESS_TOKEN_KEYS_DIR",
+        )
+
+    def handle(self, *args, **options):
+        if not options["keys_dir"]:
+            raise CommandError("ACCESS_TOKEN_KEYS_DIR is not set")
+        kid = options["kid"] or (
+            f"{datetime.date.today():%Y%m%d}-{uuid.uuid4().hex[:8]}"
+        )
+        path = Path(options["keys_dir"]) / f"{kid}.pem"
+        if path.exists():
+            raise CommandError(f"{path} already exists")
+        key = KEY_GENERATORS[options["algorithm"]]()
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # private key is readable by the owner only
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(pem)
+        self.stdout.write(kid)
@@ -0,0 +1,26 @@
+from api.reaper import purge_expired_tokens
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Deletes expired refresh tokens in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.REFRESH_TOKEN_REAPER_BATCH_SIZE,
+            help="Max number of tokens deleted by a single statement",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to wait between batches",
+        )
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_tokens(options["batch_size"], options["pause"])
+        self.stdout.write(f"Deleted {deleted} expired refresh tokens")
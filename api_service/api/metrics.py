@@ -0,0 +1,244 @@
+"""
+Prometheus metrics of the service, served in text format by metrics_view.
+
+When PROMETHEUS_MULTIPROC_DIR environment variable is set (it has to be
+set before the process starts, as the production entrypoint does), every
+worker process writes its samples to mmap-backed files in that directory
+and a scrape served by any worker aggregates the files of all of them;
+otherwise metrics of the current process are served.
+"""
+
+import datetime
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import connections
+from django.db.models import Count, Q
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+REQUEST_DURATION = Histogram(
+    "api_request_duration_seconds",
+    "Time spent handling api requests, by route (URL name)",
+    ["route", "method", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+TOKENS_ISSUED = Counter(
+    "api_tokens_issued", "Tokens issued to users", ["type"]
+)
+REFRESH_TOKENS_ROTATED = Counter(
+    "api_refresh_tokens_rotated", "Refresh tokens replaced by new ones"
+)
+AUTHENTICATION_FAILURES = Counter(
+    "api_authentication_failures",
+    "Access tokens rejected by JWTAuthentication",
+    ["reason"],
+)
+REVOCATION_CHECKS = Counter(
+    "api_refresh_token_revocation_checks",
+    "Checks of stateless refresh tokens against revocation set, by result "
+    "(bloom_miss ones are answered by the in-memory filter)",
+    ["result"],
+)
+ACCESS_TOKEN_CACHE_LOOKUPS = Counter(
+    "api_access_token_cache_lookups",
+    "Lookups in per-worker caches of verified access tokens, by result",
+    ["result"],
+)
+ACCESS_TOKEN_CACHE_EVICTIONS = Counter(
+    "api_access_token_cache_evictions",
+    "Access tokens evicted from full per-worker caches",
+)
+RATE_LIMIT_DECISIONS = Counter(
+    "api_rate_limit_decisions",
+    "Rate limiter decisions by throttle scope; fallback ones are made "
+    "with per-worker buckets while redis is unavailable",
+    ["scope", "decision"],
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "api_password_hash_duration_seconds",
+    "Time spent computing password hashes",
+    ["operation"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+PASSWORD_HASHING_REJECTED = Counter(
+    "api_password_hashing_rejected",
+    "Hashing requests rejected because hashing queue was full",
+)
+
+# Connection pools of all workers; gauges are summed over live processes
+DB_POOL_GAUGES = {
+    stat: Gauge(
+        f"api_db_pool_{name}",
+        description,
+        ["alias"],
+        multiprocess_mode="livesum",
+    )
+    for stat, name, description in (
+        ("pool_max", "max", "Max number of pooled connections"),
+        ("pool_size", "size", "Connections opened by pools"),
+        ("pool_available", "available", "Idle connections in pools"),
+        (
+            "requests_waiting",
+            "requests_waiting",
+            "Requests waiting for a free connection",
+        ),
+    )
+}
+DB_POOL_COUNTERS = {
+    stat: Counter(f"api_db_pool_{name}", description, ["alias"])
+    for stat, name, description in (
+        ("requests_num", "requests", "Connections taken from pools"),
+        (
+            "requests_queued",
+            "requests_queued",
+            "Requests which had to wait for a free connection",
+        ),
+        (
+            "requests_errors",
+            "requests_errors",
+            "Requests failed to get a connection in time",
+        ),
+        ("connections_num", "connections", "Connections opened by pools"),
+        ("connections_lost", "connections_lost", "Broken pooled connections"),
+    )
+}
+DB_POOL_WAIT = Counter(
+    "api_db_pool_wait_seconds",
+    "Time requests spent waiting for a free connection",
+    ["alias"],
+)
+
+
+@receiver(request_finished)
+def record_pool_stats(sender, **kwargs):
+    """Moves counters of connection pools of the current process to
+    the metrics; done after each request, when its connection is already
+    back in the pool"""
+    for alias in connections:
+        # pools are shared by connections of all threads of the process
+        connection = connections[alias]
+        pool = getattr(connection, "pool", None)
+        if pool is None:
+            continue
+        stats = pool.pop_stats()
+        for stat, gauge in DB_POOL_GAUGES.items():
+            gauge.labels(alias=connection.alias).set(stats.get(stat, 0))
+        for stat, counter in DB_POOL_COUNTERS.items():
+            if stats.get(stat):
+                counter.labels(alias=connection.alias).inc(stats[stat])
+        if stats.get("requests_wait_ms"):
+            DB_POOL_WAIT.labels(alias=connection.alias).inc(
+                stats["requests_wait_ms"] / 1000
+            )
+
+
+class RefreshTokenCollector:
+    """Counts refresh token rows; the number comes from the database, so it
+    is the same whichever worker serves the scrape. Counts are kept in the
+    shared cache for REFRESH_TOKEN_METRICS_MAX_AGE seconds, so the table is
+    scanned once per that period rather than on every scrape"""
+
+    cache_key = "metrics:refresh_tokens"
+
+    def describe(self):
+        return [self._families()[0]]
+
+    def collect(self):
+        counts = self._cached_counts()
+        live, stored = self._families()
+        live.add_metric([], counts["live"])
+        stored.add_metric([], counts["total"])
+        return [live, stored]
+
+    def _cached_counts(self):
+        try:
+            counts = cache.get(self.cache_key)
+        except RedisError:
+            logger.warning("refresh token counts not cached", exc_info=True)
+            return self._count()
+        if counts is None:
+            counts = self._count()
+            try:
+                cache.set(
+                    self.cache_key,
+                    counts,
+                    timeout=settings.REFRESH_TOKEN_METRICS_MAX_AGE,
+                )
+            except RedisError:
+                logger.warning(
+                    "refresh token counts not cached", exc_info=True
+                )
+        return counts
+
+    @staticmethod
+    def _count():
+        from api.models import RefreshToken
+
+        bound_field, bound = RefreshToken.validity_bound(
+            datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+        return RefreshToken.objects.aggregate(
+            total=Count("pk"),
+            live=Count("pk", filter=Q(**{f"{bound_field}__gt": bound})),
+        )
+
+    @staticmethod
+    def _families():
+        return (
+            GaugeMetricFamily(
+                "api_refresh_tokens_live", "Unexpired refresh tokens"
+            ),
+            GaugeMetricFamily(
+                "api_refresh_tokens_stored",
+                "Refresh token rows, including expired ones not purged yet",
+            ),
+        )
+
+
+refresh_token_collector = RefreshTokenCollector()
+
+
+def multiprocess_enabled() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def get_registry():
+    """Returns registry to be served by the current scrape"""
+    if not multiprocess_enabled():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(refresh_token_collector)
+    return registry
+
+
+if not multiprocess_enabled():
+    REGISTRY.register(refresh_token_collector)
+
+
+@require_GET
+def metrics_view(request):
+    return HttpResponse(
+        generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST
+    )
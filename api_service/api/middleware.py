@@ -0,0 +1,328 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
+
+from api import metrics, routers
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.messages import middleware as messages_middleware
+from django.contrib.sessions import middleware as sessions_middleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.middleware import clickjacking, csrf
+
+logger = logging.getLogger(__name__)
+
+UNRESOLVED_ROUTE = "<unresolved>"
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised (instead of logging a warning) when QUERY_BUDGET_STRICT
+    is enabled, so that tests going over a budget fail"""
+
+
+@dataclass
+class RequestQueries:
+    count: int = 0
+    duration: float = 0.0
+
+
+@dataclass
+class RouteQueries:
+    requests: int = 0
+    queries: int = 0
+    max_queries: int = 0
+    duration: float = 0.0
+
+
+_current: ContextVar[Optional[RequestQueries]] = ContextVar(
+    "current_request_queries", default=None
+)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper adding the query to stats of the current request"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.duration += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # installed once per connection rather than with execute_wrapper()
+    # around each request: async views run queries on connections of
+    # the sync_to_async threads, which the context variable reaches
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class RouteStats:
+    """Queries per route (URL name) aggregated in the current process"""
+
+    def __init__(self):
+        self._routes: Dict[str, RouteQueries] = {}
+        self._lock = threading.Lock()
+
+    def add(self, route: str, queries: RequestQueries) -> None:
+        with self._lock:
+            stats = self._routes.setdefault(route, RouteQueries())
+            stats.requests += 1
+            stats.queries += queries.count
+            stats.max_queries = max(stats.max_queries, queries.count)
+            stats.duration += queries.duration
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                route: {
+                    "requests": stats.requests,
+                    "queries": stats.queries,
+                    "avg_queries": stats.queries / stats.requests,
+                    "max_queries": stats.max_queries,
+                    "sql_ms": stats.duration * 1000,
+                }
+                for route, stats in self._routes.items()
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._routes.clear()
+
+
+route_stats = RouteStats()
+
+
+class QueryCountMiddleware:
+    """
+    Counts DB queries and total SQL time of every request.
+
+    Numbers are sent in Server-Timing header of the response and added to
+    per-route stats (route_stats). Routes listed in QUERY_BUDGETS going
+    over their number of queries are logged (or fail, when
+    QUERY_BUDGET_STRICT is enabled).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(None, connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        queries = RequestQueries()
+        token = _current.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.process(request, response, queries, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        queries = RequestQueries()
+        token = _current.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.process(request, response, queries, started)
+
+    def process(self, request, response, queries, started):
+        match = request.resolver_match
+        route = match.view_name if match else UNRESOLVED_ROUTE
+        route_stats.add(route, queries)
+        if settings.QUERY_SERVER_TIMING:
+            total = time.perf_counter() - started
+            noun = "query" if queries.count == 1 else "queries"
+            response.headers["Server-Timing"] = (
+                f"db;dur={queries.duration * 1000:.2f}"
+                f';desc="{queries.count} {noun}", '
+                f"app;dur={total * 1000:.2f}"
+            )
+        budget = settings.QUERY_BUDGETS.get(route)
+        if budget is not None and queries.count > budget:
+            message = (
+                f"{request.method} {route} ran {queries.count} queries, "
+                f"budget is {budget}"
+            )
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+
+class MetricsMiddleware:
+    """Observes duration of every request to api routes (see api.metrics)"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        return self.process(request, response, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        return self.process(request, response, started)
+
+    def process(self, request, response, started):
+        match = request.resolver_match
+        # other routes (admin, metrics) would only add label values
+        if match is not None and match.namespace == "api":
+            metrics.REQUEST_DURATION.labels(
+                route=match.view_name,
+                method=request.method,
+                status=response.status_code,
+            ).observe(time.perf_counter() - started)
+        return response
+
+
+class DatabaseRoutingMiddleware:
+    """
+    Keeps state of database routing of each request (see api.routers).
+
+    Requests with unsafe methods read from the primary. After a request
+    has written, users it was made by, created or updated stick to the
+    primary. Not used without DATABASE_REPLICAS.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing = routers.RequestRouting(
+            primary=request.method not in SAFE_METHODS
+        )
+        token = routers.current_routing.set(routing)
+        try:
+            return self.get_response(request)
+        finally:
+            routers.current_routing.reset(token)
+            user_ids = self.written_users(routing)
+            if user_ids:
+                routers.stick_to_primary(user_ids)
+
+    async def __acall__(self, request):
+        routing = routers.RequestRouting(
+            primary=request.method not in SAFE_METHODS
+        )
+        token = routers.current_routing.set(routing)
+        try:
+            return await self.get_response(request)
+        finally:
+            routers.current_routing.reset(token)
+            user_ids = self.written_users(routing)
+            if user_ids:
+                await routers.astick_to_primary(user_ids)
+
+    @staticmethod
+    def written_users(routing: routers.RequestRouting) -> Set[int]:
+        """Ids of users whose reads have to stick to the primary"""
+        if not routing.wrote:
+            return set()
+        user_ids = {
+            user.pk for user in routing.written_users if user.pk is not None
+        }
+        if routing.user_id is not None:
+            user_ids.add(routing.user_id)
+        return user_ids
+
+
+class SiteOnlyMiddlewareMixin:
+    """
+    Skips the middleware for requests to LEAN_MIDDLEWARE_PATHS (ones
+    ending with a slash match every path under them, others only
+    themselves).
+
+    Those are served to clients authenticating with tokens, so sessions,
+    CSRF cookies, request.user of sessions, messages and frame options
+    are only needed by the admin (and other pages). Subclasses stay in
+    MIDDLEWARE at the usual places, so admin checks and the order of
+    middleware of other requests are unchanged.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        paths = settings.LEAN_MIDDLEWARE_PATHS
+        self.lean_prefixes = tuple(
+            path for path in paths if path.endswith("/")
+        )
+        self.lean_paths = frozenset(paths).difference(self.lean_prefixes)
+
+    def __call__(self, request):
+        path = request.path_info
+        if path in self.lean_paths or path.startswith(self.lean_prefixes):
+            # a coroutine in async mode, which the caller awaits
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SessionMiddleware(
+    SiteOnlyMiddlewareMixin, sessions_middleware.SessionMiddleware
+):
+    pass
+
+
+class CsrfViewMiddleware(SiteOnlyMiddlewareMixin, csrf.CsrfViewMiddleware):
+    # process_view still runs: api views are csrf_exempt, so it returns
+    # at once, and any other view is rejected for lack of a CSRF cookie
+    pass
+
+
+class AuthenticationMiddleware(
+    SiteOnlyMiddlewareMixin, auth_middleware.AuthenticationMiddleware
+):
+    pass
+
+
+class MessageMiddleware(
+    SiteOnlyMiddlewareMixin, messages_middleware.MessageMiddleware
+):
+    pass
+
+
+class XFrameOptionsMiddleware(
+    SiteOnlyMiddlewareMixin, clickjacking.XFrameOptionsMiddleware
+):
+    pass
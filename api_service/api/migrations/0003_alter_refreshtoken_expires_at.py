@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_customuser_token_version"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="refreshtoken",
+            name="expires_at",
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_alter_refreshtoken_expires_at"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="refreshtoken",
+            name="created_at",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
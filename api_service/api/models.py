@@ -1,17 +1,18 @@
 import datetime
 import uuid
+from typing import Optional, Tuple
 
-from constance import config
+from api import hashing, metrics
+from api.config_snapshot import config_snapshot
+from api.keys import key_ring
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import BaseUserManager
-from django.db import models
+from django.db import connections, models, router
 from django.utils.timezone import now as django_now
 from django.utils.translation import gettext_lazy as _
 
-import jwt
-
 
 class CustomUserManager(BaseUserManager):
     def create(self, email, password=None, **extra_fields):
@@ -19,7 +20,7 @@ class CustomUserManager(BaseUserManager):
             raise ValueError(_("The Email field must be set"))
         email = self.normalize_email(email)
         user = self.model(email=email, **extra_fields)
-        user.set_password(password)
+        hashing.set_password(user, password)
         user.save(using=self._db)
         return user
 
@@ -37,10 +38,22 @@ class CustomUserManager(BaseUserManager):
 
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)
+    # access tokens issued with another version are rejected
+    token_version = models.PositiveIntegerField(default=0)
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = []
     objects = CustomUserManager()
 
+    def save(self, *args, **kwargs):
+        # changing password revokes issued access tokens; hash upgrades
+        # done by check_password() reset _password and don't count
+        if self._password is not None:
+            self.token_version += 1
+            update_fields = kwargs.get("update_fields")
+            if update_fields is not None and "password" in update_fields:
+                kwargs["update_fields"] = {*update_fields, "token_version"}
+        super().save(*args, **kwargs)
+
 
 class RefreshToken(models.Model):
     user = models.OneToOneField(
@@ -49,19 +62,42 @@ class RefreshToken(models.Model):
         on_delete=models.CASCADE,
     )
     token = models.UUIDField(default=uuid.uuid4, unique=True)
-    created_at = models.DateTimeField(auto_now=True)
-    expires_at = models.DateTimeField()
+    # issue time; with lazy expiry the token's validity is computed from it
+    created_at = models.DateTimeField(default=django_now, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    @staticmethod
+    def validity_bound(now_time: datetime.datetime):
+        """
+        Returns (field name, moment) pair - token is valid while value
+        of the field is greater than the moment.
+
+        With REFRESH_TOKEN_LAZY_EXPIRY expiry is computed from creation
+        time and current token lifetime, so lifetime changes apply to
+        existing tokens without rewriting them; otherwise stored
+        expiry time is used.
+        """
+        if settings.REFRESH_TOKEN_LAZY_EXPIRY:
+            return "created_at", now_time - datetime.timedelta(
+                seconds=config_snapshot.REFRESH_TOKEN_LIFETIME
+            )
+        return "expires_at", now_time
 
     @staticmethod
     def create_access_token(user) -> str:
         exp_time = datetime.datetime.now(
             datetime.timezone.utc
-        ) + datetime.timedelta(seconds=config.ACCESS_TOKEN_LIFETIME)
-        token = jwt.encode(
-            {"sub": user.email, "exp": str(int(exp_time.timestamp()))},
-            settings.SECRET_KEY,
-            algorithm="HS256",
+        ) + datetime.timedelta(seconds=config_snapshot.ACCESS_TOKEN_LIFETIME)
+        token = key_ring().sign(
+            {
+                "sub": user.email,
+                "uid": user.pk,
+                "username": user.username,
+                "ver": user.token_version,
+                "exp": int(exp_time.timestamp()),
+            }
         )
+        metrics.TOKENS_ISSUED.labels(type="access").inc()
         return token
 
     @classmethod
@@ -71,22 +107,205 @@ class RefreshToken(models.Model):
             user=user,
             created_at=now_time,
             expires_at=now_time
-            + datetime.timedelta(seconds=config.REFRESH_TOKEN_LIFETIME),
+            + datetime.timedelta(
+                seconds=config_snapshot.REFRESH_TOKEN_LIFETIME
+            ),
         )
+        metrics.TOKENS_ISSUED.labels(type="refresh").inc()
         return refresh
 
     @classmethod
-    def get_token(cls, token_str: str) -> "RefreshToken":
-        token = cls.objects.filter(token=uuid.UUID(token_str)).first()
-        return token
+    def issue(cls, user) -> "RefreshToken":
+        """
+        Returns user's refresh token, creating it if user has none and
+        replacing it if it has expired; done in a single statement,
+        so concurrent logins of the same user never collide
+        """
+        connection = connections[router.db_for_write(cls)]
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        now_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        new_token = cls(
+            user=user,
+            token=uuid.uuid4(),
+            created_at=now_time,
+            expires_at=now_time
+            + datetime.timedelta(
+                seconds=config_snapshot.REFRESH_TOKEN_LIFETIME
+            ),
+        )
+        fields = [
+            cls._meta.get_field(name)
+            for name in ("user", "token", "created_at", "expires_at")
+        ]
+        bound_field, bound = cls.validity_bound(now_time)
+        bound_column = quote(cls._meta.get_field(bound_field).column)
+        # existing token is kept while it is valid
+        assignments = ", ".join(
+            f"{quote(field.column)} = CASE WHEN {table}.{bound_column} > %s "
+            f"THEN {table}.{quote(field.column)} "
+            f"ELSE EXCLUDED.{quote(field.column)} END"
+            for field in fields[1:]
+        )
+        bound_param = cls._meta.get_field(bound_field).get_db_prep_save(
+            bound, connection
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} "
+                f"({', '.join(quote(field.column) for field in fields)}) "
+                f"VALUES ({', '.join(['%s'] * len(fields))}) "
+                f"ON CONFLICT ({quote(fields[0].column)}) "
+                f"DO UPDATE SET {assignments} "
+                f"RETURNING {quote(cls._meta.pk.column)}, "
+                f"{', '.join(quote(field.column) for field in fields[1:])}",
+                [
+                    field.get_db_prep_save(
+                        getattr(new_token, field.attname), connection
+                    )
+                    for field in fields
+                ]
+                + [bound_param] * len(fields[1:]),
+            )
+            row = cursor.fetchone()
+
+        issued = new_token.token
+        new_token.pk = row[0]
+        for field, value in zip(fields[1:], row[1:]):
+            setattr(
+                new_token,
+                field.attname,
+                cls._from_db_value(field, value, connection),
+            )
+        new_token._state.adding = False
+        new_token._state.db = connection.alias
+        if new_token.token == issued:
+            # not an existing valid token
+            metrics.TOKENS_ISSUED.labels(type="refresh").inc()
+        return new_token
+
+    @classmethod
+    def _from_db_value(cls, field, value, connection):
+        """Converts raw value fetched by cursor to python one"""
+        expression = field.get_col(cls._meta.db_table)
+        converters = connection.ops.get_db_converters(
+            expression
+        ) + expression.get_db_converters(connection)
+        for converter in converters:
+            value = converter(value, expression, connection)
+        return value
+
+    @classmethod
+    def rotate(
+        cls, token: uuid.UUID
+    ) -> Optional[Tuple["RefreshToken", CustomUser]]:
+        """
+        Replaces unexpired token with a new one in a single statement
+        (safe against concurrent rotations of the same token);
+        returns new token along with its user, or None if given token
+        doesn't exist or has expired
+        """
+        connection = connections[router.db_for_write(cls)]
+        quote = connection.ops.quote_name
+        now_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        new_token = cls(
+            token=uuid.uuid4(),
+            created_at=now_time,
+            expires_at=now_time
+            + datetime.timedelta(
+                seconds=config_snapshot.REFRESH_TOKEN_LIFETIME
+            ),
+        )
+        fields = {
+            name: cls._meta.get_field(name)
+            for name in ("token", "created_at", "expires_at")
+        }
+        bound_field, bound = cls.validity_bound(now_time)
+        params = [
+            field.get_db_prep_save(getattr(new_token, name), connection)
+            for name, field in fields.items()
+        ] + [
+            fields["token"].get_db_prep_save(token, connection),
+            fields[bound_field].get_db_prep_save(bound, connection),
+        ]
+        assignments = ", ".join(
+            f"{quote(field.column)} = %s" for field in fields.values()
+        )
+        update = (
+            f"UPDATE {quote(cls._meta.db_table)} SET {assignments} "
+            f"WHERE {quote(fields['token'].column)} = %s "
+            f"AND {quote(fields[bound_field].column)} > %s "
+            f"RETURNING {quote(cls._meta.pk.column)}, "
+            f"{quote(cls._meta.get_field('user').column)}"
+        )
+        user_fields = CustomUser._meta.concrete_fields
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # user row is fetched in the same round trip
+                columns = ", ".join(
+                    f"u.{quote(field.column)}" for field in user_fields
+                )
+                cursor.execute(
+                    f"WITH rotated AS ({update}) "
+                    f"SELECT rotated.{quote(cls._meta.pk.column)}, {columns} "
+                    "FROM rotated "
+                    f"JOIN {quote(CustomUser._meta.db_table)} u "
+                    f"ON u.{quote(CustomUser._meta.pk.column)} = "
+                    f"rotated.{quote(cls._meta.get_field('user').column)}",
+                    params,
+                )
+            else:
+                cursor.execute(update, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        if connection.vendor == "postgresql":
+            user = CustomUser.from_db(
+                connection.alias,
+                [field.attname for field in user_fields],
+                row[1:],
+            )
+        else:
+            user = CustomUser._default_manager.using(connection.alias).get(
+                pk=row[1]
+            )
+        new_token.pk = row[0]
+        new_token.user = user
+        metrics.REFRESH_TOKENS_ROTATED.inc()
+        new_token._state.adding = False
+        new_token._state.db = connection.alias
+        return new_token, user
+
+    @classmethod
+    def delete_expired(cls, batch_size: int) -> int:
+        """Deletes up to batch_size expired tokens (oldest first);
+        returns number of tokens deleted"""
+        bound_field, bound = cls.validity_bound(django_now())
+        batch = (
+            cls.objects.filter(**{f"{bound_field}__lte": bound})
+            .order_by(bound_field)
+            .values("pk")[:batch_size]
+        )
+        deleted, _ = cls.objects.filter(pk__in=batch).delete()
+        return deleted
 
     def expired(self):
-        return django_now() >= self.expires_at
+        bound_field, bound = self.validity_bound(django_now())
+        return getattr(self, bound_field) <= bound
+
+    @property
+    def expiry(self) -> datetime.datetime:
+        """Moment the token expires at, as checked by expired(); stored
+        expires_at is ignored with REFRESH_TOKEN_LAZY_EXPIRY"""
+        now_time = django_now()
+        bound_field, bound = self.validity_bound(now_time)
+        return getattr(self, bound_field) + (now_time - bound)
 
     def __str__(self):
         return (
             f"User: {self.user.username}\n"
             f"Token: {self.token}\n"
             f"Created at: {self.created_at}\n"
-            f"Expires at: {self.expires_at}"
+            f"Expires at: {self.expiry}"
         )
@@ -0,0 +1,60 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from api.models import RefreshToken
+
+from django.db import DatabaseError, connection
+
+logger = logging.getLogger(__name__)
+
+_started_pid = None
+_lock = threading.Lock()
+
+
+def purge_expired_tokens(batch_size: int, pause: float = 0) -> int:
+    """
+    Deletes all expired refresh tokens in batches of batch_size, so that
+    no statement holds locks for long; returns number of tokens deleted
+    """
+    total = 0
+    while True:
+        deleted = RefreshToken.delete_expired(batch_size)
+        total += deleted
+        if deleted < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def start_reaper(interval: float, batch_size: int) -> None:
+    """Starts periodic purge of expired tokens in a background thread;
+    does nothing if it was already started in this process"""
+    global _started_pid
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    threading.Thread(
+        target=_run,
+        args=(interval, batch_size),
+        name="refresh-token-reaper",
+        daemon=True,
+    ).start()
+
+
+def _run(interval: float, batch_size: int) -> None:
+    # spread the runs of different workers over the interval
+    time.sleep(random.uniform(0, interval))
+    while True:
+        try:
+            deleted = purge_expired_tokens(batch_size)
+            if deleted:
+                logger.info("purged %d expired refresh tokens", deleted)
+        except DatabaseError:
+            logger.exception("failed to purge expired refresh tokens")
+        finally:
+            connection.close()
+        time.sleep(interval)
@@ -0,0 +1,85 @@
+"""
+JSON encoding of api requests and responses with orjson.
+
+orjson is optional: without it everything falls back to the stdlib json
+module DRF uses, producing the same documents. Types orjson doesn't
+encode natively (lazy strings, Decimal, datetime, ...) are passed to
+DRF's encoder, so output doesn't depend on which one is used.
+"""
+
+import json
+
+from django.http import HttpResponse
+
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = JSONEncoder(
+    ensure_ascii=False, allow_nan=False, separators=(",", ":")
+)
+
+
+def dumps(data) -> bytes:
+    if orjson is None:
+        return _encoder.encode(data).encode()
+    return orjson.dumps(
+        data,
+        default=_encoder.default,
+        # datetimes are formatted by DRF (milliseconds, "Z" for UTC)
+        option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+    )
+
+
+def loads(data: bytes):
+    """Raises ValueError if data isn't valid JSON"""
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """Renders with dumps(); indented or ASCII-only output (requested
+    by clients or settings) is left to DRF"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None
+            or data is None
+            or self.ensure_ascii
+            or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {})
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        # escaped by DRF as well, so responses are valid javascript
+        return (
+            dumps(data)
+            .replace(b"\xe2\x80\xa8", b"\\u2028")
+            .replace(b"\xe2\x80\xa9", b"\\u2029")
+        )
+
+
+class JSONParser(parsers.JSONParser):
+    renderer_class = JSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get("encoding", "utf-8")
+        if orjson is None or encoding.lower() not in ("utf-8", "utf8"):
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
+
+
+class JsonResponse(HttpResponse):
+    """django.http.JsonResponse encoding data with dumps()"""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=dumps(data), **kwargs)
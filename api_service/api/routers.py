@@ -0,0 +1,157 @@
+"""
+Routing of queries between the primary database ("default") and its read
+replicas (DATABASE_REPLICAS).
+
+Writes always go to the primary. Reads go to a random replica only for
+GET, HEAD and OPTIONS requests (and views decorated with replica_reads,
+see api.middleware.DatabaseRoutingMiddleware); requests with other
+methods write, so what they read (unique checks, users and tokens they
+update) comes from the primary, as do reads inside transactions and
+outside of requests (commands, shell).
+
+Replicas lag behind the primary, so after a request has written, reads of
+the user it was made by (or that it created or updated) stick to the
+primary for DATABASE_REPLICA_STICKINESS seconds; the mark is kept in the
+shared cache, so it holds on every worker and node.
+"""
+
+import functools
+import logging
+import random
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+from api.models import CustomUser
+
+from asgiref.sync import iscoroutinefunction
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestRouting:
+    # reads go to the primary
+    primary: bool = False
+    # user the request is made by, once authenticated
+    user_id: Optional[int] = None
+    # whether stickiness of user_id has been looked up
+    checked: bool = False
+    wrote: bool = False
+    # users created or updated by the request
+    written_users: List[CustomUser] = field(default_factory=list)
+
+
+current_routing: ContextVar[Optional[RequestRouting]] = ContextVar(
+    "current_request_routing", default=None
+)
+
+
+def sticky_key(user_id) -> str:
+    return f"db:primary:{user_id}"
+
+
+def stick_to_primary(user_ids: Set[int]) -> None:
+    """Sends reads of the users to the primary for a while"""
+    try:
+        cache.set_many(
+            {sticky_key(user_id): 1 for user_id in user_ids},
+            timeout=settings.DATABASE_REPLICA_STICKINESS,
+        )
+    except RedisError:
+        logger.warning("database stickiness not recorded", exc_info=True)
+
+
+async def astick_to_primary(user_ids: Set[int]) -> None:
+    try:
+        await cache.aset_many(
+            {sticky_key(user_id): 1 for user_id in user_ids},
+            timeout=settings.DATABASE_REPLICA_STICKINESS,
+        )
+    except RedisError:
+        logger.warning("database stickiness not recorded", exc_info=True)
+
+
+def is_sticky(user_id) -> bool:
+    try:
+        return cache.get(sticky_key(user_id)) is not None
+    except RedisError:
+        # replica may not have the user's last write
+        logger.warning("database stickiness unavailable", exc_info=True)
+        return True
+
+
+def follow_user(user_id) -> None:
+    """Makes reads of the current request stick to the primary if the user
+    has written lately; stickiness is looked up on the first read"""
+    routing = current_routing.get()
+    if routing is not None:
+        routing.user_id = user_id
+
+
+def replica_reads(view):
+    """Lets read-only views accepting unsafe methods (e.g. POST with a
+    batch in the body) read from replicas"""
+
+    if iscoroutinefunction(view):
+
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            routing = current_routing.get()
+            if routing is not None:
+                routing.primary = False
+            return await view(request, *args, **kwargs)
+
+    else:
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            routing = current_routing.get()
+            if routing is not None:
+                routing.primary = False
+            return view(request, *args, **kwargs)
+
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if (
+            routing is None
+            or routing.primary
+            or not settings.DATABASE_REPLICAS
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        if routing.user_id is not None and not routing.checked:
+            routing.checked = True
+            routing.primary = is_sticky(routing.user_id)
+            if routing.primary:
+                return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            # rest of the request reads what it has written
+            routing.primary = routing.wrote = True
+            instance = hints.get("instance")
+            if isinstance(instance, CustomUser):
+                # new users have no id yet
+                routing.written_users.append(instance)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        return db == DEFAULT_DB_ALIAS
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 
 from rest_framework import serializers
@@ -35,11 +36,30 @@ class LoginSerializer(serializers.Serializer):
     password = serializers.CharField(write_only=True)
 
 
+class IntrospectionSerializer(serializers.Serializer):
+    access_tokens = serializers.ListField(
+        child=serializers.CharField(), required=False, default=list
+    )
+    refresh_tokens = serializers.ListField(
+        child=serializers.CharField(), required=False, default=list
+    )
+
+    def validate(self, attrs):
+        limit = settings.INTROSPECTION_MAX_TOKENS
+        if len(attrs["access_tokens"]) + len(attrs["refresh_tokens"]) > limit:
+            raise serializers.ValidationError(
+                f"at most {limit} tokens may be introspected at once"
+            )
+        return attrs
+
+
 class TokenSerializer(serializers.ModelSerializer):
+    # stored expires_at isn't checked with lazy expiry
+    expires_at = serializers.DateTimeField(source="expiry", read_only=True)
+
     class Meta:
         model = RefreshToken
         fields = ("user", "token", "expires_at")
         extra_kwargs = {
             "user": {"read_only": True},
-            "expires_at": {"read_only": True},
         }
@@ -0,0 +1,304 @@
+"""
+Stateless refresh tokens, used instead of RefreshToken rows when
+REFRESH_TOKEN_STATELESS is enabled.
+
+Token is a JWT carrying user id ("uid"), id of the family of tokens
+obtained by rotating the one issued at login ("fam"), its own id ("jti")
+and expiry, so checking it needs no database read. Only revocations are
+stored: ids of rotated tokens and of logged out families, in a redis
+sorted set scored by the time they are no longer needed.
+
+Every worker mirrors the set into a Bloom filter kept up to date over
+redis pub/sub, so checking a token that isn't revoked (the common case)
+is done in memory; possible matches are confirmed in redis.
+"""
+
+import datetime
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Iterable, Optional
+
+from api import metrics
+from api.config_snapshot import config_snapshot
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac
+
+import jwt
+
+import redis
+from redis.exceptions import RedisError
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+REVOKED_KEY = "refresh:revoked"
+CHANNEL = "refresh:revocations"
+
+
+class RevocationUnavailable(APIException):
+    """Raised when revocation set can't be reached; tokens are neither
+    accepted nor rotated without it"""
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Server is busy, try again later."
+    default_code = "revocation_unavailable"
+
+    def __init__(self, wait: int = 1, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class TokenRevoked(Exception):
+    pass
+
+
+class BloomFilter:
+    """Set membership test with no false negatives and `error_rate`
+    false positives while it holds up to `capacity` items"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray(math.ceil(self.size / 8))
+        # setting a bit is read-modify-write of its byte
+        self._lock = threading.Lock()
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, item: str) -> None:
+        positions = list(self._positions(item))
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationSet:
+    """
+    Revoked token and family ids shared by all workers.
+
+    The redis set is mirrored into a Bloom filter of the process by a
+    listener thread; until the mirror is loaded (or while its
+    subscription is lost) every check goes to redis. Expired ids can't
+    be removed from the filter, so it is rebuilt every
+    `rebuild_interval` seconds.
+    """
+
+    rebuild_interval = 300
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._bloom: Optional[BloomFilter] = None
+        self._built_at = 0.0
+        self._client = None
+        self._url = None
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def client(self) -> redis.Redis:
+        url = settings.REFRESH_TOKEN_REVOCATION_URL
+        if self._client is None or self._url != url:
+            self._client = redis.from_url(
+                url, socket_connect_timeout=0.5, socket_timeout=0.5
+            )
+            self._url = url
+        return self._client
+
+    def add(self, item: str, expires_at: float) -> bool:
+        """Adds item kept until expires_at (unix time); returns False if
+        it was there already, so only one of concurrent callers wins"""
+        self._start_listener()
+        try:
+            pipe = self.client().pipeline()
+            pipe.zremrangebyscore(REVOKED_KEY, "-inf", time.time())
+            pipe.zadd(REVOKED_KEY, {item: expires_at}, nx=True)
+            pipe.publish(CHANNEL, item)
+            _, added, _ = pipe.execute()
+        except RedisError as exc:
+            logger.warning("revocation set unavailable", exc_info=True)
+            raise RevocationUnavailable() from exc
+        bloom = self._bloom
+        if bloom is not None:
+            bloom.add(item)
+        return bool(added)
+
+    def __contains__(self, item: str) -> bool:
+        self._start_listener()
+        bloom = self._bloom
+        if bloom is not None and item not in bloom:
+            metrics.REVOCATION_CHECKS.labels(result="bloom_miss").inc()
+            return False
+        try:
+            expires_at = self.client().zscore(REVOKED_KEY, item)
+        except RedisError as exc:
+            logger.warning("revocation set unavailable", exc_info=True)
+            raise RevocationUnavailable() from exc
+        revoked = expires_at is not None and expires_at > time.time()
+        metrics.REVOCATION_CHECKS.labels(
+            result="revoked" if revoked else "not_revoked"
+        ).inc()
+        return revoked
+
+    def load(self) -> None:
+        """Rebuilds the filter from unexpired items of the redis set"""
+        items = self.client().zrangebyscore(REVOKED_KEY, time.time(), "+inf")
+        bloom = BloomFilter(max(self.capacity, 2 * len(items)))
+        for item in items:
+            bloom.add(item.decode())
+        self._bloom = bloom
+        self._built_at = time.monotonic()
+
+    def _start_listener(self) -> None:
+        """Starts pub/sub listener once per process (forked workers
+        don't inherit threads, so each of them starts its own)"""
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+        threading.Thread(
+            target=self._listen, name="refresh-revocations", daemon=True
+        ).start()
+
+    def _listen(self) -> None:
+        while True:
+            try:
+                pubsub = self.client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # anything published while we weren't subscribed is lost
+                self.load()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._bloom.add(message["data"].decode())
+                    full = self._bloom.count > self._bloom.capacity
+                    outdated = (
+                        time.monotonic() - self._built_at
+                        > self.rebuild_interval
+                    )
+                    if full or outdated:
+                        self.load()
+            except RedisError:
+                # checks go to redis until the mirror is loaded again
+                self._bloom = None
+                logger.warning(
+                    "refresh token revocations subscription lost",
+                    exc_info=True,
+                )
+                time.sleep(1)
+
+
+revocations = RevocationSet(settings.REFRESH_TOKEN_BLOOM_CAPACITY)
+
+
+def signing_key() -> str:
+    # derived key, so refresh tokens are never accepted as access tokens
+    return salted_hmac("api.stateless", "refresh token").hexdigest()
+
+
+def family_key(family: str) -> str:
+    return f"fam:{family}"
+
+
+def token_key(token_id: str) -> str:
+    return f"jti:{token_id}"
+
+
+def issue(user_id, family: Optional[str] = None) -> str:
+    """Returns new refresh token of the user; it starts a new family
+    unless the family of the rotated token is given"""
+    now_time = datetime.datetime.now(tz=datetime.timezone.utc)
+    token = jwt.encode(
+        {
+            "uid": user_id,
+            "fam": family or uuid.uuid4().hex,
+            "jti": uuid.uuid4().hex,
+            "iat": int(now_time.timestamp()),
+            "exp": int(
+                (
+                    now_time
+                    + datetime.timedelta(
+                        seconds=config_snapshot.REFRESH_TOKEN_LIFETIME
+                    )
+                ).timestamp()
+            ),
+        },
+        signing_key(),
+        algorithm="HS256",
+    )
+    metrics.TOKENS_ISSUED.labels(type="refresh").inc()
+    return token
+
+
+def decode(token: str) -> dict:
+    """
+    Returns claims of a refresh token with valid signature; raises
+    jwt.ExpiredSignatureError if it has expired (with
+    REFRESH_TOKEN_LAZY_EXPIRY also by current lifetime, so shortening it
+    applies to issued tokens) and jwt.InvalidTokenError if it is invalid
+    """
+    claims = jwt.decode(
+        token,
+        signing_key(),
+        algorithms=["HS256"],
+        options={"require": ["uid", "fam", "jti", "iat", "exp"]},
+    )
+    if (
+        settings.REFRESH_TOKEN_LAZY_EXPIRY
+        and claims["iat"] + config_snapshot.REFRESH_TOKEN_LIFETIME
+        <= time.time()
+    ):
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return claims
+
+
+def family_expiry() -> float:
+    # every token of the family was issued before now
+    return time.time() + config_snapshot.REFRESH_TOKEN_LIFETIME
+
+
+def rotate(claims: dict) -> str:
+    """
+    Revokes the token and returns its successor from the same family.
+
+    Raises TokenRevoked if the token or its family was revoked; token
+    rotated for the second time has leaked, so its family is revoked
+    """
+    if family_key(claims["fam"]) in revocations:
+        raise TokenRevoked()
+    if not revocations.add(token_key(claims["jti"]), claims["exp"]):
+        revocations.add(family_key(claims["fam"]), family_expiry())
+        raise TokenRevoked()
+    metrics.REFRESH_TOKENS_ROTATED.inc()
+    return issue(claims["uid"], claims["fam"])
+
+
+def revoke(claims: dict) -> bool:
+    """Revokes family of the token (logout); returns False if the token
+    was revoked already"""
+    fresh = revocations.add(family_key(claims["fam"]), family_expiry())
+    return fresh and token_key(claims["jti"]) not in revocations
@@ -1,22 +1,97 @@
+import datetime
+import decimal
+import io
+import json
+import os
+import runpy
+import signal
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import uuid
 from http import HTTPStatus
+from pathlib import Path
 from typing import Dict, Final
+from unittest import mock, skipUnless
 
+from api import (
+    async_views,
+    hashing,
+    metrics,
+    renderers,
+    routers,
+    stateless,
+    user_cache,
+    warmup,
+)
+from api.authentication import ClaimsUser, JWTAuthentication
+from api.config_snapshot import ConfigSnapshot, config_snapshot
+from api.hashing import HashingExecutor
+from api.keys import key_ring
+from api.middleware import (
+    DatabaseRoutingMiddleware,
+    QueryBudgetExceeded,
+    QueryCountMiddleware,
+    route_stats,
+)
 from api.models import RefreshToken
+from api.reaper import purge_expired_tokens
+from api.serializers import TokenSerializer
+from api.stateless import BloomFilter, REVOKED_KEY, revocations
+from api.throttling import MemoryTokenBucket, RedisTokenBucket, rate_limiter
+from api.token_cache import TokenCache, token_cache
 from api.views import (
     RegisterUser,
     RetrieveUpdateUser,
     login_view,
     logout_view,
     refresh_view,
+    user_data,
+    user_etag,
 )
 
+from asgiref.sync import async_to_sync, sync_to_async
+
+from constance import config
+from constance.utils import get_values
+
+from cryptography.hazmat.primitives import serialization
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.urls import reverse_lazy
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import (
+    AsyncClient,
+    AsyncRequestFactory,
+    SimpleTestCase,
+    TransactionTestCase,
+    override_settings,
+    skipUnlessDBFeature,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse_lazy
+from django.utils.translation import gettext_lazy
+
+import jwt
 
 from parameterized import parameterized
 
+from prometheus_client import REGISTRY
+
+import redis
+
+from rest_framework import serializers
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.renderers import JSONRenderer as DRFJSONRenderer
 from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 
 
@@ -24,9 +99,74 @@ user_parametrization = parameterized.expand([("admin",), ("user1",)])
 ADMIN_EMAIL: Final = "admin@example.com"
 ADMIN_PASSWORD: Final = "admin@example.com"
 ADMIN_USERNAME: Final = "admin"
+LOCMEM_CACHES: Final = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
+def expire_refresh_token(pk, seconds_ago: int = 1) -> None:
+    """Makes token expired both by stored and computed expiry time"""
+    expired_at = datetime.datetime.now(
+        tz=datetime.timezone.utc
+    ) - datetime.timedelta(seconds=seconds_ago)
+    RefreshToken.objects.filter(pk=pk).update(
+        created_at=expired_at
+        - datetime.timedelta(seconds=config.REFRESH_TOKEN_LIFETIME),
+        expires_at=expired_at,
+    )
+
+
+def throttle_rates(**rates) -> dict:
+    """REST_FRAMEWORK setting with given throttle rates only"""
+    return {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    RATE_LIMIT_BACKEND="memory",
+    QUERY_BUDGET_STRICT=True,
+)
+class CacheIsolatedTestCase(APITestCase):
+    """Every test starts with empty user and token caches and rate
+    limiter buckets; requests going over their query budget fail"""
+
+    def setUp(self) -> None:
+        cache.clear()
+        token_cache.clear()
+        rate_limiter.clear()
+
+
+class UserTestCase(CacheIsolatedTestCase):
+    """Tests made with a user (self.user) logging in with ADMIN_EMAIL
+    and ADMIN_PASSWORD"""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.request_factory = APIRequestFactory()
+        cls.user = get_user_model().objects.create(
+            username=ADMIN_USERNAME,
+            email=ADMIN_EMAIL,
+            password=ADMIN_PASSWORD,
+        )
+
+    def login(self, email: str = ADMIN_EMAIL, **extra):
+        return self.client.post(
+            reverse_lazy("api:login"),
+            {"email": email, "password": ADMIN_PASSWORD},
+            format="json",
+            **extra,
+        )
+
+    def authenticate(self, token: str):
+        """Authenticates request with the access token"""
+        request = self.request_factory.get(
+            reverse_lazy("api:account_options"),
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        return JWTAuthentication().authenticate(request)
 
 
-class APIUnitTests(APITestCase):
+class APIUnitTests(CacheIsolatedTestCase):
 
     @classmethod
     def setUpTestData(cls) -> None:
@@ -51,6 +191,7 @@ class APIUnitTests(APITestCase):
         )
 
     def setUp(self) -> None:
+        super().setUp()
         self.test_class = type(self)
 
     def get_user_tokens(self, username: str) -> Dict[str, str]:
@@ -285,3 +426,2131 @@ class APIUnitTests(APITestCase):
         )
         response = RegisterUser.as_view()(request)
         self.assertEqual(response.status_code, expected_code)
+
+
+class TokenCacheTests(UserTestCase):
+    def test_repeated_token_skips_database(self):
+        token = RefreshToken.create_access_token(self.user)
+        self.authenticate(token)
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate(token)
+        self.assertEqual(user.email, ADMIN_EMAIL)
+        self.assertEqual(token_cache.stats()["hits"], 1)
+        self.assertEqual(token_cache.stats()["misses"], 1)
+
+    def test_cached_user_is_a_copy(self):
+        token = RefreshToken.create_access_token(self.user)
+        user, _ = self.authenticate(token)
+        user.username = "changed"
+        user, _ = self.authenticate(token)
+        self.assertEqual(user.username, ADMIN_USERNAME)
+
+    def test_user_save_invalidates_entries(self):
+        token = RefreshToken.create_access_token(self.user)
+        self.authenticate(token)
+        self.user.username = "renamed"
+        self.user.save()
+        user, _ = self.authenticate(token)
+        self.assertEqual(user.username, "renamed")
+        self.assertEqual(token_cache.stats()["hits"], 0)
+
+    def test_revocation_by_other_worker_rejects_cached_token(self):
+        token = RefreshToken.create_access_token(self.user)
+        self.authenticate(token)
+        # saved by another worker: shared user cache is invalidated,
+        # token cache of this worker is not
+        with mock.patch.object(token_cache, "invalidate_user"):
+            self.user.set_password("another password")
+            self.user.save()
+        with self.assertRaisesMessage(AuthenticationFailed, "Token revoked"):
+            self.authenticate(token)
+
+        request = AsyncRequestFactory().get(
+            reverse_lazy("api:account_options"),
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        with self.assertRaisesMessage(AuthenticationFailed, "Token revoked"):
+            async_to_sync(JWTAuthentication().aauthenticate)(request)
+
+    def test_least_recently_used_entry_evicted(self):
+        cache = TokenCache(maxsize=2)
+        payload = {"exp": time.time() + 60}
+        for token in ("first", "second", "third"):
+            cache.set(token, payload, self.user)
+        self.assertIsNone(cache.get("first"))
+        self.assertIsNotNone(cache.get("third"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expired_entry_not_returned(self):
+        cache = TokenCache(maxsize=2)
+        cache.set("token", {"exp": time.time() - 1}, self.user)
+        self.assertIsNone(cache.get("token"))
+
+
+@override_settings(ACCESS_TOKEN_CLAIMS_AUTH=True)
+class ClaimsAuthenticationTests(UserTestCase):
+    def test_token_fields_served_from_claims(self):
+        token = RefreshToken.create_access_token(self.user)
+        with self.assertNumQueries(1):
+            user, _ = self.authenticate(token)
+            self.assertIsInstance(user, ClaimsUser)
+            self.assertEqual(user.id, self.user.id)
+            self.assertEqual(user.username, ADMIN_USERNAME)
+            self.assertEqual(user.email, ADMIN_EMAIL)
+            self.assertTrue(user.is_authenticated)
+
+    def test_other_fields_loaded_lazily(self):
+        token = RefreshToken.create_access_token(self.user)
+        user, _ = self.authenticate(token)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.date_joined, self.user.date_joined)
+
+    def test_update_revokes_issued_tokens(self):
+        token = RefreshToken.create_access_token(self.user)
+        request = self.request_factory.put(
+            reverse_lazy("api:account_options"),
+            {"username": "renamed"},
+            headers={"Authorization": f"Bearer {token}"},
+            format="json",
+        )
+        response = RetrieveUpdateUser.as_view()(request)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response.data["username"], "renamed")
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_password_change_revokes_issued_tokens(self):
+        token = RefreshToken.create_access_token(self.user)
+        self.user.set_password("another password")
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+        self.assertIsNotNone(
+            self.authenticate(RefreshToken.create_access_token(self.user))
+        )
+
+
+class UserCacheTests(UserTestCase):
+    def test_lookups_read_through_cache(self):
+        user_cache.get_user_by_email(ADMIN_EMAIL)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                user_cache.get_user_by_email(ADMIN_EMAIL).pk, self.user.pk
+            )
+            self.assertEqual(
+                user_cache.get_user_by_id(self.user.pk).email, ADMIN_EMAIL
+            )
+            self.assertEqual(
+                user_cache.get_token_version(self.user.pk),
+                self.user.token_version,
+            )
+
+    def test_save_invalidates_entries(self):
+        user_cache.get_user_by_id(self.user.pk)
+        self.user.username = "renamed"
+        self.user.save()
+        self.assertEqual(
+            user_cache.get_user_by_id(self.user.pk).username, "renamed"
+        )
+
+    def test_old_email_not_resolved_after_change(self):
+        user_cache.get_user_by_email(ADMIN_EMAIL)
+        self.user.email = "new@example.com"
+        self.user.save()
+        with self.assertRaises(get_user_model().DoesNotExist):
+            user_cache.get_user_by_email(ADMIN_EMAIL)
+
+    def test_update_writes_through(self):
+        token = RefreshToken.create_access_token(self.user)
+        request = self.request_factory.put(
+            reverse_lazy("api:account_options"),
+            {"username": "renamed"},
+            headers={"Authorization": f"Bearer {token}"},
+            format="json",
+        )
+        RetrieveUpdateUser.as_view()(request)
+        with self.assertNumQueries(0):
+            user = user_cache.get_user_by_id(self.user.pk)
+        self.assertEqual(user.username, "renamed")
+
+    def test_password_hash_not_cached(self):
+        user_cache.get_user_by_email(ADMIN_EMAIL)
+        cached = cache.get(user_cache.id_key(self.user.pk))
+        self.assertNotIn(self.user.password, cached)
+        with self.assertNumQueries(0):
+            user = user_cache.get_user_by_id(self.user.pk)
+        self.assertEqual(user.get_deferred_fields(), {"password"})
+        # loaded on access
+        with self.assertNumQueries(1):
+            self.assertEqual(user.password, self.user.password)
+
+    def test_cached_user_saves_loaded_fields(self):
+        user_cache.get_user_by_id(self.user.pk)
+        user = user_cache.get_user_by_id(self.user.pk)
+        user.username = "renamed"
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.username, "renamed")
+        self.assertTrue(self.user.check_password(ADMIN_PASSWORD))
+
+    def test_login_reads_password_from_database(self):
+        user_cache.get_user_by_email(ADMIN_EMAIL)
+        request = self.request_factory.post(
+            reverse_lazy("api:login"),
+            {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+            format="json",
+        )
+        # user with its password hash and refresh token upsert
+        with self.assertNumQueries(2):
+            response = login_view(request)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        with self.assertNumQueries(0):
+            user_cache.get_user_by_id(self.user.pk)
+
+    def test_invalidated_again_on_commit(self):
+        stale = get_user_model().objects.get(pk=self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.username = "renamed"
+            self.user.save()
+            # lookup done before the transaction commits
+            user_cache.cache_user(stale)
+        self.assertEqual(
+            user_cache.get_user_by_id(self.user.pk).username, "renamed"
+        )
+
+    @override_settings(
+        CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.redis.RedisCache",
+                "LOCATION": "redis://127.0.0.1:1",
+            }
+        }
+    )
+    def test_falls_back_to_database_without_redis(self):
+        with self.assertLogs("api.user_cache", level="WARNING"):
+            user = user_cache.get_user_by_email(ADMIN_EMAIL)
+        self.assertEqual(user.pk, self.user.pk)
+
+
+class ConfigSnapshotTests(UserTestCase):
+    def isolated_snapshot(self, max_age: float) -> ConfigSnapshot:
+        """Snapshot without pub/sub listener, which reloads it on its own"""
+        snapshot = ConfigSnapshot(max_age=max_age)
+        snapshot._start_listener = lambda: None
+        return snapshot
+
+    def test_values_served_from_memory(self):
+        snapshot = self.isolated_snapshot(max_age=60)
+        with mock.patch(
+            "api.config_snapshot.get_values", wraps=get_values
+        ) as fetch:
+            snapshot.ACCESS_TOKEN_LIFETIME
+            snapshot.REFRESH_TOKEN_LIFETIME
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_outdated_snapshot_reloaded(self):
+        snapshot = self.isolated_snapshot(max_age=0)
+        with mock.patch(
+            "api.config_snapshot.get_values", wraps=get_values
+        ) as fetch:
+            snapshot.ACCESS_TOKEN_LIFETIME
+            snapshot.ACCESS_TOKEN_LIFETIME
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_outdated_snapshot_served_while_listener_reloads_it(self):
+        snapshot = ConfigSnapshot(max_age=0)
+        snapshot.reload()
+        # listener of this process is running
+        snapshot._listener_pid = os.getpid()
+        with mock.patch(
+            "api.config_snapshot.get_values", wraps=get_values
+        ) as fetch:
+            snapshot.ACCESS_TOKEN_LIFETIME
+        fetch.assert_not_called()
+
+    def test_listener_reloads_snapshot_periodically(self):
+        class Stop(Exception):
+            pass
+
+        snapshot = ConfigSnapshot(max_age=30)
+        pubsub = mock.Mock()
+        # two timeouts without announcements
+        pubsub.get_message.side_effect = [None, None, Stop]
+        with mock.patch("api.config_snapshot.redis_client") as client:
+            client.return_value.pubsub.return_value = pubsub
+            with mock.patch(
+                "api.config_snapshot.get_values", wraps=get_values
+            ) as fetch, self.assertRaises(Stop):
+                snapshot._listen()
+        pubsub.get_message.assert_called_with(timeout=30)
+        # on subscription and after each timeout
+        self.assertEqual(fetch.call_count, 3)
+
+    def test_config_change_applied_to_tokens(self):
+        lifetime = config.ACCESS_TOKEN_LIFETIME
+        self.addCleanup(setattr, config, "ACCESS_TOKEN_LIFETIME", lifetime)
+        config_snapshot.ACCESS_TOKEN_LIFETIME
+        config.ACCESS_TOKEN_LIFETIME = 3600
+
+        self.assertEqual(config_snapshot.ACCESS_TOKEN_LIFETIME, 3600)
+        payload = jwt.decode(
+            RefreshToken.create_access_token(self.user),
+            settings.SECRET_KEY,
+            algorithms=["HS256"],
+        )
+        self.assertGreater(payload["exp"], time.time() + 3000)
+
+
+class RefreshRotationTests(UserTestCase):
+    def refresh(self, token):
+        request = self.request_factory.post(
+            reverse_lazy("api:refresh"),
+            {"refresh_token": str(token)},
+            format="json",
+        )
+        return refresh_view(request)
+
+    def test_rotation_is_a_single_statement(self):
+        token = RefreshToken.create_refresh_token(self.user).token
+        with self.assertNumQueries(
+            1 if connection.vendor == "postgresql" else 2
+        ):
+            response = self.refresh(token)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotEqual(response.data["refresh_token"], token)
+        self.assertEqual(
+            RefreshToken.objects.get(user=self.user).token,
+            response.data["refresh_token"],
+        )
+
+    def test_rotated_token_cannot_be_reused(self):
+        token = RefreshToken.create_refresh_token(self.user).token
+        self.assertEqual(self.refresh(token).status_code, HTTPStatus.OK)
+        self.assertEqual(
+            self.refresh(token).status_code, HTTPStatus.UNAUTHORIZED
+        )
+
+    def test_expired_token_removed(self):
+        refresh = RefreshToken.create_refresh_token(self.user)
+        expire_refresh_token(refresh.pk)
+        response = self.refresh(refresh.token)
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertEqual(response.data["error"], "Refresh token expired")
+        self.assertFalse(RefreshToken.objects.filter(pk=refresh.pk).exists())
+
+
+class RefreshIssueTests(UserTestCase):
+    def test_token_created_in_single_statement(self):
+        with self.assertNumQueries(1):
+            refresh = RefreshToken.issue(self.user)
+        stored = RefreshToken.objects.get(user=self.user)
+        self.assertEqual(refresh.pk, stored.pk)
+        self.assertEqual(refresh.token, stored.token)
+        self.assertEqual(refresh.expires_at, stored.expires_at)
+
+    def test_valid_token_kept(self):
+        token = RefreshToken.issue(self.user).token
+        self.assertEqual(RefreshToken.issue(self.user).token, token)
+
+    def test_expired_token_replaced(self):
+        refresh = RefreshToken.issue(self.user)
+        expire_refresh_token(refresh.pk)
+        reissued = RefreshToken.issue(self.user)
+        self.assertNotEqual(reissued.token, refresh.token)
+        self.assertFalse(reissued.expired())
+        self.assertEqual(
+            RefreshToken.objects.filter(user=self.user).count(), 1
+        )
+
+
+@skipUnless(connection.vendor == "postgresql", "PostgreSQL statements")
+class PostgresRefreshTokenTests(UserTestCase):
+    """Runs the PostgreSQL-only statements of RefreshToken.issue and
+    rotate on a single connection, racing writers replaced by their
+    outcome being in the table already"""
+
+    def test_rotation_returns_user_from_same_statement(self):
+        refresh = RefreshToken.issue(self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            rotated, user = RefreshToken.rotate(refresh.token)
+
+        self.assertEqual(len(queries), 1)
+        self.assertIn("WITH rotated AS", queries[0]["sql"])
+        self.assertEqual(rotated.pk, refresh.pk)
+        self.assertNotEqual(rotated.token, refresh.token)
+        self.assertEqual(
+            RefreshToken.objects.get(pk=refresh.pk).token, rotated.token
+        )
+        for field in get_user_model()._meta.concrete_fields:
+            self.assertEqual(
+                getattr(user, field.attname),
+                getattr(self.user, field.attname),
+            )
+
+    def test_rotation_lost_to_other_rotation(self):
+        refresh = RefreshToken.issue(self.user)
+        winner, _ = RefreshToken.rotate(refresh.token)
+
+        self.assertIsNone(RefreshToken.rotate(refresh.token))
+        self.assertEqual(
+            RefreshToken.objects.get(pk=refresh.pk).token, winner.token
+        )
+
+    def test_expired_token_not_rotated(self):
+        refresh = RefreshToken.issue(self.user)
+        expire_refresh_token(refresh.pk)
+
+        self.assertIsNone(RefreshToken.rotate(refresh.token))
+        self.assertEqual(
+            RefreshToken.objects.get(pk=refresh.pk).token, refresh.token
+        )
+
+    def test_issue_conflicting_with_stored_token(self):
+        stored = RefreshToken.create_refresh_token(self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            kept = RefreshToken.issue(self.user)
+        expire_refresh_token(stored.pk)
+        replaced = RefreshToken.issue(self.user)
+
+        self.assertEqual(len(queries), 1)
+        self.assertIn("ON CONFLICT", queries[0]["sql"])
+        self.assertEqual((kept.pk, kept.token), (stored.pk, stored.token))
+        self.assertEqual(kept.created_at, stored.created_at)
+        self.assertEqual(replaced.pk, stored.pk)
+        self.assertNotEqual(replaced.token, stored.token)
+        self.assertFalse(replaced.expired())
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    RATE_LIMIT_BACKEND="memory",
+    REST_FRAMEWORK=throttle_rates(),
+)
+@skipUnlessDBFeature("test_db_allows_multiple_connections")
+class ConcurrentLoginTests(TransactionTestCase):
+    parallel_logins = 16
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.request_factory = APIRequestFactory()
+        # every login must reach the database, none may be shed
+        patcher = mock.patch.object(
+            hashing,
+            "hashing_executor",
+            HashingExecutor(
+                workers=4, queue_size=self.parallel_logins, retry_after=1
+            ),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_user_model().objects.create(
+            username=ADMIN_USERNAME,
+            email=ADMIN_EMAIL,
+            password=ADMIN_PASSWORD,
+        )
+
+    def test_parallel_logins_of_one_user(self):
+        barrier = threading.Barrier(self.parallel_logins)
+        responses = []
+
+        def login():
+            request = self.request_factory.post(
+                reverse_lazy("api:login"),
+                {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+                format="json",
+            )
+            barrier.wait()
+            try:
+                responses.append(login_view(request))
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=login)
+            for _ in range(self.parallel_logins)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            [response.status_code for response in responses],
+            [HTTPStatus.OK] * self.parallel_logins,
+        )
+        self.assertEqual(
+            len({response.data["refresh_token"] for response in responses}), 1
+        )
+        self.assertEqual(RefreshToken.objects.count(), 1)
+
+
+class ExpiredTokensPurgeTests(CacheIsolatedTestCase):
+    @classmethod
+    def setUpTestData(cls) -> None:
+        for index in range(4):
+            user = get_user_model().objects.create(
+                username=f"user{index}", email=f"user{index}@example.com"
+            )
+            refresh = RefreshToken.create_refresh_token(user)
+            if index:
+                expire_refresh_token(refresh.pk, seconds_ago=index)
+
+    def test_batch_deleted_in_single_statement(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(RefreshToken.delete_expired(2), 2)
+        self.assertEqual(RefreshToken.objects.count(), 2)
+
+    def test_all_expired_tokens_purged(self):
+        self.assertEqual(purge_expired_tokens(batch_size=2), 3)
+        self.assertEqual(RefreshToken.objects.count(), 1)
+        self.assertFalse(RefreshToken.objects.get().expired())
+
+    def test_management_command(self):
+        out = io.StringIO()
+        call_command("purge_refresh_tokens", "--batch-size", "1", stdout=out)
+        self.assertIn("Deleted 3 expired refresh tokens", out.getvalue())
+
+
+class LazyExpiryTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        lifetime = config.REFRESH_TOKEN_LIFETIME
+        self.addCleanup(setattr, config, "REFRESH_TOKEN_LIFETIME", lifetime)
+
+    @override_settings(REFRESH_TOKEN_LAZY_EXPIRY=True)
+    def test_lifetime_change_applies_without_rewriting_tokens(self):
+        refresh = RefreshToken.issue(self.user)
+        expires_at = refresh.expires_at
+        config.REFRESH_TOKEN_LIFETIME = 0
+
+        self.assertTrue(refresh.expired())
+        self.assertEqual(
+            RefreshToken.objects.get(pk=refresh.pk).expires_at, expires_at
+        )
+        self.assertIsNone(RefreshToken.rotate(refresh.token))
+        self.assertEqual(RefreshToken.delete_expired(10), 1)
+
+    @override_settings(REFRESH_TOKEN_LAZY_EXPIRY=False)
+    def test_stored_expiry_recomputed_on_lifetime_change(self):
+        refresh = RefreshToken.issue(self.user)
+        config.REFRESH_TOKEN_LIFETIME = 0
+
+        refresh.refresh_from_db()
+        self.assertTrue(refresh.expired())
+        self.assertEqual(refresh.expires_at, refresh.created_at)
+
+    @override_settings(REFRESH_TOKEN_LAZY_EXPIRY=True)
+    def test_saving_token_keeps_creation_time(self):
+        refresh = RefreshToken.issue(self.user)
+        created_at = refresh.created_at
+
+        refresh.save()
+
+        refresh.refresh_from_db()
+        self.assertEqual(refresh.created_at, created_at)
+
+    @parameterized.expand([(True,), (False,)])
+    def test_exposed_expiry_is_the_checked_one(self, lazy: bool):
+        with override_settings(REFRESH_TOKEN_LAZY_EXPIRY=lazy):
+            refresh = RefreshToken.issue(self.user)
+            config.REFRESH_TOKEN_LIFETIME = 60
+            if not lazy:
+                refresh.refresh_from_db()
+            expiry = refresh.created_at + datetime.timedelta(seconds=60)
+
+            self.assertEqual(refresh.expiry, expiry)
+            self.assertEqual(
+                TokenSerializer(refresh).data["expires_at"],
+                serializers.DateTimeField().to_representation(expiry),
+            )
+            self.assertIn(f"Expires at: {expiry}", str(refresh))
+
+
+class AsyncViewsTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+
+    def post(self, path: str, data: dict):
+        return self.factory.post(path, data, content_type="application/json")
+
+    async def login(self) -> dict:
+        response = await async_views.login_view(
+            self.post(
+                "/api/login/",
+                {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return json.loads(response.content)
+
+    async def test_login(self):
+        tokens = await self.login()
+
+        payload = jwt.decode(
+            tokens["access_token"], settings.SECRET_KEY, algorithms=["HS256"]
+        )
+        self.assertEqual(payload["sub"], ADMIN_EMAIL)
+        self.assertTrue(
+            await RefreshToken.objects.filter(
+                token=tokens["refresh_token"]
+            ).aexists()
+        )
+
+    async def test_login_invalid_credentials(self):
+        response = await async_views.login_view(
+            self.post(
+                "/api/login/", {"email": ADMIN_EMAIL, "password": "wrong"}
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    async def test_register(self):
+        response = await async_views.register_view(
+            self.post(
+                "/api/register/",
+                {"email": "new@example.com", "password": "Passw0rd!"},
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertTrue(
+            await get_user_model()
+            .objects.filter(email="new@example.com")
+            .aexists()
+        )
+
+    async def test_refresh(self):
+        tokens = await self.login()
+
+        response = await async_views.refresh_view(
+            self.post(
+                "/api/refresh/", {"refresh_token": tokens["refresh_token"]}
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotEqual(
+            json.loads(response.content)["refresh_token"],
+            tokens["refresh_token"],
+        )
+
+        response = await async_views.refresh_view(
+            self.post(
+                "/api/refresh/", {"refresh_token": tokens["refresh_token"]}
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    async def test_me(self):
+        tokens = await self.login()
+        auth = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+        response = await async_views.me_view(
+            self.factory.get("/api/me/", headers=auth)
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(json.loads(response.content)["email"], ADMIN_EMAIL)
+
+        response = await async_views.me_view(
+            self.factory.put(
+                "/api/me/",
+                {"username": "renamed"},
+                content_type="application/json",
+                headers=auth,
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(json.loads(response.content)["username"], "renamed")
+
+        # update bumps token version, revoking the old access token
+        response = await async_views.me_view(
+            self.factory.get("/api/me/", headers=auth)
+        )
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    async def test_me_conditional_requests(self):
+        tokens = await self.login()
+        auth = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+        response = await async_views.me_view(
+            self.factory.get("/api/me/", headers=auth)
+        )
+        etag = response["ETag"]
+        response = await async_views.me_view(
+            self.factory.get(
+                "/api/me/", headers={**auth, "If-None-Match": etag}
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+        response = await async_views.me_view(
+            self.factory.put(
+                "/api/me/",
+                {"username": "renamed"},
+                content_type="application/json",
+                headers={**auth, "If-Match": '"stale"'},
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.PRECONDITION_FAILED)
+
+    async def test_me_unauthenticated(self):
+        response = await async_views.me_view(self.factory.get("/api/me/"))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    async def test_logout(self):
+        tokens = await self.login()
+
+        response = await async_views.logout_view(
+            self.post(
+                "/api/logout/", {"refresh_token": tokens["refresh_token"]}
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertFalse(await RefreshToken.objects.aexists())
+
+
+class PasswordHashingTests(UserTestCase):
+    def saturate_executor(self) -> HashingExecutor:
+        """Replaces hashing executor with one whose only slot is taken"""
+        executor = HashingExecutor(workers=1, queue_size=0, retry_after=7)
+        patcher = mock.patch.object(hashing, "hashing_executor", executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        release = threading.Event()
+        executor.submit(release.wait)
+        self.addCleanup(release.set)
+        return executor
+
+    def test_login_rejected_when_queue_full(self):
+        executor = self.saturate_executor()
+
+        response = self.login()
+        self.assertEqual(response.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "7")
+        self.assertEqual(executor.stats()["rejected"], 1)
+
+    def test_registration_rejected_when_queue_full(self):
+        self.saturate_executor()
+
+        response = self.client.post(
+            reverse_lazy("api:registration"),
+            {"email": "new@example.com", "password": "Passw0rd!"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "7")
+        self.assertFalse(
+            get_user_model().objects.filter(email="new@example.com").exists()
+        )
+
+    async def test_async_login_rejected_when_queue_full(self):
+        self.saturate_executor()
+
+        response = await async_views.login_view(
+            AsyncRequestFactory().post(
+                "/api/login/",
+                {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+                content_type="application/json",
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers["Retry-After"], "7")
+
+    def test_slots_released_after_hashing(self):
+        executor = HashingExecutor(workers=1, queue_size=0, retry_after=1)
+
+        with mock.patch.object(hashing, "hashing_executor", executor):
+            for _ in range(3):
+                self.assertTrue(
+                    hashing.check_password(self.user, ADMIN_PASSWORD)
+                )
+        self.assertEqual(executor.stats()["in_flight"], 0)
+        self.assertEqual(executor.stats()["rejected"], 0)
+
+    def test_outdated_hash_upgraded_without_revoking_tokens(self):
+        self.user.password = make_password(
+            ADMIN_PASSWORD, hasher="pbkdf2_sha1"
+        )
+        self.user.save(update_fields=["password"])
+        version = get_user_model().objects.get(pk=self.user.pk).token_version
+
+        self.assertTrue(hashing.check_password(self.user, ADMIN_PASSWORD))
+
+        user = get_user_model().objects.get(pk=self.user.pk)
+        self.assertTrue(user.password.startswith("pbkdf2_sha256$"))
+        self.assertEqual(user.token_version, version)
+
+
+class ThrottlingTests(UserTestCase):
+    @override_settings(REST_FRAMEWORK=throttle_rates(login_email="2/min"))
+    def test_login_throttled_per_email(self):
+        for _ in range(2):
+            self.assertEqual(self.login().status_code, HTTPStatus.OK)
+
+        response = self.login(email=ADMIN_EMAIL.upper())
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        # one token is refilled every 30 seconds
+        self.assertIn(int(response.headers["Retry-After"]), range(1, 31))
+        # buckets of other addresses aren't affected
+        response = self.login(email="user@example.com")
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    @override_settings(REST_FRAMEWORK=throttle_rates(login_ip="1/min"))
+    def test_login_throttled_per_ip(self):
+        self.assertEqual(self.login().status_code, HTTPStatus.OK)
+
+        response = self.login(email="user@example.com")
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        response = self.login(REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    @override_settings(REST_FRAMEWORK=throttle_rates(login_ip="1/min"))
+    def test_throttled_before_hashing_and_queries(self):
+        self.login()
+
+        with mock.patch.object(
+            hashing.hashing_executor, "submit"
+        ) as submit, self.assertNumQueries(0):
+            response = self.login()
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        submit.assert_not_called()
+
+    @override_settings(
+        REST_FRAMEWORK=throttle_rates(register_email="1/min", refresh_ip="1/m")
+    )
+    def test_register_and_refresh_throttled(self):
+        data = {"email": "new@example.com", "password": "Passw0rd!"}
+        response = self.client.post(
+            reverse_lazy("api:registration"), data, format="json"
+        )
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        response = self.client.post(
+            reverse_lazy("api:registration"), data, format="json"
+        )
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+
+        for status in (HTTPStatus.UNAUTHORIZED, HTTPStatus.TOO_MANY_REQUESTS):
+            response = self.client.post(
+                reverse_lazy("api:refresh"),
+                {"refresh_token": str(uuid.uuid4())},
+                format="json",
+            )
+            self.assertEqual(response.status_code, status)
+
+    @override_settings(REST_FRAMEWORK=throttle_rates(login_email="1/min"))
+    async def test_async_login_throttled(self):
+        def request():
+            return async_views.login_view(
+                AsyncRequestFactory().post(
+                    "/api/login/",
+                    {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+                    content_type="application/json",
+                )
+            )
+
+        self.assertEqual((await request()).status_code, HTTPStatus.OK)
+        response = await request()
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertIn(int(response.headers["Retry-After"]), range(1, 61))
+
+    @override_settings(REST_FRAMEWORK=throttle_rates(login_email="1/min"))
+    def test_decisions_counted(self):
+        for _ in range(3):
+            self.login()
+
+        self.assertEqual(
+            rate_limiter.stats(), {"login": {"allowed": 1, "throttled": 2}}
+        )
+
+    @override_settings(
+        RATE_LIMIT_BACKEND="redis",
+        RATE_LIMIT_URL="redis://127.0.0.1:1/0",
+        REST_FRAMEWORK=throttle_rates(login_email="1/min"),
+    )
+    def test_memory_fallback_when_redis_unavailable(self):
+        labels = {"scope": "login", "decision": "fallback"}
+        exported = REGISTRY.get_sample_value(
+            "api_rate_limit_decisions_total", labels
+        )
+
+        with self.assertLogs("api.throttling", "WARNING"):
+            self.assertEqual(self.login().status_code, HTTPStatus.OK)
+            response = self.login()
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertEqual(rate_limiter.stats()["login"]["fallback"], 2)
+        # visible to /metrics, summed over workers
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                "api_rate_limit_decisions_total", labels
+            ),
+            (exported or 0) + 2,
+        )
+
+    def test_bucket_refilled_over_time(self):
+        bucket = MemoryTokenBucket()
+        buckets = [("key", 1.0, 2)]
+
+        with mock.patch("api.throttling.time.monotonic", return_value=100):
+            self.assertEqual(bucket.consume(buckets), (True, 0.0))
+            self.assertEqual(bucket.consume(buckets), (True, 0.0))
+            self.assertEqual(bucket.consume(buckets), (False, 1.0))
+        with mock.patch("api.throttling.time.monotonic", return_value=101):
+            self.assertEqual(bucket.consume(buckets), (True, 0.0))
+
+    def test_rejection_doesnt_drain_other_buckets(self):
+        bucket = MemoryTokenBucket()
+        bucket.consume([("empty", 1.0, 1)])
+
+        allowed, _ = bucket.consume([("full", 1.0, 1), ("empty", 1.0, 1)])
+        self.assertFalse(allowed)
+        allowed, _ = bucket.consume([("full", 1.0, 1)])
+        self.assertTrue(allowed)
+
+    def test_redis_buckets(self):
+        client = redis.from_url(settings.RATE_LIMIT_URL)
+        try:
+            client.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest("redis server is unavailable")
+        key = f"throttle:test:{uuid.uuid4()}"
+        other = f"throttle:test:{uuid.uuid4()}"
+        self.addCleanup(client.delete, key, other)
+        bucket = RedisTokenBucket(settings.RATE_LIMIT_URL)
+
+        self.assertEqual(bucket.consume([(key, 0.5, 2)]), (True, 0.0))
+        self.assertEqual(bucket.consume([(key, 0.5, 2)]), (True, 0.0))
+        allowed, wait = bucket.consume([(key, 0.5, 2), (other, 0.5, 2)])
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 2, delta=0.1)
+        self.assertFalse(client.exists(other))
+        self.assertLessEqual(client.ttl(key), 4)
+
+
+class QueryAccountingTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        route_stats.clear()
+
+    def test_queries_sent_in_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.login()
+
+        self.assertRegex(
+            response.headers["Server-Timing"],
+            rf'^db;dur=[\d.]+;desc="{len(queries)} quer(y|ies)", '
+            r"app;dur=[\d.]+$",
+        )
+
+    def test_queries_aggregated_per_route(self):
+        self.login()
+        self.login()
+        self.client.post(
+            reverse_lazy("api:refresh"),
+            {"refresh_token": str(uuid.uuid4())},
+            format="json",
+        )
+
+        stats = route_stats.snapshot()
+        self.assertEqual(stats.keys(), {"api:login", "api:refresh"})
+        self.assertEqual(stats["api:login"]["requests"], 2)
+        # user is read with its password hash on every login
+        self.assertEqual(stats["api:login"]["queries"], 4)
+        self.assertEqual(stats["api:login"]["max_queries"], 2)
+
+    @override_settings(QUERY_BUDGETS={"api:login": 1})
+    def test_exceeded_budget_fails_in_strict_mode(self):
+        with self.assertRaisesMessage(
+            QueryBudgetExceeded, "POST api:login ran 2 queries, budget is 1"
+        ):
+            self.login()
+
+    @override_settings(
+        QUERY_BUDGETS={"api:login": 1}, QUERY_BUDGET_STRICT=False
+    )
+    def test_exceeded_budget_logged(self):
+        with self.assertLogs("api.middleware", "WARNING") as logs:
+            response = self.login()
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertIn("ran 2 queries", logs.output[0])
+
+    async def test_queries_of_async_views_counted(self):
+        async def view(request):
+            await sync_to_async(get_user_model().objects.count)()
+            await get_user_model().objects.acount()
+            return HttpResponse()
+
+        response = await QueryCountMiddleware(view)(
+            AsyncRequestFactory().get("/")
+        )
+        self.assertIn('desc="2 queries"', response.headers["Server-Timing"])
+
+
+class MetricsTests(UserTestCase):
+    def sample(self, name: str, **labels) -> float:
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_metrics_served_in_text_format(self):
+        self.login()
+
+        response = self.client.get(reverse_lazy("metrics"))
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        content = response.content.decode()
+        self.assertIn(
+            'api_request_duration_seconds_count{method="POST",'
+            'route="api:login",status="200"}',
+            content,
+        )
+        self.assertIn("api_refresh_tokens_live 1.0", content)
+
+    def test_request_duration_observed_for_api_routes_only(self):
+        before = self.sample(
+            "api_request_duration_seconds_count",
+            route="api:login",
+            method="POST",
+            status="200",
+        )
+
+        self.login()
+        self.client.get(reverse_lazy("metrics"))
+
+        self.assertEqual(
+            self.sample(
+                "api_request_duration_seconds_count",
+                route="api:login",
+                method="POST",
+                status="200",
+            ),
+            before + 1,
+        )
+        self.assertIsNone(
+            REGISTRY.get_sample_value(
+                "api_request_duration_seconds_count",
+                {"route": "metrics", "method": "GET", "status": "200"},
+            )
+        )
+
+    def test_tokens_issued_and_rotated_counted(self):
+        access = self.sample("api_tokens_issued_total", type="access")
+        refresh = self.sample("api_tokens_issued_total", type="refresh")
+        rotated = self.sample("api_refresh_tokens_rotated_total")
+
+        token = self.login().data["refresh_token"]
+        # valid refresh token is returned again
+        self.login()
+        self.client.post(
+            reverse_lazy("api:refresh"),
+            {"refresh_token": str(token)},
+            format="json",
+        )
+
+        self.assertEqual(
+            self.sample("api_tokens_issued_total", type="access"), access + 3
+        )
+        self.assertEqual(
+            self.sample("api_tokens_issued_total", type="refresh"), refresh + 1
+        )
+        self.assertEqual(
+            self.sample("api_refresh_tokens_rotated_total"), rotated + 1
+        )
+
+    def test_authentication_failures_counted_by_reason(self):
+        before = self.sample(
+            "api_authentication_failures_total", reason="Invalid token"
+        )
+
+        response = self.client.get(
+            reverse_lazy("api:account_options"),
+            HTTP_AUTHORIZATION="Bearer not-a-token",
+        )
+
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        self.assertEqual(
+            self.sample(
+                "api_authentication_failures_total", reason="Invalid token"
+            ),
+            before + 1,
+        )
+
+    def test_access_token_cache_use_counted(self):
+        def lookups(result: str) -> float:
+            return self.sample(
+                "api_access_token_cache_lookups_total", result=result
+            )
+
+        hits, misses = lookups("hit"), lookups("miss")
+        evictions = self.sample("api_access_token_cache_evictions_total")
+        token = RefreshToken.create_access_token(self.user)
+
+        self.authenticate(token)
+        self.authenticate(token)
+        full = TokenCache(maxsize=1)
+        for cached in ("first", "second"):
+            full.set(cached, {"exp": time.time() + 60}, self.user)
+
+        self.assertEqual(lookups("hit"), hits + 1)
+        self.assertEqual(lookups("miss"), misses + 1)
+        self.assertEqual(
+            self.sample("api_access_token_cache_evictions_total"),
+            evictions + 1,
+        )
+
+    def test_password_hash_duration_observed(self):
+        before = self.sample(
+            "api_password_hash_duration_seconds_count", operation="check"
+        )
+
+        self.login()
+
+        self.assertEqual(
+            self.sample(
+                "api_password_hash_duration_seconds_count", operation="check"
+            ),
+            before + 1,
+        )
+
+    def test_live_refresh_tokens_counted_at_scrape_time(self):
+        other = get_user_model().objects.create(
+            username="other", email="other@example.com", password="password"
+        )
+        RefreshToken.issue(self.user)
+        expire_refresh_token(RefreshToken.issue(other).pk)
+
+        self.assertEqual(self.sample("api_refresh_tokens_live"), 1)
+        self.assertEqual(self.sample("api_refresh_tokens_stored"), 2)
+
+    def test_refresh_token_counts_cached_between_scrapes(self):
+        other = get_user_model().objects.create(
+            username="other", email="other@example.com", password="password"
+        )
+        RefreshToken.issue(self.user)
+        self.assertEqual(self.sample("api_refresh_tokens_stored"), 1)
+        RefreshToken.issue(other)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.sample("api_refresh_tokens_stored"), 1)
+
+        cache.clear()
+        self.assertEqual(self.sample("api_refresh_tokens_stored"), 2)
+
+    def test_pool_stats_recorded_after_request(self):
+        pool = mock.Mock()
+        pool.pop_stats.return_value = {
+            "pool_max": 4,
+            "pool_size": 2,
+            "pool_available": 1,
+            "requests_waiting": 0,
+            "requests_num": 3,
+            "requests_queued": 1,
+            "requests_wait_ms": 250,
+        }
+        requests = self.sample("api_db_pool_requests_total", alias="default")
+        waited = self.sample(
+            "api_db_pool_wait_seconds_total", alias="default"
+        )
+
+        with mock.patch.object(
+            type(connections["default"]),
+            "pool",
+            new_callable=mock.PropertyMock,
+            create=True,
+            return_value=pool,
+        ):
+            self.client.get(reverse_lazy("metrics"))
+
+        self.assertEqual(self.sample("api_db_pool_size", alias="default"), 2)
+        self.assertEqual(
+            self.sample("api_db_pool_available", alias="default"), 1
+        )
+        self.assertEqual(
+            self.sample("api_db_pool_requests_total", alias="default"),
+            requests + 3,
+        )
+        self.assertEqual(
+            self.sample("api_db_pool_wait_seconds_total", alias="default"),
+            waited + 0.25,
+        )
+
+    def test_counters_aggregated_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for _ in range(2):
+                subprocess.run(
+                    [
+                        sys.executable,
+                        "-c",
+                        "from api import metrics; "
+                        "metrics.TOKENS_ISSUED.labels(type='access').inc()",
+                    ],
+                    cwd=settings.BASE_DIR,
+                    env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": directory},
+                    check=True,
+                )
+            with mock.patch.dict(
+                os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}
+            ):
+                registry = metrics.get_registry()
+
+            self.assertEqual(
+                registry.get_sample_value(
+                    "api_tokens_issued_total", {"type": "access"}
+                ),
+                2,
+            )
+            self.assertEqual(
+                registry.get_sample_value("api_refresh_tokens_live"), 0
+            )
+
+
+@override_settings(
+    REFRESH_TOKEN_STATELESS=True,
+    REFRESH_TOKEN_REVOCATION_URL="redis://127.0.0.1:6379/15",
+)
+class StatelessRefreshTokenTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # the mirror is loaded by tests, not by the listener
+        patcher = mock.patch.multiple(
+            revocations, _start_listener=lambda: None, _bloom=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        revocations.client().delete(REVOKED_KEY)
+
+    def refresh(self, token: str):
+        return self.client.post(
+            reverse_lazy("api:refresh"),
+            {"refresh_token": token},
+            format="json",
+        )
+
+    def logout(self, token: str):
+        return self.client.post(
+            reverse_lazy("api:logout"),
+            {"refresh_token": token},
+            format="json",
+        )
+
+    def test_refresh_needs_no_database(self):
+        tokens = self.login().data
+        revocations.load()
+
+        with self.assertNumQueries(0):
+            response = self.refresh(tokens["refresh_token"])
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertFalse(RefreshToken.objects.exists())
+        payload = jwt.decode(
+            response.data["access_token"],
+            settings.SECRET_KEY,
+            algorithms=["HS256"],
+        )
+        self.assertEqual(payload["uid"], self.user.pk)
+
+    def test_reused_token_revokes_its_family(self):
+        first = self.login().data["refresh_token"]
+        second = self.refresh(first).data["refresh_token"]
+        other_family = self.login().data["refresh_token"]
+
+        response = self.refresh(first)
+
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertEqual(
+            self.refresh(second).status_code, HTTPStatus.UNAUTHORIZED
+        )
+        self.assertEqual(
+            self.refresh(other_family).status_code, HTTPStatus.OK
+        )
+
+    def test_logout_revokes_family(self):
+        token = self.login().data["refresh_token"]
+        rotated = self.refresh(token).data["refresh_token"]
+
+        self.assertEqual(self.logout(rotated).status_code, HTTPStatus.OK)
+        self.assertEqual(
+            self.refresh(rotated).status_code, HTTPStatus.UNAUTHORIZED
+        )
+        self.assertEqual(
+            self.logout(rotated).status_code, HTTPStatus.UNAUTHORIZED
+        )
+
+    def test_expired_token_rejected(self):
+        token = self.login().data["refresh_token"]
+        lifetime = config.REFRESH_TOKEN_LIFETIME
+        self.addCleanup(setattr, config, "REFRESH_TOKEN_LIFETIME", lifetime)
+        config.REFRESH_TOKEN_LIFETIME = 0
+
+        response = self.refresh(token)
+
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertEqual(response.data["error"], "Refresh token expired")
+
+    def test_refresh_token_not_accepted_as_access_token(self):
+        token = self.login().data["refresh_token"]
+
+        response = self.client.get(
+            reverse_lazy("api:account_options"),
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    def test_unrevoked_ids_checked_in_memory(self):
+        revocations.add("jti:revoked", time.time() + 60)
+        revocations.load()
+
+        with mock.patch.object(
+            revocations, "client", wraps=revocations.client
+        ) as client:
+            self.assertNotIn("jti:unknown", revocations)
+            client.assert_not_called()
+            self.assertIn("jti:revoked", revocations)
+
+    def test_expired_revocations_dropped(self):
+        revocations.add("jti:expired", time.time() - 1)
+
+        self.assertNotIn("jti:expired", revocations)
+        revocations.add("jti:other", time.time() + 60)
+        self.assertIsNone(
+            revocations.client().zscore(REVOKED_KEY, "jti:expired")
+        )
+
+    @override_settings(REFRESH_TOKEN_REVOCATION_URL="redis://127.0.0.1:1/0")
+    def test_unavailable_revocation_set(self):
+        token = self.login().data["refresh_token"]
+
+        with self.assertLogs("api.stateless", "WARNING"):
+            response = self.refresh(token)
+
+        self.assertEqual(
+            response.status_code, HTTPStatus.SERVICE_UNAVAILABLE
+        )
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+    async def test_async_views(self):
+        factory = AsyncRequestFactory()
+        response = await async_views.login_view(
+            factory.post(
+                "/api/login/",
+                {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+                content_type="application/json",
+            )
+        )
+        token = json.loads(response.content)["refresh_token"]
+
+        response = await async_views.refresh_view(
+            factory.post(
+                "/api/refresh/",
+                {"refresh_token": token},
+                content_type="application/json",
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        token = json.loads(response.content)["refresh_token"]
+        response = await async_views.logout_view(
+            factory.post(
+                "/api/logout/",
+                {"refresh_token": token},
+                content_type="application/json",
+            )
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"in:{i}")
+
+        self.assertTrue(all(f"in:{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"out:{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class SigningKeysTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        keys_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(keys_dir.cleanup)
+        self.keys_dir = keys_dir.name
+
+    def generate_key(self, algorithm: str = "EdDSA") -> str:
+        out = io.StringIO()
+        call_command(
+            "generate_signing_key",
+            algorithm=algorithm,
+            keys_dir=self.keys_dir,
+            stdout=out,
+        )
+        return out.getvalue().strip()
+
+    def signing_with(self, kid):
+        return override_settings(
+            ACCESS_TOKEN_KEYS_DIR=self.keys_dir,
+            ACCESS_TOKEN_SIGNING_KID=kid,
+        )
+
+    def me(self, token: str):
+        return self.client.get(
+            reverse_lazy("api:account_options"),
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+
+    @parameterized.expand([("EdDSA",), ("RS256",)])
+    def test_tokens_verified_with_published_keys(self, algorithm):
+        kid = self.generate_key(algorithm)
+        with self.signing_with(kid):
+            token = RefreshToken.create_access_token(self.user)
+            jwks = self.client.get(reverse_lazy("jwks")).json()
+
+            self.assertEqual(self.me(token).status_code, HTTPStatus.OK)
+
+        self.assertEqual(jwt.get_unverified_header(token)["kid"], kid)
+        # as done by downstream services
+        key = jwt.PyJWKSet.from_dict(jwks)[kid]
+        self.assertEqual(key.algorithm_name, algorithm)
+        self.assertEqual(jwt.decode(token, key)["uid"], self.user.pk)
+
+    def test_jwks_cached_and_revalidated(self):
+        self.generate_key()
+        with self.signing_with(None), override_settings(JWKS_MAX_AGE=600):
+            response = self.client.get(reverse_lazy("jwks"))
+            etag = response.headers["ETag"]
+            revalidated = self.client.get(
+                reverse_lazy("jwks"), HTTP_IF_NONE_MATCH=etag
+            )
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(len(response.json()["keys"]), 1)
+        self.assertEqual(
+            response.headers["Cache-Control"], "public, max-age=600"
+        )
+        self.assertEqual(revalidated.status_code, HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(revalidated.headers["ETag"], etag)
+        self.assertEqual(
+            revalidated.headers["Cache-Control"], "public, max-age=600"
+        )
+
+    def test_secret_key_tokens_rejected_with_signing_key(self):
+        token = RefreshToken.create_access_token(self.user)
+        kid = self.generate_key()
+
+        with self.signing_with(kid):
+            response = self.me(token)
+
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        self.assertEqual(response.data["detail"], "Invalid token")
+
+    def test_retired_key_still_verifies(self):
+        old_kid = self.generate_key()
+        with self.signing_with(old_kid):
+            token = RefreshToken.create_access_token(self.user)
+        new_kid = self.generate_key()
+        # only public part of the retired key is kept
+        path = os.path.join(self.keys_dir, f"{old_kid}.pem")
+        with self.signing_with(old_kid):
+            public = key_ring().verifiers[old_kid].key.public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+        with open(path, "wb") as file:
+            file.write(public)
+
+        with self.signing_with(new_kid):
+            self.assertEqual(self.me(token).status_code, HTTPStatus.OK)
+            new_token = RefreshToken.create_access_token(self.user)
+        self.assertEqual(jwt.get_unverified_header(new_token)["kid"], new_kid)
+
+    def test_unknown_key_rejected(self):
+        kid = self.generate_key()
+        with self.signing_with(kid):
+            token = RefreshToken.create_access_token(self.user)
+        os.remove(os.path.join(self.keys_dir, f"{kid}.pem"))
+
+        with self.signing_with(self.generate_key()):
+            response = self.me(token)
+
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    def test_algorithm_not_taken_from_token_header(self):
+        kid = self.generate_key()
+        forged = jwt.encode(
+            {"sub": ADMIN_EMAIL, "exp": int(time.time()) + 60},
+            settings.SECRET_KEY,
+            algorithm="HS256",
+            headers={"kid": kid},
+        )
+
+        with self.signing_with(kid):
+            response = self.me(forged)
+
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+
+@override_settings(INTROSPECTION_SECRETS=["old-secret", "gateway-secret"])
+class IntrospectionTests(UserTestCase):
+    @classmethod
+    def setUpTestData(cls) -> None:
+        super().setUpTestData()
+        cls.other = get_user_model().objects.create(
+            username="other", email="other@example.com", password="password"
+        )
+
+    def introspect(self, secret: str = "gateway-secret", **tokens):
+        return self.client.post(
+            reverse_lazy("api:introspect"),
+            tokens,
+            format="json",
+            HTTP_AUTHORIZATION=f"Bearer {secret}",
+        )
+
+    def statuses(self, results):
+        return [(result["status"], result["sub"]) for result in results]
+
+    def test_batch_resolved_with_two_queries(self):
+        active = RefreshToken.create_access_token(self.user)
+        revoked = RefreshToken.create_access_token(self.other)
+        get_user_model().objects.filter(pk=self.other.pk).update(
+            token_version=F("token_version") + 1
+        )
+        lifetime = config.ACCESS_TOKEN_LIFETIME
+        self.addCleanup(setattr, config, "ACCESS_TOKEN_LIFETIME", lifetime)
+        config.ACCESS_TOKEN_LIFETIME = -1
+        expired = RefreshToken.create_access_token(self.user)
+        refresh = RefreshToken.issue(self.user)
+        expired_refresh = RefreshToken.issue(self.other)
+        expire_refresh_token(expired_refresh.pk)
+
+        with self.assertNumQueries(2):
+            response = self.introspect(
+                access_tokens=[active, revoked, expired, "garbage"],
+                refresh_tokens=[
+                    str(refresh.token),
+                    str(expired_refresh.token),
+                    str(uuid.uuid4()),
+                    "garbage",
+                ],
+            )
+
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(
+            self.statuses(response.data["access_tokens"]),
+            [
+                ("active", ADMIN_EMAIL),
+                ("revoked", "other@example.com"),
+                ("expired", None),
+                ("invalid", None),
+            ],
+        )
+        self.assertEqual(
+            self.statuses(response.data["refresh_tokens"]),
+            [
+                ("active", ADMIN_EMAIL),
+                ("expired", None),
+                ("revoked", None),
+                ("invalid", None),
+            ],
+        )
+        first = response.data["access_tokens"][0]
+        self.assertTrue(first["active"])
+        self.assertEqual(first["uid"], self.user.pk)
+        self.assertGreater(first["exp"], time.time())
+        self.assertGreater(
+            response.data["refresh_tokens"][0]["exp"], time.time()
+        )
+
+    @override_settings(INTROSPECTION_MAX_TOKENS=2)
+    def test_batch_size_limited(self):
+        response = self.introspect(
+            access_tokens=["a", "b"], refresh_tokens=["c"]
+        )
+
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_empty_batch(self):
+        with self.assertNumQueries(0):
+            response = self.introspect()
+
+        self.assertEqual(
+            response.data, {"access_tokens": [], "refresh_tokens": []}
+        )
+
+    def test_gateway_secret_required(self):
+        token = RefreshToken.create_access_token(self.user)
+        for secret in ("", "wrong-secret", token):
+            with self.assertNumQueries(0):
+                response = self.introspect(secret, access_tokens=[token])
+            self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        response = self.client.post(
+            reverse_lazy("api:introspect"), {}, format="json"
+        )
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        # secret being rotated out is still accepted
+        response = self.introspect("old-secret")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+        with override_settings(INTROSPECTION_SECRETS=[]):
+            response = self.introspect()
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    @override_settings(
+        REST_FRAMEWORK=throttle_rates(introspect_ip="2/min"),
+    )
+    def test_throttled(self):
+        for _ in range(2):
+            self.assertEqual(self.introspect().status_code, HTTPStatus.OK)
+        response = self.introspect()
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertIn("Retry-After", response.headers)
+
+    @override_settings(
+        REFRESH_TOKEN_STATELESS=True,
+        REFRESH_TOKEN_REVOCATION_URL="redis://127.0.0.1:6379/15",
+    )
+    def test_stateless_refresh_tokens(self):
+        patcher = mock.patch.multiple(
+            revocations, _start_listener=lambda: None, _bloom=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        revocations.client().delete(REVOKED_KEY)
+        token = stateless.issue(self.user.pk)
+        rotated = stateless.rotate(stateless.decode(token))
+
+        with self.assertNumQueries(1):
+            response = self.introspect(refresh_tokens=[token, rotated])
+
+        self.assertEqual(
+            self.statuses(response.data["refresh_tokens"]),
+            [("revoked", ADMIN_EMAIL), ("active", ADMIN_EMAIL)],
+        )
+
+
+class ConditionalRequestsTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.token = RefreshToken.create_access_token(self.user)
+
+    def get(self, **headers):
+        return self.client.get(
+            reverse_lazy("api:account_options"),
+            HTTP_AUTHORIZATION=f"Bearer {self.token}",
+            **headers,
+        )
+
+    def put(self, data: dict, **headers):
+        return self.client.put(
+            reverse_lazy("api:account_options"),
+            data,
+            format="json",
+            HTTP_AUTHORIZATION=f"Bearer {self.token}",
+            **headers,
+        )
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        etag = response["ETag"]
+        self.assertIn("no-cache", response["Cache-Control"])
+        self.assertIn("private", response["Cache-Control"])
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+        response = self.get(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    @override_settings(ACCESS_TOKEN_CLAIMS_AUTH=True)
+    def test_not_modified_without_user_row(self):
+        etag = self.get()["ETag"]
+        with self.assertNumQueries(0):
+            response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    def test_etag_follows_updates(self):
+        etag = self.get()["ETag"]
+
+        response = self.put({"username": "renamed"}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+        self.user.refresh_from_db()
+        self.token = RefreshToken.create_access_token(self.user)
+        new = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(new.status_code, HTTPStatus.OK)
+        self.assertEqual(new["ETag"], response["ETag"])
+
+    def test_stale_if_match(self):
+        response = self.put({"username": "renamed"}, HTTP_IF_MATCH='"stale"')
+        self.assertEqual(response.status_code, HTTPStatus.PRECONDITION_FAILED)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.username, ADMIN_USERNAME)
+
+    def test_format_in_etag(self):
+        data = user_data(self.user)
+        self.assertEqual(self.get()["ETag"], user_etag(data, "json"))
+        # browsable API renders the same data differently
+        self.assertNotEqual(user_etag(data, "json"), user_etag(data, "api"))
+
+
+class JSONRenderingTests(UserTestCase):
+    data = {
+        "refresh_token": uuid.uuid4(),
+        "at": datetime.datetime(
+            2024, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc
+        ),
+        "price": decimal.Decimal("1.50"),
+        "detail": gettext_lazy("Invalid token"),
+        "name": "Łukasz \u2028",
+        "ids": (1, 2),
+        3: None,
+    }
+
+    def test_same_output_as_drf(self):
+        expected = DRFJSONRenderer().render(self.data)
+        self.assertEqual(renderers.JSONRenderer().render(self.data), expected)
+        with mock.patch.object(renderers, "orjson", None):
+            self.assertEqual(
+                renderers.JSONRenderer().render(self.data), expected
+            )
+            self.assertEqual(
+                json.loads(renderers.dumps(self.data)), json.loads(expected)
+            )
+
+    def test_indent_requested(self):
+        rendered = renderers.JSONRenderer().render(
+            {"id": 1}, "application/json; indent=2"
+        )
+        self.assertEqual(rendered, b'{\n  "id": 1\n}')
+
+    def test_refresh_token_rendered(self):
+        response = self.login()
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        refresh_token = json.loads(response.content)["refresh_token"]
+        self.assertEqual(
+            str(RefreshToken.objects.get(user=self.user).token), refresh_token
+        )
+
+    def test_parse_error(self):
+        response = self.client.post(
+            reverse_lazy("api:login"),
+            b'{"email": ',
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertIn("JSON parse error", response.data["detail"])
+
+    def test_browsable_api_disabled(self):
+        response = self.client.get(
+            reverse_lazy("api:account_options"), HTTP_ACCEPT="text/html"
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_ACCEPTABLE)
+
+
+class LeanMiddlewareTests(CacheIsolatedTestCase):
+    def assertSiteMiddlewareSkipped(self, response):
+        self.assertNotIn("X-Frame-Options", response.headers)
+        self.assertNotIn("Vary", response.headers)
+        self.assertNotIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        self.assertFalse(hasattr(response.wsgi_request, "session"))
+
+    def test_api_skips_site_middleware(self):
+        response = self.client.post(
+            reverse_lazy("api:login"),
+            {"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD},
+            format="json",
+        )
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertSiteMiddlewareSkipped(response)
+        self.assertSiteMiddlewareSkipped(
+            self.client.get(reverse_lazy("jwks"))
+        )
+
+    def test_lean_paths_without_slash_matched_exactly(self):
+        self.assertSiteMiddlewareSkipped(
+            self.client.get(reverse_lazy("metrics"))
+        )
+
+        response = self.client.get("/metrics-dashboard/")
+        self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+        self.assertEqual(response["X-Frame-Options"], "DENY")
+
+    def test_admin_runs_site_middleware(self):
+        response = self.client.get("/admin/login/")
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(response["X-Frame-Options"], "DENY")
+        self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+        self.assertTrue(hasattr(response.wsgi_request, "session"))
+
+        client = APIClient(enforce_csrf_checks=True)
+        response = client.post(
+            "/admin/login/", {"username": "admin", "password": "admin"}
+        )
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    async def test_async_handler(self):
+        client = AsyncClient()
+        response = await client.get(reverse_lazy("api:account_options"))
+        self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+        self.assertNotIn("X-Frame-Options", response.headers)
+
+        response = await client.get("/admin/login/")
+        self.assertEqual(response["X-Frame-Options"], "DENY")
+
+
+class WarmUpTests(CacheIsolatedTestCase):
+    def test_warm_up_runs_no_queries(self):
+        with mock.patch.object(
+            warmup.connections, "close_all"
+        ) as close_all, self.assertNumQueries(0), self.assertLogs(
+            "api.warmup", "INFO"
+        ) as logs:
+            warmup.warm_up()
+        # connections must not be inherited by forked workers
+        close_all.assert_called_once()
+        self.assertRegex(logs.output[0], r"warmed up, \d+ routes resolved")
+
+    def test_url_names(self):
+        names = set(warmup.url_names(get_resolver()))
+        self.assertIn("api:login", names)
+        self.assertIn("admin:index", names)
+        self.assertIn("jwks", names)
+
+    def test_connect_databases(self):
+        # test transaction would be broken by closing the connection;
+        # replicas, when configured, are left alone
+        with mock.patch.multiple(
+            connection,
+            ensure_connection=mock.DEFAULT,
+            close_if_unusable_or_obsolete=mock.DEFAULT,
+        ) as mocks, mock.patch.object(
+            warmup.connections, "all", return_value=[connection]
+        ):
+            warmup.connect_databases()
+        mocks["ensure_connection"].assert_called_once()
+        mocks["close_if_unusable_or_obsolete"].assert_called_once()
+
+
+class ServerProfileTests(SimpleTestCase):
+    def load(self, **env) -> dict:
+        # settings load GUNICORN_ variables of .env.example as well
+        environ = {
+            name: value
+            for name, value in os.environ.items()
+            if not name.startswith("GUNICORN_")
+        }
+        environ.update(GUNICORN_PRELOAD="False", **env)
+        with mock.patch.dict(os.environ, environ, clear=True):
+            return runpy.run_path(
+                str(settings.BASE_DIR / "gunicorn.conf.py")
+            )
+
+    def test_defaults(self):
+        profile = self.load(DJANGO_API_ASYNC_VIEWS="False")
+        self.assertEqual(profile["worker_class"], "sync")
+        self.assertEqual(profile["wsgi_app"], "api_service.wsgi")
+        self.assertEqual(profile["workers"], 2 * profile["CPUS"] + 1)
+        self.assertEqual(profile["max_requests_jitter"], 500)
+
+    def test_threads_and_async_views(self):
+        profile = self.load(
+            DJANGO_API_ASYNC_VIEWS="False", GUNICORN_THREADS="4"
+        )
+        self.assertEqual(profile["worker_class"], "gthread")
+        self.assertEqual(profile["workers"], profile["CPUS"] + 1)
+
+        profile = self.load(DJANGO_API_ASYNC_VIEWS="True")
+        self.assertEqual(
+            profile["worker_class"], "uvicorn_worker.UvicornWorker"
+        )
+        self.assertEqual(
+            profile["wsgi_app"], "api_service.asgi:application"
+        )
+        self.assertEqual(profile["workers"], profile["CPUS"])
+
+    def test_overrides(self):
+        profile = self.load(
+            GUNICORN_WORKER_CLASS="gthread",
+            GUNICORN_WORKERS="7",
+            GUNICORN_MAX_REQUESTS="0",
+        )
+        self.assertEqual(profile["worker_class"], "gthread")
+        self.assertEqual(profile["workers"], 7)
+        self.assertEqual(profile["max_requests_jitter"], 0)
+
+    def test_cgroup_quota(self):
+        cpu_count = self.load()["cpu_count"]
+        with tempfile.TemporaryDirectory() as cgroup, mock.patch.object(
+            os, "sched_getaffinity", return_value={0, 1, 2, 3}
+        ):
+            self.assertEqual(cpu_count(cgroup), 4)
+            cpu_max = Path(cgroup) / "cpu.max"
+            cpu_max.write_text("max 100000\n")
+            self.assertEqual(cpu_count(cgroup), 4)
+            cpu_max.write_text("150000 100000\n")
+            self.assertEqual(cpu_count(cgroup), 2)
+
+    @skipUnless(hasattr(socket, "TCP_INFO"), "tcp_info is Linux only")
+    def test_listen_backlog(self):
+        listen_backlog = self.load()["listen_backlog"]
+        with socket.socket() as server:
+            server.bind(("127.0.0.1", 0))
+            server.listen(8)
+            self.assertEqual(listen_backlog(server), (0, 8))
+            clients = [
+                socket.create_connection(server.getsockname())
+                for _ in range(2)
+            ]
+            self.assertEqual(listen_backlog(server), (2, 8))
+            for client in clients:
+                client.close()
+
+    def test_worker_over_memory_limit_replaced(self):
+        profile = self.load(GUNICORN_MAX_WORKER_MEMORY="1")
+        worker = mock.Mock(pid=12345, sockets=[])
+        with mock.patch.object(os, "kill") as kill:
+            profile["report_stats"](worker)
+        worker.log.info.assert_called_once()
+        kill.assert_called_once_with(12345, signal.SIGTERM)
+
+
+class VerifyTests(UserTestCase):
+    def verify(self, token: str = None, method: str = "get"):
+        headers = {}
+        if token is not None:
+            headers["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+        return getattr(self.client, method)(
+            reverse_lazy("api:verify"), **headers
+        )
+
+    def test_valid_token(self):
+        token = RefreshToken.create_access_token(self.user)
+        for method in ("get", "post", "head"):
+            response = self.verify(token, method)
+            self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+            self.assertEqual(response.content, b"")
+            self.assertEqual(response["X-User-Id"], str(self.user.id))
+            self.assertEqual(response["X-User-Email"], ADMIN_EMAIL)
+            self.assertEqual(response["Cache-Control"], "max-age=10")
+
+    @override_settings(ACCESS_TOKEN_CLAIMS_AUTH=True)
+    def test_cached_token_needs_no_queries(self):
+        token = RefreshToken.create_access_token(self.user)
+        self.verify(token)
+        with self.assertNumQueries(0):
+            response = self.verify(token)
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+
+    def test_cached_no_longer_than_token_is_valid(self):
+        lifetime = config.ACCESS_TOKEN_LIFETIME
+        self.addCleanup(setattr, config, "ACCESS_TOKEN_LIFETIME", lifetime)
+        config.ACCESS_TOKEN_LIFETIME = 3
+        response = self.verify(RefreshToken.create_access_token(self.user))
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertIn(response["Cache-Control"], ["max-age=3", "max-age=2"])
+
+    def test_invalid_token(self):
+        for response in (self.verify(), self.verify("garbage")):
+            self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+            self.assertEqual(response["WWW-Authenticate"], "Bearer")
+            self.assertNotIn("X-User-Id", response.headers)
+
+        token = RefreshToken.create_access_token(self.user)
+        self.user.set_password("another password")
+        self.user.save()
+        response = self.verify(token)
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_malformed_header(self):
+        token = RefreshToken.create_access_token(self.user)
+        for header in ("Bearer", f"Bearer {token} extra", f"Basic {token}"):
+            response = self.client.get(
+                reverse_lazy("api:verify"), HTTP_AUTHORIZATION=header
+            )
+            self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+            response = async_to_sync(async_views.verify_view)(
+                AsyncRequestFactory().get(
+                    "/api/verify/", headers={"Authorization": header}
+                )
+            )
+            self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+            response = self.client.get(
+                reverse_lazy("api:account_options"),
+                HTTP_AUTHORIZATION=header,
+            )
+            self.assertEqual(response.status_code, HTTPStatus.FORBIDDEN)
+
+    async def test_async_view(self):
+        token = await sync_to_async(RefreshToken.create_access_token)(
+            self.user
+        )
+        factory = AsyncRequestFactory()
+        auth = {"Authorization": f"Bearer {token}"}
+        response = await async_views.verify_view(
+            factory.get("/api/verify/", headers=auth)
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NO_CONTENT)
+        self.assertEqual(response["X-User-Email"], ADMIN_EMAIL)
+
+        response = await async_views.verify_view(factory.get("/api/verify/"))
+        self.assertEqual(response.status_code, HTTPStatus.UNAUTHORIZED)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, DATABASE_REPLICAS=["replica1", "replica2"]
+)
+class PrimaryReplicaRouterTests(SimpleTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.router = routers.PrimaryReplicaRouter()
+
+    def route(self, **state) -> routers.RequestRouting:
+        routing = routers.RequestRouting(**state)
+        token = routers.current_routing.set(routing)
+        self.addCleanup(routers.current_routing.reset, token)
+        return routing
+
+    def test_reads_outside_requests_use_primary(self):
+        self.assertEqual(
+            self.router.db_for_read(get_user_model()), "default"
+        )
+
+    def test_safe_requests_read_from_replicas(self):
+        self.route()
+        self.assertIn(
+            self.router.db_for_read(RefreshToken), ["replica1", "replica2"]
+        )
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.router.db_for_read(RefreshToken), "default")
+
+    def test_unsafe_requests_read_from_primary(self):
+        self.route(primary=True)
+        self.assertEqual(self.router.db_for_read(RefreshToken), "default")
+
+    def test_reads_after_write_use_primary(self):
+        routing = self.route()
+        user = get_user_model()(email=ADMIN_EMAIL)
+        self.assertEqual(
+            self.router.db_for_write(get_user_model(), instance=user),
+            "default",
+        )
+        self.assertTrue(routing.wrote)
+        self.assertEqual(routing.written_users, [user])
+        self.assertEqual(
+            self.router.db_for_read(get_user_model()), "default"
+        )
+
+    def test_sticky_user_reads_from_primary(self):
+        routers.stick_to_primary({1})
+        self.route()
+        routers.follow_user(1)
+        self.assertEqual(
+            self.router.db_for_read(get_user_model()), "default"
+        )
+
+        routing = self.route()
+        routers.follow_user(2)
+        with mock.patch.object(
+            routers.cache, "get", wraps=routers.cache.get
+        ) as cache_get:
+            for _ in range(3):
+                self.assertIn(
+                    self.router.db_for_read(get_user_model()),
+                    ["replica1", "replica2"],
+                )
+        # stickiness is looked up once per request
+        cache_get.assert_called_once_with(routers.sticky_key(2))
+        self.assertTrue(routing.checked)
+
+    def test_stickiness_unavailable(self):
+        self.route()
+        routers.follow_user(1)
+        with mock.patch.object(
+            routers.cache,
+            "get",
+            side_effect=redis.exceptions.ConnectionError,
+        ), self.assertLogs("api.routers", "WARNING"):
+            self.assertEqual(
+                self.router.db_for_read(get_user_model()), "default"
+            )
+
+    def test_migrations_only_on_primary(self):
+        self.assertTrue(self.router.allow_migrate("default", "api"))
+        self.assertFalse(self.router.allow_migrate("replica1", "api"))
+
+    def test_replica_reads(self):
+        @routers.replica_reads
+        def view(request):
+            return routers.current_routing.get().primary
+
+        @routers.replica_reads
+        async def async_view(request):
+            return routers.current_routing.get().primary
+
+        self.route(primary=True)
+        self.assertFalse(view(None))
+        self.route(primary=True)
+        self.assertFalse(async_to_sync(async_view)(None))
+
+
+@override_settings(
+    DATABASE_REPLICAS=["default"],
+    DATABASE_ROUTERS=["api.routers.PrimaryReplicaRouter"],
+)
+class DatabaseRoutingMiddlewareTests(UserTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.auth = {
+            "HTTP_AUTHORIZATION": "Bearer "
+            + RefreshToken.create_access_token(self.user)
+        }
+
+    def is_sticky(self, user) -> bool:
+        return cache.get(routers.sticky_key(user.pk)) is not None
+
+    def test_update_sticks_to_primary(self):
+        response = self.client.get(
+            reverse_lazy("api:account_options"), **self.auth
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertFalse(self.is_sticky(self.user))
+
+        response = self.client.put(
+            reverse_lazy("api:account_options"),
+            {"username": "renamed"},
+            format="json",
+            **self.auth,
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(self.is_sticky(self.user))
+        self.assertIsNone(routers.current_routing.get())
+
+    def test_registration_sticks_to_primary(self):
+        response = self.client.post(
+            reverse_lazy("api:registration"),
+            {"email": "new@example.com", "password": "Hahy3tuuz!"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        user = get_user_model().objects.get(email="new@example.com")
+        self.assertTrue(self.is_sticky(user))
+        self.assertFalse(self.is_sticky(self.user))
+
+    async def test_async_handler(self):
+        response = await AsyncClient().put(
+            reverse_lazy("api:account_options"),
+            {"username": "renamed"},
+            content_type="application/json",
+            headers={"Authorization": self.auth["HTTP_AUTHORIZATION"]},
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertTrue(await sync_to_async(self.is_sticky)(self.user))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_not_used_without_replicas(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            DatabaseRoutingMiddleware(lambda request: HttpResponse())
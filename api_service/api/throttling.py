@@ -0,0 +1,250 @@
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from api import metrics
+
+from django.conf import settings
+
+import redis
+from redis.exceptions import RedisError
+
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+# (key, refill rate in tokens per second, capacity)
+Bucket = Tuple[str, float, int]
+
+PERIODS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+# Checks all buckets and takes a token from each of them only if every
+# one has it, so a rejected request doesn't drain the other buckets.
+# Redis TIME is used as a clock shared by all workers and nodes.
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local capacity = tonumber(ARGV[2 * i])
+    local state = redis.call("HMGET", key, "tokens", "ts")
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local capacity = tonumber(ARGV[2 * i])
+    redis.call(
+        "HSET", key, "tokens", tostring(levels[i] - 1), "ts", tostring(now)
+    )
+    redis.call("EXPIRE", key, math.ceil(capacity / rate))
+end
+return {1, "0"}
+"""
+
+
+def parse_rate(rate: Optional[str]) -> Optional[Tuple[float, int]]:
+    """Turns DRF-style rate ("<number>/<period>") into
+    (tokens per second, capacity) pair; None disables the bucket"""
+    if rate is None:
+        return None
+    num, period = rate.split("/")
+    capacity = int(num)
+    return capacity / PERIODS[period[0]], capacity
+
+
+class MemoryTokenBucket:
+    """Token buckets kept in memory of the current process"""
+
+    max_keys = 10000
+
+    def __init__(self):
+        # key -> (tokens, last update, time the bucket is full again)
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self._lock = threading.Lock()
+
+    def consume(self, buckets: Sequence[Bucket]) -> Tuple[bool, float]:
+        """Takes a token from every bucket; returns whether request is
+        allowed and seconds to wait before retrying if it isn't"""
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            wait = 0.0
+            for key, rate, capacity in buckets:
+                tokens, ts, _ = self._buckets.get(key, (capacity, now, now))
+                tokens = min(capacity, tokens + (now - ts) * rate)
+                levels.append(tokens)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            if wait:
+                return False, wait
+            for (key, rate, capacity), tokens in zip(buckets, levels):
+                full_at = now + (capacity - tokens + 1) / rate
+                self._buckets[key] = (tokens - 1, now, full_at)
+            if len(self._buckets) > self.max_keys:
+                # full bucket is the same as a missing one
+                self._buckets = {
+                    key: bucket
+                    for key, bucket in self._buckets.items()
+                    if bucket[2] > now
+                }
+        return True, 0.0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisTokenBucket:
+    """Token buckets shared by all workers and checked with a single
+    script call"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._script = None
+
+    def _get_script(self):
+        if self._script is None:
+            client = redis.from_url(
+                self.url, socket_connect_timeout=0.5, socket_timeout=0.5
+            )
+            self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script
+
+    def consume(self, buckets: Sequence[Bucket]) -> Tuple[bool, float]:
+        args = []
+        for _, rate, capacity in buckets:
+            args.extend((rate, capacity))
+        allowed, wait = self._get_script()(
+            keys=[key for key, _, _ in buckets], args=args
+        )
+        return bool(allowed), float(wait)
+
+
+class RateLimiter:
+    """Picks token bucket storage (falling back to process memory while
+    redis is unavailable) and counts its decisions"""
+
+    def __init__(self):
+        self.counters: Counter = Counter()
+        self.memory = MemoryTokenBucket()
+        self._redis = None
+        self._lock = threading.Lock()
+
+    def storage(self):
+        if settings.RATE_LIMIT_BACKEND == "memory":
+            return self.memory
+        if self._redis is None or self._redis.url != settings.RATE_LIMIT_URL:
+            self._redis = RedisTokenBucket(settings.RATE_LIMIT_URL)
+        return self._redis
+
+    def consume(self, scope: str, buckets: List[Bucket]) -> Tuple[bool, float]:
+        if not buckets:
+            return True, 0.0
+        storage = self.storage()
+        try:
+            allowed, wait = storage.consume(buckets)
+        except RedisError:
+            logger.warning("rate limiter storage unavailable", exc_info=True)
+            self._count(scope, "fallback")
+            allowed, wait = self.memory.consume(buckets)
+        self._count(scope, "allowed" if allowed else "throttled")
+        return allowed, wait
+
+    def _count(self, scope: str, decision: str) -> None:
+        with self._lock:
+            self.counters[scope, decision] += 1
+        metrics.RATE_LIMIT_DECISIONS.labels(
+            scope=scope, decision=decision
+        ).inc()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns decision counters grouped by scope"""
+        with self._lock:
+            stats = {}
+            for (scope, decision), count in self.counters.items():
+                stats.setdefault(scope, {})[decision] = count
+            return stats
+
+    def clear(self) -> None:
+        self.memory.clear()
+        with self._lock:
+            self.counters.clear()
+
+
+rate_limiter = RateLimiter()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle checking a per-client-IP bucket and a bucket per value of
+    each of `fields` of request data at once.
+
+    Rate of a bucket is taken from DEFAULT_THROTTLE_RATES under
+    "<scope>_ip" and "<scope>_<field>" keys.
+    """
+
+    scope: str
+    fields: Sequence[str] = ()
+
+    def get_buckets(self, ident: str, data) -> List[Bucket]:
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        values = [("ip", ident)]
+        if isinstance(data, dict):
+            for field in self.fields:
+                value = data.get(field)
+                if isinstance(value, str) and value:
+                    values.append((field, value.strip().lower()))
+        buckets = []
+        for name, value in values:
+            rate = parse_rate(rates.get(f"{self.scope}_{name}"))
+            if rate is not None:
+                buckets.append(
+                    (f"throttle:{self.scope}:{name}:{value}", *rate)
+                )
+        return buckets
+
+    def check(self, ident: str, data) -> bool:
+        allowed, self._wait = rate_limiter.consume(
+            self.scope, self.get_buckets(ident, data)
+        )
+        return allowed
+
+    def allow_request(self, request, view):
+        return self.check(self.get_ident(request), request.data)
+
+    def wait(self):
+        return math.ceil(self._wait)
+
+
+class LoginThrottle(TokenBucketThrottle):
+    scope = "login"
+    fields = ("email",)
+
+
+class RefreshThrottle(TokenBucketThrottle):
+    scope = "refresh"
+
+
+class IntrospectThrottle(TokenBucketThrottle):
+    scope = "introspect"
+
+
+class RegisterThrottle(TokenBucketThrottle):
+    scope = "register"
+    fields = ("email",)
@@ -0,0 +1,95 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from api import metrics
+from api.models import CustomUser
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+
+class TokenCache:
+    """
+    Per-process LRU cache of already verified access tokens.
+
+    Entry is kept until the "exp" claim of its token is reached; when the
+    cache is full, the least recently used entry is evicted. Stored user
+    is a snapshot - every hit returns a copy of it, so views are free to
+    modify request.user without affecting other requests.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[float, dict, Any]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Tuple[dict, Any]]:
+        """Returns (payload, user) pair for a cached token or None"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                metrics.ACCESS_TOKEN_CACHE_LOOKUPS.labels(result="miss").inc()
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            metrics.ACCESS_TOKEN_CACHE_LOOKUPS.labels(result="hit").inc()
+        expires_at, payload, user = entry
+        return payload, copy.copy(user)
+
+    def set(self, token: str, payload: dict, user) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = float(payload["exp"])
+        with self._lock:
+            self._entries[token] = (expires_at, payload, copy.copy(user))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                metrics.ACCESS_TOKEN_CACHE_EVICTIONS.inc()
+
+    def invalidate_user(self, user_id) -> None:
+        with self._lock:
+            stale = [
+                token
+                for token, (_, _, user) in self._entries.items()
+                if user.pk == user_id
+            ]
+            for token in stale:
+                del self._entries[token]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+token_cache = TokenCache(settings.ACCESS_TOKEN_CACHE_SIZE)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_cached_user(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
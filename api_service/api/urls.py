@@ -1,5 +1,7 @@
+import api.async_views as async_views
 import api.views as views
 
+from django.conf import settings
 from django.urls import path
 
 
@@ -13,4 +15,22 @@ urlpatterns = [
     path(
         "me/", view=views.RetrieveUpdateUser.as_view(), name="account_options"
     ),
+    path("introspect/", view=views.introspect_view, name="introspect"),
+    path("verify/", view=views.verify_view, name="verify"),
 ]
+
+if settings.API_ASYNC_VIEWS:
+    urlpatterns = [
+        path(
+            "register/",
+            view=async_views.register_view,
+            name="registration",
+        ),
+        path("login/", view=async_views.login_view, name="login"),
+        path("refresh/", view=async_views.refresh_view, name="refresh"),
+        path("logout/", view=async_views.logout_view, name="logout"),
+        path("me/", view=async_views.me_view, name="account_options"),
+        # has no async counterpart, Django runs it in a thread
+        path("introspect/", view=views.introspect_view, name="introspect"),
+        path("verify/", view=async_views.verify_view, name="verify"),
+    ]
@@ -0,0 +1,187 @@
+import functools
+import logging
+from typing import List, Optional
+
+from api.models import CustomUser
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Password hash is never kept in the shared cache: users are cached as
+# values of the other fields and come back with the password deferred
+# (loaded from the database if it is accessed; saving such user writes
+# only the loaded fields)
+CACHED_FIELDS: List[str] = [
+    field.attname
+    for field in CustomUser._meta.concrete_fields
+    if field.attname != "password"
+]
+
+
+def id_key(pk) -> str:
+    return f"user:fields:{pk}"
+
+
+def email_key(email: str) -> str:
+    return f"user:email:{email}"
+
+
+def version_key(pk) -> str:
+    return f"user:version:{pk}"
+
+
+def _cache_get(key: str):
+    try:
+        return cache.get(key)
+    except RedisError:
+        logger.warning("user cache unavailable", exc_info=True)
+        return None
+
+
+async def _cache_aget(key: str):
+    try:
+        return await cache.aget(key)
+    except RedisError:
+        logger.warning("user cache unavailable", exc_info=True)
+        return None
+
+
+def _to_cache(user: CustomUser) -> list:
+    return [getattr(user, name) for name in CACHED_FIELDS]
+
+
+def _from_cache(values: Optional[list]) -> Optional[CustomUser]:
+    if values is None:
+        return None
+    return CustomUser.from_db(DEFAULT_DB_ALIAS, CACHED_FIELDS, values)
+
+
+def _entries(user: CustomUser) -> dict:
+    return {
+        id_key(user.pk): _to_cache(user),
+        email_key(user.email): user.pk,
+        version_key(user.pk): user.token_version,
+    }
+
+
+def cache_user(user: CustomUser) -> None:
+    """Stores user under its id; email key maps the address to the id"""
+    try:
+        cache.set_many(_entries(user), timeout=settings.USER_CACHE_TIMEOUT)
+    except RedisError:
+        logger.warning("user cache unavailable", exc_info=True)
+
+
+async def acache_user(user: CustomUser) -> None:
+    try:
+        await cache.aset_many(
+            _entries(user), timeout=settings.USER_CACHE_TIMEOUT
+        )
+    except RedisError:
+        logger.warning("user cache unavailable", exc_info=True)
+
+
+def invalidate_user(user: CustomUser) -> None:
+    try:
+        cache.delete_many(
+            [id_key(user.pk), email_key(user.email), version_key(user.pk)]
+        )
+    except RedisError:
+        logger.warning("user cache unavailable", exc_info=True)
+
+
+def get_user_by_id(pk) -> CustomUser:
+    """Same as CustomUser.objects.get(pk=pk), read through the cache"""
+    user = _from_cache(_cache_get(id_key(pk)))
+    if user is None:
+        user = CustomUser.objects.get(pk=pk)
+        cache_user(user)
+    return user
+
+
+async def aget_user_by_id(pk) -> CustomUser:
+    user = _from_cache(await _cache_aget(id_key(pk)))
+    if user is None:
+        user = await CustomUser.objects.aget(pk=pk)
+        await acache_user(user)
+    return user
+
+
+def get_user_by_email(email: str) -> CustomUser:
+    """Same as CustomUser.objects.get(email=email), read through the cache"""
+    pk = _cache_get(email_key(email))
+    user = None if pk is None else _from_cache(_cache_get(id_key(pk)))
+    # mapping is left behind under the old address when user changes email
+    if user is None or user.email != email:
+        user = CustomUser.objects.get(email=email)
+        cache_user(user)
+    return user
+
+
+async def aget_user_by_email(email: str) -> CustomUser:
+    pk = await _cache_aget(email_key(email))
+    user = None if pk is None else _from_cache(await _cache_aget(id_key(pk)))
+    if user is None or user.email != email:
+        user = await CustomUser.objects.aget(email=email)
+        await acache_user(user)
+    return user
+
+
+def get_token_version(pk) -> Optional[int]:
+    """Returns user's current token version or None if user doesn't exist"""
+    version = _cache_get(version_key(pk))
+    if version is None:
+        version = (
+            CustomUser.objects.filter(pk=pk)
+            .values_list("token_version", flat=True)
+            .first()
+        )
+        if version is not None:
+            try:
+                cache.set(
+                    version_key(pk),
+                    version,
+                    timeout=settings.USER_CACHE_TIMEOUT,
+                )
+            except RedisError:
+                logger.warning("user cache unavailable", exc_info=True)
+    return version
+
+
+async def aget_token_version(pk) -> Optional[int]:
+    version = await _cache_aget(version_key(pk))
+    if version is None:
+        version = (
+            await CustomUser.objects.filter(pk=pk)
+            .values_list("token_version", flat=True)
+            .afirst()
+        )
+        if version is not None:
+            try:
+                await cache.aset(
+                    version_key(pk),
+                    version,
+                    timeout=settings.USER_CACHE_TIMEOUT,
+                )
+            except RedisError:
+                logger.warning("user cache unavailable", exc_info=True)
+    return version
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_saved_user(sender, instance, using, **kwargs):
+    invalidate_user(instance)
+    if connections[using].in_atomic_block:
+        # lookups missing the cache until the transaction commits read
+        # the old row and would cache it again
+        transaction.on_commit(
+            functools.partial(invalidate_user, instance), using=using
+        )
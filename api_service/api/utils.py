@@ -1,40 +1,184 @@
 import uuid
-from typing import Optional, Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import api.models as models
+from api import stateless, user_cache
+from api.authentication import get_token_user
+from api.keys import key_ring
 
 from django.conf import settings
+from django.db.models import Q
+from django.utils.timezone import now as django_now
 
 import jwt
 
+from rest_framework.exceptions import AuthenticationFailed
+
 
 def user_from_refresh_token(
     token: Union[str, uuid.UUID],
 ) -> Optional[models.CustomUser]:
     """Returns user instance on valid token
     (meaning existing) or None instead"""
-    if type(token) is uuid.UUID:
-        token = models.RefreshToken.objects.filter(token=token).first()
-    else:
-        token = models.RefreshToken.get_token(token)
+    token = parse_uuid(token)
     if token is None:
         return None
-    return token.user
+    user_id = (
+        models.RefreshToken.objects.filter(token=token)
+        .values_list("user_id", flat=True)
+        .first()
+    )
+    if user_id is None:
+        return None
+    try:
+        return user_cache.get_user_by_id(user_id)
+    except models.CustomUser.DoesNotExist:
+        return None
 
 
 def user_from_access_token(token: str) -> Optional[models.CustomUser]:
     """Returns user instance on valid token or None instead"""
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-        user = models.CustomUser.objects.filter(email=payload["sub"]).first()
-        return user
-    except jwt.exceptions.InvalidTokenError:
+        payload = key_ring().verify(token)
+        return get_token_user(payload)
+    except (
+        jwt.exceptions.InvalidTokenError,
+        models.CustomUser.DoesNotExist,
+        AuthenticationFailed,
+    ):
         return None
 
 
-def is_valid_uuid(string: str) -> bool:
+ACTIVE = "active"
+EXPIRED = "expired"
+# logged out, rotated or revoked by user update
+REVOKED = "revoked"
+# malformed or not signed by us
+INVALID = "invalid"
+
+
+def introspect_tokens(
+    access_tokens: Sequence[str], refresh_tokens: Sequence[str]
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Batch version of user_from_access_token() and
+    user_from_refresh_token(); returns status of every token (in given
+    order) along with its subject for active and revoked ones.
+
+    Stored refresh tokens are fetched with a single token__in query and
+    users of all tokens with a single id__in/email__in query.
+    """
+    access = [_access_token_claims(token) for token in access_tokens]
+    if settings.REFRESH_TOKEN_STATELESS:
+        refresh = [_stateless_token_claims(token) for token in refresh_tokens]
+    else:
+        refresh = _stored_token_claims(refresh_tokens)
+
+    ids = {claims["uid"] for _, claims in access + refresh if "uid" in claims}
+    emails = {
+        claims["sub"]
+        for _, claims in access
+        if "uid" not in claims and "sub" in claims
+    }
+    users: Dict[object, dict] = {}
+    if ids or emails:
+        for user in models.CustomUser.objects.filter(
+            Q(id__in=ids) | Q(email__in=emails)
+        ).values("id", "email", "token_version"):
+            users[user["id"]] = users[user["email"]] = user
+
+    def result(status: str, claims: dict, user: Optional[dict]) -> dict:
+        if user is None and status == ACTIVE:
+            status = REVOKED
+        known = user is not None and status in (ACTIVE, REVOKED)
+        return {
+            "active": status == ACTIVE,
+            "status": status,
+            "sub": user["email"] if known else None,
+            "uid": user["id"] if known else None,
+            "exp": claims.get("exp"),
+        }
+
+    access_results = []
+    for status, claims in access:
+        user = users.get(claims.get("uid", claims.get("sub")))
+        if (
+            status == ACTIVE
+            and user is not None
+            and claims.get("ver", user["token_version"])
+            != user["token_version"]
+        ):
+            status = REVOKED
+        access_results.append(result(status, claims, user))
+    refresh_results = [
+        result(status, claims, users.get(claims.get("uid")))
+        for status, claims in refresh
+    ]
+    return access_results, refresh_results
+
+
+def _access_token_claims(token: str) -> Tuple[str, dict]:
+    try:
+        return ACTIVE, key_ring().verify(token)
+    except jwt.ExpiredSignatureError:
+        return EXPIRED, {}
+    except jwt.InvalidTokenError:
+        return INVALID, {}
+
+
+def _stateless_token_claims(token: str) -> Tuple[str, dict]:
     try:
-        uuid.UUID(string)
-        return True
-    except ValueError:
-        return False
+        claims = stateless.decode(token)
+    except jwt.ExpiredSignatureError:
+        return EXPIRED, {}
+    except jwt.InvalidTokenError:
+        return INVALID, {}
+    revoked = (
+        stateless.family_key(claims["fam"]) in stateless.revocations
+        or stateless.token_key(claims["jti"]) in stateless.revocations
+    )
+    return (REVOKED if revoked else ACTIVE), claims
+
+
+def _stored_token_claims(tokens: Sequence[str]) -> List[Tuple[str, dict]]:
+    parsed = [parse_uuid(token) for token in tokens]
+    now_time = django_now()
+    bound_field, bound = models.RefreshToken.validity_bound(now_time)
+    rows = {
+        row["token"]: row
+        for row in models.RefreshToken.objects.filter(
+            token__in=[token for token in parsed if token is not None]
+        ).values("token", "user_id", bound_field)
+    }
+    claims = []
+    for token in parsed:
+        row = rows.get(token)
+        if token is None:
+            claims.append((INVALID, {}))
+        elif row is None:
+            # deleted by logout or rotation (or never issued)
+            claims.append((REVOKED, {}))
+        else:
+            # see RefreshToken.expiry
+            expires_at = row[bound_field] + (now_time - bound)
+            status = ACTIVE if row[bound_field] > bound else EXPIRED
+            claims.append(
+                (
+                    status,
+                    {
+                        "uid": row["user_id"],
+                        "exp": int(expires_at.timestamp()),
+                    },
+                )
+            )
+    return claims
+
+
+def parse_uuid(value) -> Optional[uuid.UUID]:
+    """Returns uuid object for a valid uuid string or None instead"""
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return None
@@ -1,30 +1,140 @@
 import datetime
+import hashlib
+import time
 from http import HTTPStatus
+from typing import Tuple
 
 import api.serializers as serializers
-from api.authentication import AllowOptionsOrAuthenticated
-from api.models import RefreshToken
-from api.utils import is_valid_uuid, user_from_refresh_token
+from api import stateless, user_cache
+from api.authentication import (
+    AllowOptionsOrAuthenticated,
+    IsGateway,
+    JWTAuthentication,
+)
+from api.models import CustomUser, RefreshToken
+from api.routers import replica_reads
+from api.throttling import (
+    IntrospectThrottle,
+    LoginThrottle,
+    RefreshThrottle,
+    RegisterThrottle,
+)
+from api.utils import introspect_tokens, parse_uuid
 
 from constance.signals import config_updated
 
+from django.conf import settings
 from django.contrib.auth import authenticate, get_user_model
 from django.db.models import F
 from django.dispatch import receiver
-
-from rest_framework.decorators import api_view
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt
+
+import jwt
+
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+    throttle_classes,
+)
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.generics import CreateAPIView
 from rest_framework.views import APIView, Response
 
 
 @receiver(config_updated)
 def update_tokens(sender, key, old_value, new_value, **kwargs):
-    if "refresh" in key.lower():
+    # with lazy expiry new lifetime applies to existing tokens as is
+    if "refresh" in key.lower() and not settings.REFRESH_TOKEN_LAZY_EXPIRY:
         RefreshToken.objects.all().update(
             expires_at=F("created_at") + datetime.timedelta(seconds=new_value)
         )
 
 
+def update_user(user, data) -> Tuple[dict, HTTPStatus]:
+    """Partially updates user; returns response data and status"""
+    ser = serializers.UserSerializer(user, data=data, partial=True)
+    if ser.is_valid():
+        # access tokens carry user's data, so the ones issued before
+        # the update are no longer valid
+        user = ser.save(token_version=user.token_version + 1)
+        user_cache.cache_user(user)
+        return ser.data, HTTPStatus.OK
+    return ser.errors, HTTPStatus.BAD_REQUEST
+
+
+def user_data(user) -> dict:
+    """Representation of the user served by api/me/; fields are the ones
+    access token claims carry, so they need no user row"""
+    return {"id": user.id, "username": user.username, "email": user.email}
+
+
+def user_etag(data: dict, media_format: str = "json") -> str:
+    """Strong ETag of api/me/ representation, derived from its fields
+    (and format, as browsable API renders them differently)"""
+    fields = (data["id"], data["username"], data["email"], media_format)
+    digest = hashlib.blake2b(
+        ":".join(map(str, fields)).encode(), digest_size=16
+    )
+    return quote_etag(digest.hexdigest())
+
+
+def with_etag(response, etag: str):
+    response["ETag"] = etag
+    # per-user representation, revalidated by clients on every poll
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def issue_refresh_token(user) -> str:
+    if settings.REFRESH_TOKEN_STATELESS:
+        return stateless.issue(user.pk)
+    return str(RefreshToken.issue(user).token)
+
+
+def stateless_refresh(token) -> Tuple[dict, HTTPStatus]:
+    """Token refresh with REFRESH_TOKEN_STATELESS enabled;
+    returns response data and status"""
+    if not isinstance(token, str):
+        return {
+            "error": "invalid 'refresh_token' value "
+            "- valid refresh token must be provided"
+        }, HTTPStatus.BAD_REQUEST
+    try:
+        claims = stateless.decode(token)
+        refresh = stateless.rotate(claims)
+        user = user_cache.get_user_by_id(claims["uid"])
+    except jwt.ExpiredSignatureError:
+        return {"error": "Refresh token expired"}, HTTPStatus.UNAUTHORIZED
+    except (
+        jwt.InvalidTokenError,
+        stateless.TokenRevoked,
+        CustomUser.DoesNotExist,
+    ):
+        return {
+            "error": "refresh token doesn't exist"
+        }, HTTPStatus.UNAUTHORIZED
+    return {
+        "access_token": RefreshToken.create_access_token(user),
+        "refresh_token": refresh,
+    }, HTTPStatus.OK
+
+
+def stateless_logout(token: str) -> Tuple[dict, HTTPStatus]:
+    """Logout with REFRESH_TOKEN_STATELESS enabled;
+    returns response data and status"""
+    try:
+        logged_out = stateless.revoke(stateless.decode(token))
+    except jwt.InvalidTokenError:
+        logged_out = False
+    if not logged_out:
+        return {"error": "invalid token"}, HTTPStatus.UNAUTHORIZED
+    return {"success": "user logged out"}, HTTPStatus.OK
+
+
 class RegisterUser(CreateAPIView):
     """
     Handling user registration
@@ -38,6 +148,7 @@ class RegisterUser(CreateAPIView):
 
     queryset = get_user_model().objects.all()
     serializer_class = serializers.UserRegisterSerializer
+    throttle_classes = [RegisterThrottle]
 
 
 class RetrieveUpdateUser(APIView):
@@ -75,23 +186,27 @@ class RetrieveUpdateUser(APIView):
     permission_classes = [AllowOptionsOrAuthenticated]
 
     def get(self, request):
-        return Response(
-            data={
-                "id": request.user.id,
-                "username": request.user.username,
-                "email": request.user.email,
-            },
-            status=HTTPStatus.OK,
+        data = user_data(request.user)
+        etag = user_etag(data, request.accepted_renderer.format)
+        # not modified response is sent without rendering the data
+        response = get_conditional_response(request, etag=etag) or Response(
+            data=data, status=HTTPStatus.OK
         )
+        return with_etag(response, etag)
 
     def put(self, request):
-        ser = self.serializer_class(
-            request.user, data=request.data, partial=True
+        media_format = request.accepted_renderer.format
+        # If-Match header makes update fail with 412 if user has changed
+        precondition_failed = get_conditional_response(
+            request, etag=user_etag(user_data(request.user), media_format)
         )
-        if ser.is_valid():
-            ser.save()
-            return Response(data=ser.data, status=HTTPStatus.OK)
-        return Response(ser.errors, status=HTTPStatus.BAD_REQUEST)
+        if precondition_failed is not None:
+            return precondition_failed
+        data, status = update_user(request.user, request.data)
+        response = Response(data=data, status=status)
+        if status == HTTPStatus.OK:
+            with_etag(response, user_etag(data, media_format))
+        return response
 
     def options(self, request, *args, **kwargs):
         meta = self.metadata_class()
@@ -101,6 +216,7 @@ class RetrieveUpdateUser(APIView):
 
 
 @api_view(["POST"])
+@throttle_classes([LoginThrottle])
 def login_view(request):
     """
     Endpoint handling user's login;
@@ -118,12 +234,9 @@ def login_view(request):
             password=credentials.validated_data["password"],
         )
         if user:
-            refresh = RefreshToken.objects.filter(user=user).first()
-            if not refresh or refresh.expired():
-                refresh = RefreshToken.create_refresh_token(user)
             return Response(
                 data={
-                    "refresh_token": str(refresh.token),
+                    "refresh_token": issue_refresh_token(user),
                     "access_token": RefreshToken.create_access_token(user),
                 },
                 status=HTTPStatus.OK,
@@ -143,6 +256,7 @@ def login_view(request):
 
 
 @api_view(["POST"])
+@throttle_classes([RefreshThrottle])
 def refresh_view(request):
     """
     Returns pair of refresh token and access token;
@@ -150,9 +264,11 @@ def refresh_view(request):
     Accepts json-object as a request, which must have a key **_refresh\_token_**;
     if such key is not found, or it is not a valid uuid object - error is returned
     """
-    if request.data.get("refresh_token") is None or not is_valid_uuid(
-        request.data.get("refresh_token")
-    ):
+    if settings.REFRESH_TOKEN_STATELESS:
+        data, status = stateless_refresh(request.data.get("refresh_token"))
+        return Response(data=data, status=status)
+    token = parse_uuid(request.data.get("refresh_token"))
+    if token is None:
         return Response(
             data={
                 "error": "invalid 'refresh_token' value "
@@ -160,29 +276,19 @@ def refresh_view(request):
             },
             status=HTTPStatus.BAD_REQUEST,
         )
-    token = RefreshToken.objects.filter(
-        token=request.data.get("refresh_token")
-    ).first()
-    if not token:
+    rotated = RefreshToken.rotate(token)
+    if rotated is None:
+        # expired tokens are never rotated, only removed
+        if RefreshToken.objects.filter(token=token).delete()[0]:
+            return Response(
+                data={"error": "Refresh token expired"},
+                status=HTTPStatus.UNAUTHORIZED,
+            )
         return Response(
             data={"error": "refresh token doesn't exist"},
             status=HTTPStatus.UNAUTHORIZED,
         )
-
-    if token.expired():
-        token.delete()
-        return Response(
-            data={"error": "Refresh token expired"},
-            status=HTTPStatus.UNAUTHORIZED,
-        )
-    user = user_from_refresh_token(token.token)
-    if user is None:
-        return Response(
-            data={"error": "user doesn't exist"},
-            status=HTTPStatus.INTERNAL_SERVER_ERROR,
-        )
-    token.delete()
-    refresh = RefreshToken.create_refresh_token(user)
+    refresh, user = rotated
     return Response(
         data={
             "access_token": RefreshToken.create_access_token(user),
@@ -204,6 +310,9 @@ def logout_view(request):
         return Response(
             data={"error": "token not provided"}, status=HTTPStatus.BAD_REQUEST
         )
+    if settings.REFRESH_TOKEN_STATELESS:
+        data, status = stateless_logout(token_str)
+        return Response(data=data, status=status)
     token = RefreshToken.objects.filter(token=token_str).first()
     if not token:
         return Response(
@@ -211,3 +320,67 @@ def logout_view(request):
         )
     token.delete()
     return Response(data={"success": "user logged out"}, status=HTTPStatus.OK)
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([IsGateway])
+@throttle_classes([IntrospectThrottle])
+@replica_reads
+def introspect_view(request):
+    """
+    Batch token introspection for API gateways, authenticated with one of
+    INTROSPECTION_SECRETS sent as bearer token;
+
+    Accepts json-object with lists of tokens under "access_tokens" and
+    "refresh_tokens" keys (up to INTROSPECTION_MAX_TOKENS in total).
+    Returns the same keys with a json-object per token, in request order:
+    "active", "status" (active, expired, revoked or invalid), "sub"
+    (user's email), "uid" and "exp"
+    """
+    ser = serializers.IntrospectionSerializer(data=request.data)
+    if not ser.is_valid():
+        return Response(data=ser.errors, status=HTTPStatus.BAD_REQUEST)
+    access, refresh = introspect_tokens(
+        ser.validated_data["access_tokens"],
+        ser.validated_data["refresh_tokens"],
+    )
+    return Response(
+        data={"access_tokens": access, "refresh_tokens": refresh},
+        status=HTTPStatus.OK,
+    )
+
+
+def verification_response(authenticated) -> HttpResponse:
+    """Response of verify endpoints to authenticate() result; nginx caches
+    it for max-age seconds, no longer than the token is valid"""
+    max_age = settings.AUTH_VERIFY_MAX_AGE
+    if authenticated is None:
+        response = HttpResponse(status=HTTPStatus.UNAUTHORIZED)
+        response["WWW-Authenticate"] = "Bearer"
+    else:
+        user, payload = authenticated
+        response = HttpResponse(status=HTTPStatus.NO_CONTENT)
+        response["X-User-Id"] = str(user.id)
+        response["X-User-Email"] = user.email
+        if "exp" in payload:
+            max_age = max(0, min(max_age, payload["exp"] - int(time.time())))
+    patch_cache_control(response, max_age=max_age)
+    return response
+
+
+@csrf_exempt
+@replica_reads
+def verify_view(request):
+    """
+    Access token check for nginx auth_request, protecting other apps
+    behind the proxy; any method is accepted and the body is not read.
+
+    Responds with 204 and X-User-Id, X-User-Email headers if the token
+    of Authorization header is valid, 401 otherwise
+    """
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        authenticated = None
+    return verification_response(authenticated)
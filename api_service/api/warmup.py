@@ -0,0 +1,63 @@
+"""
+Warming up of server processes before they serve requests (see
+gunicorn.conf.py), so that first requests of a worker don't pay for
+building URL resolvers and serializer fields, loading translations and
+connecting to databases.
+"""
+
+import logging
+from typing import Iterator
+
+from api import serializers
+
+from django.db import connections
+from django.urls import NoReverseMatch, get_resolver, resolve, reverse
+
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
+
+
+def url_names(resolver, prefix: str = "") -> Iterator[str]:
+    for key in resolver.reverse_dict:
+        if isinstance(key, str):
+            yield prefix + key
+    for namespace, (_, child) in resolver.namespace_dict.items():
+        yield from url_names(child, f"{prefix}{namespace}:")
+
+
+def warm_up() -> None:
+    """
+    Primes caches of the process. Doesn't leave database connections
+    open, so with preloading it is done in the gunicorn master and
+    forked workers share what it has built.
+    """
+    resolved = 0
+    for name in url_names(get_resolver()):
+        try:
+            resolve(reverse(name))
+        except NoReverseMatch:
+            # routes taking arguments
+            continue
+        resolved += 1
+    for serializer_class in vars(serializers).values():
+        if (
+            isinstance(serializer_class, type)
+            and issubclass(serializer_class, BaseSerializer)
+            and serializer_class.__module__ == serializers.__name__
+        ):
+            # required fields are missing, so validation fails before
+            # any query, having built fields and translated messages
+            serializer_class(data={}).is_valid()
+    connections.close_all()
+    logger.info("warmed up, %d routes resolved", resolved)
+
+
+def connect_databases() -> None:
+    """Connects (fills connection pools) before the first request of
+    the worker; connections can't be shared with forked processes, so
+    it is done by each of them"""
+    for connection in connections.all():
+        connection.ensure_connection()
+        # kept open (or returned to pool) as after a request
+        connection.close_if_unusable_or_obsolete()
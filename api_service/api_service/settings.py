@@ -52,15 +52,24 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.middleware.MetricsMiddleware",
+    "api.middleware.QueryCountMiddleware",
+    "api.middleware.DatabaseRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
+    # these are skipped for LEAN_MIDDLEWARE_PATHS (see api.middleware)
+    "api.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
-    "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django.contrib.messages.middleware.MessageMiddleware",
-    "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "api.middleware.CsrfViewMiddleware",
+    "api.middleware.AuthenticationMiddleware",
+    "api.middleware.MessageMiddleware",
+    "api.middleware.XFrameOptionsMiddleware",
 ]
 
+# Paths of token authenticated endpoints, served without session, CSRF,
+# auth, messages and clickjacking middleware; ones ending with a slash are
+# prefixes, others are matched exactly
+LEAN_MIDDLEWARE_PATHS = ["/api/", "/.well-known/", "/metrics"]
+
 # CSRF_COOKIE_SECURE = True
 # SESSION_COOKIE_SECURE = True
 # SECURE_SSL_REDIRECT = True
@@ -90,6 +99,16 @@ WSGI_APPLICATION = "api_service.wsgi.application"
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
 HOST = os.getenv("DJANGO_DB_HOST", default="localhost")
+# Each worker process takes connections from its own pool (PostgreSQL with
+# psycopg 3 only); with the pool disabled, connections are kept open for
+# DB_CONN_MAX_AGE seconds and checked before being reused
+DB_POOL = os.getenv("DJANGO_DB_POOL", default="True").lower() in [
+    "1",
+    "y",
+    "yes",
+    "true",
+]
+DB_CONN_MAX_AGE = int(os.getenv("DJANGO_DB_CONN_MAX_AGE", default="60"))
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.{}".format(
@@ -99,12 +118,67 @@ DATABASES = {
         "USER": os.getenv("DJANGO_DB_USERNAME"),
         "PASSWORD": os.getenv("DJANGO_DB_PASSWORD"),
         "HOST": HOST,
-        "POST": os.getenv("DJANGO_DB_PORT", default="5432"),
+        "PORT": os.getenv("DJANGO_DB_PORT", default="5432"),
+        # pooled connections are returned to the pool after each request
+        "CONN_MAX_AGE": 0 if DB_POOL else DB_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
+if DB_POOL and DATABASES["default"]["ENGINE"].endswith("postgresql"):
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": int(os.getenv("DJANGO_DB_POOL_MIN_SIZE", default="1")),
+            "max_size": int(os.getenv("DJANGO_DB_POOL_MAX_SIZE", default="4")),
+            # seconds to wait for a free connection before failing
+            "timeout": float(os.getenv("DJANGO_DB_POOL_TIMEOUT", default="5")),
+        }
+    }
+
+# Read replicas of the default database, comma separated hosts (database
+# files with SQLite); GET requests read from a random one (see api.routers).
+# Tests run them as mirrors of the default database
+DB_REPLICAS = [
+    replica.strip()
+    for replica in os.getenv("DJANGO_DB_REPLICAS", default="").split(",")
+    if replica.strip()
+]
+for number, replica in enumerate(DB_REPLICAS, start=1):
+    DATABASES[f"replica{number}"] = {
+        **DATABASES["default"],
+        (
+            "NAME"
+            if DATABASES["default"]["ENGINE"].endswith("sqlite3")
+            else "HOST"
+        ): replica,
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+DATABASE_ROUTERS = (
+    ["api.routers.PrimaryReplicaRouter"] if DATABASE_REPLICAS else []
+)
+# Seconds reads of a user go to the primary after a request has written
+# the user (or was made by it), so that replicas lagging behind don't
+# serve stale data
+DATABASE_REPLICA_STICKINESS = int(
+    os.getenv("DJANGO_DB_REPLICA_STICKINESS", default="5")
+)
 
 AUTH_USER_MODEL = "api.CustomUser"
 
+AUTHENTICATION_BACKENDS = ["api.backends.CachedModelBackend"]
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv(
+            "DJANGO_CACHE_REDIS_URL", default="redis://127.0.0.1:6379/1"
+        ),
+    }
+}
+
+# Seconds user rows are kept in the shared cache
+USER_CACHE_TIMEOUT = int(os.getenv("DJANGO_USER_CACHE_TIMEOUT", default="300"))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -120,6 +194,19 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Passwords are hashed by a pool of threads in each worker process (see
+# api.hashing); when all threads are busy and the queue is full, login and
+# registration respond 503 with Retry-After header of the given seconds
+PASSWORD_HASHING_WORKERS = int(
+    os.getenv("DJANGO_PASSWORD_HASHING_WORKERS", default="2")
+)
+PASSWORD_HASHING_QUEUE_SIZE = int(
+    os.getenv("DJANGO_PASSWORD_HASHING_QUEUE_SIZE", default="8")
+)
+PASSWORD_HASHING_RETRY_AFTER = int(
+    os.getenv("DJANGO_PASSWORD_HASHING_RETRY_AFTER", default="1")
+)
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
@@ -150,7 +237,163 @@ REST_FRAMEWORK = {
     ),
     "DEFAULT_PERMISSION_CLASSES": ["rest_framework.permissions.AllowAny"],
     "DEFAULT_METADATA_CLASS": "rest_framework.metadata.SimpleMetadata",
+    # orjson based (see api.renderers); browsable API is served only when
+    # debugging, its rendering is expensive and it exposes the API
+    "DEFAULT_RENDERER_CLASSES": ["api.renderers.JSONRenderer"]
+    + (["rest_framework.renderers.BrowsableAPIRenderer"] if DEBUG else []),
+    "DEFAULT_PARSER_CLASSES": [
+        "api.renderers.JSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
+    # token bucket rates (see api.throttling); capacity of a bucket is the
+    # number of requests, which is refilled evenly over the period
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": os.getenv("DJANGO_THROTTLE_LOGIN_IP", default="30/min"),
+        "login_email": os.getenv(
+            "DJANGO_THROTTLE_LOGIN_EMAIL", default="10/min"
+        ),
+        "refresh_ip": os.getenv(
+            "DJANGO_THROTTLE_REFRESH_IP", default="60/min"
+        ),
+        "register_ip": os.getenv(
+            "DJANGO_THROTTLE_REGISTER_IP", default="20/min"
+        ),
+        "register_email": os.getenv(
+            "DJANGO_THROTTLE_REGISTER_EMAIL", default="5/min"
+        ),
+        "introspect_ip": os.getenv(
+            "DJANGO_THROTTLE_INTROSPECT_IP", default="600/min"
+        ),
+    },
+    # nginx is the only proxy in front of the service
+    "NUM_PROXIES": int(os.getenv("DJANGO_NUM_PROXIES", default="1")),
+}
+
+# Storage of rate limiter buckets: "redis" (shared by all workers; process
+# memory is used while redis is unavailable) or "memory"
+RATE_LIMIT_BACKEND = os.getenv("DJANGO_RATE_LIMIT_BACKEND", default="redis")
+RATE_LIMIT_URL = os.getenv(
+    "DJANGO_RATE_LIMIT_URL", default=CACHES["default"]["LOCATION"]
+)
+
+# Send number of DB queries and SQL time of each request in Server-Timing
+# response header (see api.middleware)
+QUERY_SERVER_TIMING = os.getenv(
+    "DJANGO_QUERY_SERVER_TIMING", default="True"
+).lower() in ["1", "y", "yes", "true"]
+
+# Expected max number of DB queries per route (URL name); requests going
+# over it are logged as warnings, or fail when QUERY_BUDGET_STRICT is set.
+# Budgets allow for user lookups missing the cache
+QUERY_BUDGETS = {
+    # unique checks of email and username, insert
+    "api:registration": 3,
+    # user read (password hashes aren't cached, so it always hits the
+    # database), token upsert, password hash upgrade
+    "api:login": 3,
+    # rotation (with user lookup outside of PostgreSQL), or removal of
+    # an expired token
+    "api:refresh": 2,
+    # token lookup, delete
+    "api:logout": 2,
+    # user lookup; on update unique checks and update
+    "api:account_options": 4,
+    # refresh tokens and users of the whole batch
+    "api:introspect": 2,
+    # user (or token version) lookup, unless the token is cached
+    "api:verify": 1,
 }
+QUERY_BUDGET_STRICT = os.getenv(
+    "DJANGO_QUERY_BUDGET_STRICT", default="False"
+).lower() in ["1", "y", "yes", "true"]
+
+# Serve api endpoints with async views (see api.async_views); meant for
+# running under an ASGI server
+API_ASYNC_VIEWS = os.getenv(
+    "DJANGO_API_ASYNC_VIEWS", default="False"
+).lower() in ["1", "y", "yes", "true"]
+
+# Max number of verified access tokens kept by each worker process;
+# 0 disables the cache
+ACCESS_TOKEN_CACHE_SIZE = int(
+    os.getenv("DJANGO_ACCESS_TOKEN_CACHE_SIZE", default="1024")
+)
+
+# Max number of tokens (access and refresh together) introspected by
+# a single request to api/introspect/
+INTROSPECTION_MAX_TOKENS = int(
+    os.getenv("DJANGO_INTROSPECTION_MAX_TOKENS", default="100")
+)
+# Secrets API gateways send as bearer token to api/introspect/ (comma
+# separated, so that one can be rotated); introspection is denied while
+# none is set
+INTROSPECTION_SECRETS = [
+    secret.strip()
+    for secret in os.getenv("DJANGO_INTROSPECTION_SECRETS", default="").split(
+        ","
+    )
+    if secret.strip()
+]
+
+# Seconds nginx caches responses of api/verify/ (never longer than the
+# token is valid), so revoking tokens takes up to as long for other apps
+AUTH_VERIFY_MAX_AGE = int(
+    os.getenv("DJANGO_AUTH_VERIFY_MAX_AGE", default="10")
+)
+
+# Directory of access token signing keys ("<kid>.pem" files, see api.keys)
+# published at /.well-known/jwks.json; with ACCESS_TOKEN_SIGNING_KID set,
+# access tokens are signed with that key instead of SECRET_KEY (HS256)
+ACCESS_TOKEN_KEYS_DIR = os.getenv("DJANGO_ACCESS_TOKEN_KEYS_DIR") or None
+ACCESS_TOKEN_SIGNING_KID = os.getenv("DJANGO_ACCESS_TOKEN_SIGNING_KID") or None
+# Seconds JWKS document may be cached by its clients
+JWKS_MAX_AGE = int(os.getenv("DJANGO_JWKS_MAX_AGE", default="300"))
+
+# Resolve authenticated user from access token claims, loading user row
+# only when a field not carried by the token is accessed
+ACCESS_TOKEN_CLAIMS_AUTH = os.getenv(
+    "DJANGO_ACCESS_TOKEN_CLAIMS_AUTH", default="False"
+).lower() in ["1", "y", "yes", "true"]
+
+# Compute refresh token expiry from its creation time and current
+# REFRESH_TOKEN_LIFETIME on every check instead of storing it, so that
+# lifetime changes don't rewrite the whole tokens table
+REFRESH_TOKEN_LAZY_EXPIRY = os.getenv(
+    "DJANGO_REFRESH_TOKEN_LAZY_EXPIRY", default="True"
+).lower() in ["1", "y", "yes", "true"]
+
+# Seconds between purges of expired refresh tokens done by each worker
+# process in background; 0 disables it (run "purge_refresh_tokens"
+# management command periodically instead)
+REFRESH_TOKEN_REAPER_INTERVAL = int(
+    os.getenv("DJANGO_REFRESH_TOKEN_REAPER_INTERVAL", default="0")
+)
+REFRESH_TOKEN_REAPER_BATCH_SIZE = int(
+    os.getenv("DJANGO_REFRESH_TOKEN_REAPER_BATCH_SIZE", default="1000")
+)
+
+# Seconds refresh token counts served by /metrics are kept in the cache;
+# counting scans the tokens table, so it isn't done on every scrape
+REFRESH_TOKEN_METRICS_MAX_AGE = int(
+    os.getenv("DJANGO_REFRESH_TOKEN_METRICS_MAX_AGE", default="60")
+)
+
+# Issue signed refresh tokens checked without database reads (see
+# api.stateless) instead of storing them in RefreshToken table; only
+# revocations are kept, in redis
+REFRESH_TOKEN_STATELESS = os.getenv(
+    "DJANGO_REFRESH_TOKEN_STATELESS", default="False"
+).lower() in ["1", "y", "yes", "true"]
+REFRESH_TOKEN_REVOCATION_URL = os.getenv(
+    "DJANGO_REFRESH_TOKEN_REVOCATION_URL",
+    default=CACHES["default"]["LOCATION"],
+)
+# Number of revocations the in-memory Bloom filter of each worker holds
+# with 0.1% false positives (about 1.8 bytes per revocation)
+REFRESH_TOKEN_BLOOM_CAPACITY = int(
+    os.getenv("DJANGO_REFRESH_TOKEN_BLOOM_CAPACITY", default="100000")
+)
 
 CONSTANCE_CONFIG = {
     "ACCESS_TOKEN_LIFETIME": (30, "Access token lifetime in seconds"),
@@ -159,3 +402,10 @@ CONSTANCE_CONFIG = {
         "Refresh token lifetime in seconds",
     ),
 }
+
+# Constance values are kept in memory of each worker and reloaded when
+# changed; this is the upper bound on how long a missed change goes
+# unnoticed
+CONSTANCE_SNAPSHOT_MAX_AGE = int(
+    os.getenv("DJANGO_CONSTANCE_SNAPSHOT_MAX_AGE", default="60")
+)
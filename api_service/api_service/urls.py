@@ -1,3 +1,6 @@
+from api.keys import jwks_view
+from api.metrics import metrics_view
+
 from django.contrib import admin
 from django.shortcuts import redirect
 from django.urls import include, path
@@ -6,4 +9,6 @@ urlpatterns = [
     path("", view=lambda request: redirect("api:login")),
     path("admin/", admin.site.urls),
     path("api/", include("api.urls")),
+    path("metrics", view=metrics_view, name="metrics"),
+    path(".well-known/jwks.json", view=jwks_view, name="jwks"),
 ]
@@ -0,0 +1,139 @@
+"""
+Compares the sync (WSGI, sync gunicorn workers) and async (ASGI, uvicorn
+gunicorn workers) stacks under the same load.
+
+Run from the api_service directory with the same environment the service
+uses (database, redis, secret key):
+
+    python -m benchmarks.async_vs_sync --concurrency 256 --duration 20
+
+Each stack is started as a separate gunicorn process with the same number
+of workers; a test user is registered and logged in, then the chosen
+scenario is driven at the requested concurrency. Requests per second and
+p50/p95/p99 latencies are printed for both stacks.
+"""
+
+import argparse
+import asyncio
+import json
+import uuid
+
+from benchmarks.http_load import request, run_load
+from benchmarks.server import (
+    HOST,
+    free_port,
+    start_server,
+    stop_server,
+    wait_for_port,
+)
+
+STACKS = {
+    "sync": {
+        "app": "api_service.wsgi:application",
+        "args": [],
+        "env": {"DJANGO_API_ASYNC_VIEWS": "False"},
+    },
+    "async": {
+        "app": "api_service.asgi:application",
+        "args": ["--worker-class", "uvicorn_worker.UvicornWorker"],
+        "env": {"DJANGO_API_ASYNC_VIEWS": "True"},
+    },
+}
+
+
+async def prepare(port: int, scenario: str) -> dict:
+    """Creates a user and returns arguments for run_load() of the scenario"""
+    name = f"bench-{uuid.uuid4().hex[:12]}"
+    credentials = {"email": f"{name}@example.com", "password": "Passw0rd!"}
+    status, body = await request(
+        HOST,
+        port,
+        "POST",
+        "/api/register/",
+        body={**credentials, "username": name},
+    )
+    if status != 201:
+        raise RuntimeError(f"registration failed: {status} {body}")
+    if scenario == "login":
+        return {"method": "POST", "path": "/api/login/", "body": credentials}
+
+    status, body = await request(
+        HOST, port, "POST", "/api/login/", body=credentials
+    )
+    if status != 200:
+        raise RuntimeError(f"login failed: {status} {body}")
+    return {
+        "method": "GET",
+        "path": "/api/me/",
+        "headers": {"Authorization": f"Bearer {body['access_token']}"},
+    }
+
+
+def bench_stack(stack: str, args) -> dict:
+    port = free_port()
+    config = STACKS[stack]
+    server = start_server(
+        config["app"], port, args.workers, config["args"], config["env"]
+    )
+    try:
+        wait_for_port(port)
+        load = asyncio.run(prepare(port, args.scenario))
+        # warm up workers (imports, connections, caches) before measuring
+        asyncio.run(run_load(HOST, port, concurrency=8, duration=2, **load))
+        result = asyncio.run(
+            run_load(
+                HOST,
+                port,
+                concurrency=args.concurrency,
+                duration=args.duration,
+                **load,
+            )
+        )
+    finally:
+        stop_server(server)
+    return result.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scenario",
+        choices=["me", "login"],
+        default="me",
+        help="'me' - authenticated GET /api/me/, "
+        "'login' - POST /api/login/ (password hashing bound)",
+    )
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument(
+        "--stacks", nargs="+", choices=list(STACKS), default=list(STACKS)
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print results as json"
+    )
+    args = parser.parse_args()
+
+    results = {stack: bench_stack(stack, args) for stack in args.stacks}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"scenario={args.scenario} concurrency={args.concurrency} "
+        f"duration={args.duration}s workers={args.workers}"
+    )
+    print(
+        f"{'stack':<8}{'requests':>10}{'errors':>8}{'rps':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    )
+    for stack, summary in results.items():
+        print(
+            f"{stack:<8}{summary['requests']:>10}{summary['errors']:>8}"
+            f"{summary['rps']:>10}{summary['p50_ms']:>10}"
+            f"{summary['p95_ms']:>10}{summary['p99_ms']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
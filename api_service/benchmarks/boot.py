@@ -0,0 +1,183 @@
+"""
+Compares boot modes of the service under gunicorn (see gunicorn.conf.py):
+without preloading, with the app preloaded in the master (and frozen
+for garbage collector before fork), and preloaded with warm-up.
+
+Run from the api_service directory with the same environment the service
+uses (database, redis, secret key):
+
+    python -m benchmarks.boot --workers 3
+
+For each mode the server is started from scratch and the time from its
+launch to the first response (TTFR) is measured, polling with an
+authenticated api/me/ request; then the slowest of the first requests
+reaching every worker, and memory of every worker after it has served
+requests: RSS counts pages shared with the master in every worker, PSS
+splits them between sharing processes, USS is memory of the worker only.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from typing import Dict, List
+
+from benchmarks.http_load import request
+from benchmarks.server import (
+    HOST,
+    free_port,
+    start_server,
+    stop_server,
+)
+
+MODES = {
+    "no preload": {"GUNICORN_PRELOAD": "False", "GUNICORN_WARM_UP": "False"},
+    "preload": {"GUNICORN_PRELOAD": "True", "GUNICORN_WARM_UP": "False"},
+    "preload + warm-up": {
+        "GUNICORN_PRELOAD": "True",
+        "GUNICORN_WARM_UP": "True",
+    },
+}
+
+
+def access_token() -> str:
+    """Returns access token of the benchmark user, created if needed"""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_service.settings")
+    import django
+
+    django.setup()
+
+    from api.models import RefreshToken
+
+    from django.contrib.auth import get_user_model
+    from django.db import connections
+
+    user, _ = get_user_model().objects.get_or_create(
+        email="bench-boot@example.com",
+        defaults={"username": "bench-boot", "password": "Passw0rd!"},
+    )
+    token = RefreshToken.create_access_token(user)
+    connections.close_all()
+    return token
+
+
+def worker_pids(master: int) -> List[int]:
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # ppid follows the command, which may contain spaces
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == master:
+            pids.append(int(entry))
+    return pids
+
+
+def memory(pid: int) -> Dict[str, float]:
+    """RSS, PSS and USS of the process in MiB"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0]) / 1024
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "uss": fields["Private_Clean"] + fields["Private_Dirty"],
+    }
+
+
+async def wait_for_response(port: int, headers: dict) -> None:
+    while True:
+        try:
+            await request(HOST, port, "GET", "/api/me/", headers)
+            return
+        except OSError:
+            await asyncio.sleep(0.01)
+
+
+async def first_requests(port: int, headers: dict, workers: int) -> float:
+    """Sends rounds of concurrent requests, so that every worker gets
+    some; returns latency of the slowest one in milliseconds"""
+
+    async def timed() -> float:
+        started = time.perf_counter()
+        status, body = await request(HOST, port, "GET", "/api/me/", headers)
+        if status != 200:
+            raise RuntimeError(f"api/me/ failed: {status} {body}")
+        return time.perf_counter() - started
+
+    latencies = []
+    for _ in range(4):
+        latencies += await asyncio.gather(
+            *(timed() for _ in range(workers * 2))
+        )
+    return max(latencies) * 1000
+
+
+def bench_mode(env: dict, headers: dict, args) -> dict:
+    port = free_port()
+    started = time.perf_counter()
+    server = start_server("api_service.wsgi", port, args.workers, env=env)
+    try:
+        asyncio.run(wait_for_response(port, headers))
+        ttfr = (time.perf_counter() - started) * 1000
+        # let workers forked after the first one finish booting
+        time.sleep(args.settle)
+        slowest = asyncio.run(first_requests(port, headers, args.workers))
+        for _ in range(args.requests // 50):
+            asyncio.run(first_requests(port, headers, 6))
+        usage = [memory(pid) for pid in worker_pids(server.pid)]
+    finally:
+        stop_server(server)
+    return {
+        "ttfr": ttfr,
+        "slowest": slowest,
+        **{
+            key: sum(worker[key] for worker in usage) / len(usage)
+            for key in ("rss", "pss", "uss")
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=500,
+        help="requests served before memory is measured",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=2,
+        help="seconds to wait after the first response",
+    )
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=MODES)
+    args = parser.parse_args()
+
+    headers = {"Authorization": f"Bearer {access_token()}"}
+    print(
+        f"{'mode':<20}{'TTFR ms':>9}{'first ms':>10}"
+        f"{'RSS MiB':>9}{'PSS MiB':>9}{'USS MiB':>9}"
+    )
+    for mode in args.mode:
+        result = bench_mode(MODES[mode], headers, args)
+        print(
+            f"{mode:<20}{result['ttfr']:>9.0f}{result['slowest']:>10.1f}"
+            f"{result['rss']:>9.1f}{result['pss']:>9.1f}{result['uss']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Minimal HTTP/1.1 load generator built on asyncio streams.
+
+Every worker keeps its own keep-alive connection open (reconnecting
+when the server closes it) and fires requests one after another, so
+concurrency equals the number of open connections.
+"""
+
+import asyncio
+import json
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+
+@dataclass
+class LoadResult:
+    latencies: List[float] = field(default_factory=list)
+    statuses: Dict[int, int] = field(default_factory=dict)
+    # number of queries per request, when it is known
+    queries: List[int] = field(default_factory=list)
+    errors: int = 0
+    # responses with status other than expected
+    failed: int = 0
+    elapsed: float = 0.0
+
+    def add(
+        self, latency: float, status: int, queries: Optional[int] = None
+    ) -> None:
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if queries is not None:
+            self.queries.append(queries)
+
+    def percentile(self, p: float) -> float:
+        """Returns p-th percentile of latencies in milliseconds"""
+        if not self.latencies:
+            return 0.0
+        if len(self.latencies) == 1:
+            return self.latencies[0] * 1000
+        quantiles = statistics.quantiles(
+            self.latencies, n=100, method="inclusive"
+        )
+        return quantiles[int(p) - 1] * 1000
+
+    @property
+    def rps(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def summary(self) -> dict:
+        summary = {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "failed": self.failed,
+            "statuses": self.statuses,
+            "rps": round(self.rps, 1),
+            "p50_ms": round(self.percentile(50), 2),
+            "p95_ms": round(self.percentile(95), 2),
+            "p99_ms": round(self.percentile(99), 2),
+        }
+        if self.queries:
+            summary["queries"] = round(statistics.mean(self.queries), 2)
+        return summary
+
+
+class Connection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: Optional[dict] = None,
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        payload = b"" if body is None else json.dumps(body).encode()
+        lines = [
+            f"{method} {path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            f"Content-Length: {len(payload)}",
+        ]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        lines.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode()
+        try:
+            self.writer.write(head + payload)
+            await self.writer.drain()
+            return await self._read_response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            raise
+
+    async def _read_response(self) -> Tuple[int, Dict[str, str], bytes]:
+        status_line = await self.reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b"\r\n")).strip(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await self.reader.readexactly(
+                int(headers["content-length"])
+            )
+        else:
+            body = await self.reader.read()
+            headers["connection"] = "close"
+
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, headers, body
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def request(
+    host: str,
+    port: int,
+    method: str,
+    path: str,
+    headers: Optional[Dict[str, str]] = None,
+    body: Optional[dict] = None,
+) -> Tuple[int, Any]:
+    """Sends a single request and returns its status and json-body
+    (or raw body if it isn't json)"""
+    conn = Connection(host, port)
+    try:
+        status, _, content = await conn.request(method, path, headers, body)
+    finally:
+        conn.close()
+    try:
+        return status, json.loads(content or b"{}")
+    except ValueError:
+        return status, content
+
+
+async def run_load(
+    host: str,
+    port: int,
+    method: str,
+    path: str,
+    concurrency: int,
+    duration: float,
+    headers: Optional[Dict[str, str]] = None,
+    body: Optional[dict] = None,
+) -> LoadResult:
+    """Keeps `concurrency` connections busy for `duration` seconds"""
+    result = LoadResult()
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        conn = Connection(host, port)
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    status, _, _ = await conn.request(
+                        method, path, headers, body
+                    )
+                except (OSError, asyncio.IncompleteReadError):
+                    result.errors += 1
+                    await asyncio.sleep(0.01)
+                    continue
+                result.add(time.perf_counter() - started, status)
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result.elapsed = time.perf_counter() - started
+    return result
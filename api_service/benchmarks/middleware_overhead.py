@@ -0,0 +1,97 @@
+"""
+Measures per-request overhead of the middleware skipped for
+LEAN_MIDDLEWARE_PATHS, by serving the same requests through a WSGI
+handler with the stock Django middleware and with the configured one.
+
+Run from the api_service directory:
+
+    python -m benchmarks.middleware_overhead --number 2000
+
+Requests chosen need no database (unauthenticated api/me/, JWKS); the
+admin login page shows that other paths still run the whole chain.
+Microseconds per request and the time saved are printed for each path.
+"""
+
+import argparse
+import io
+import os
+import timeit
+
+PATHS = ["/api/me/", "/.well-known/jwks.json", "/admin/login/"]
+
+# stock Django middleware replaced by path-scoped subclasses
+STOCK = {
+    "api.middleware.SessionMiddleware": (
+        "django.contrib.sessions.middleware.SessionMiddleware"
+    ),
+    "api.middleware.CsrfViewMiddleware": (
+        "django.middleware.csrf.CsrfViewMiddleware"
+    ),
+    "api.middleware.AuthenticationMiddleware": (
+        "django.contrib.auth.middleware.AuthenticationMiddleware"
+    ),
+    "api.middleware.MessageMiddleware": (
+        "django.contrib.messages.middleware.MessageMiddleware"
+    ),
+    "api.middleware.XFrameOptionsMiddleware": (
+        "django.middleware.clickjacking.XFrameOptionsMiddleware"
+    ),
+}
+
+
+def environ(path: str) -> dict:
+    return {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "HTTP_HOST": "localhost",
+        "HTTP_ACCEPT": "application/json",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+    }
+
+
+def per_request(handler, path: str, number: int) -> float:
+    """Best of 5 runs, in microseconds per request"""
+
+    def serve():
+        response = handler(environ(path), lambda status, headers: None)
+        response.close()
+
+    serve()
+    return min(timeit.repeat(serve, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_service.settings")
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test.utils import override_settings
+
+    stock = [STOCK.get(path, path) for path in settings.MIDDLEWARE]
+    with override_settings(ALLOWED_HOSTS=["localhost"]):
+        lean_handler = WSGIHandler()
+        with override_settings(MIDDLEWARE=stock):
+            stock_handler = WSGIHandler()
+
+        print(f"{'path':<26}{'stock us':>10}{'lean us':>10}{'saved us':>10}")
+        for path in PATHS:
+            full = per_request(stock_handler, path, args.number)
+            lean = per_request(lean_handler, path, args.number)
+            print(f"{path:<26}{full:>10.1f}{lean:>10.1f}{full - lean:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Starting the service under gunicorn for benchmarks"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, Optional, Sequence
+
+HOST = "127.0.0.1"
+
+# load comes from a few addresses and users, keep rate limits out of the way
+UNTHROTTLED = {
+    f"DJANGO_THROTTLE_{scope}": "1000000/s"
+    for scope in (
+        "LOGIN_IP",
+        "LOGIN_EMAIL",
+        "REFRESH_IP",
+        "REGISTER_IP",
+        "REGISTER_EMAIL",
+    )
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(
+    app: str,
+    port: int,
+    workers: int,
+    args: Sequence[str] = (),
+    env: Optional[Dict[str, str]] = None,
+) -> subprocess.Popen:
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            app,
+            "--bind",
+            f"{HOST}:{port}",
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+            *args,
+        ],
+        env={**os.environ, **UNTHROTTLED, **(env or {})},
+    )
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server didn't start listening on port {port}")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.terminate()
+    server.wait(timeout=30)
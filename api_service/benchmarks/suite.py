@@ -0,0 +1,456 @@
+"""
+Benchmark suite of the api endpoints.
+
+Drives register, login, refresh, me (GET and PUT) and logout endpoints
+with the workloads from benchmarks.workloads in two modes:
+
+- inprocess - requests go one after another through Django's WSGI
+  handler (test client) in this process; DB queries of every request
+  are counted;
+- http - requests are sent concurrently over keep-alive connections to
+  gunicorn started on a local port; DB queries are taken from
+  Server-Timing header of responses.
+
+Both modes run against a throwaway test database created from the
+configured one. Throughput, p50/p95/p99 latency and queries per request
+are reported for each operation and compared against the stored
+baseline; the command exits with status 1 if any of them regressed or
+has no baseline to be compared with.
+
+Run from the api_service directory with the environment the service uses:
+
+    python -m benchmarks.suite
+    python -m benchmarks.suite --mode inprocess --workload mixed
+    python -m benchmarks.suite --update-baseline
+
+Timings depend on the machine, so the baseline should be recorded
+(--update-baseline) on the same machine the suite runs on, e.g. a CI
+runner. Queries per request don't, and are compared exactly, but they
+do depend on the database (e.g. refresh token rotation takes one query
+on PostgreSQL and two elsewhere), so a baseline is kept for each
+database vendor and results are compared with the one of the
+configured database.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from benchmarks.http_load import Connection, LoadResult
+from benchmarks.server import (
+    HOST,
+    free_port,
+    start_server,
+    stop_server,
+    wait_for_port,
+)
+from benchmarks.workloads import (
+    EXPECTED_STATUS,
+    OPS,
+    VirtualUser,
+    WORKLOADS,
+    unique_name,
+)
+
+BASELINE = Path(__file__).with_name("baseline.json")
+MODES = ("inprocess", "http")
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) quer')
+
+Results = Dict[str, LoadResult]
+
+
+def timing_queries(headers: Dict[str, str]) -> Optional[int]:
+    """Returns number of queries reported in Server-Timing header
+    (see api.middleware), if any"""
+    match = SERVER_TIMING_QUERIES.search(headers.get("server-timing", ""))
+    return int(match.group(1)) if match else None
+
+
+def merge(results: Results) -> LoadResult:
+    total = LoadResult()
+    for result in results.values():
+        total.latencies.extend(result.latencies)
+        total.queries.extend(result.queries)
+        total.errors += result.errors
+        total.failed += result.failed
+        for status, count in result.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+        total.elapsed = result.elapsed
+    return total
+
+
+@contextmanager
+def test_database(keepdb: bool):
+    """Creates test database the way test runner does; yields its name"""
+    from django.db import connection
+    from django.test.utils import (
+        setup_test_environment,
+        teardown_test_environment,
+    )
+
+    setup_test_environment()
+    old_name = connection.settings_dict["NAME"]
+    name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, keepdb=keepdb
+    )
+    try:
+        yield name
+    finally:
+        connection.creation.destroy_test_db(
+            old_name, verbosity=0, keepdb=keepdb
+        )
+        teardown_test_environment()
+
+
+def run_inprocess(workload: str, args) -> Results:
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client, override_settings
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client()
+
+    def send(call):
+        return client.generic(
+            call.method,
+            call.path,
+            json.dumps(call.body) if call.body is not None else "",
+            content_type="application/json",
+            headers=call.headers,
+        )
+
+    rng = random.Random(args.seed)
+    ops, weights = zip(*WORKLOADS[workload].items())
+    results = {op: LoadResult() for op in OPS}
+    users = [VirtualUser(unique_name()) for _ in range(args.users)]
+
+    unthrottled = {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": {}}
+    with override_settings(REST_FRAMEWORK=unthrottled):
+        for user in users:
+            send(user.registration())
+            response = send(user.call("login"))
+            user.apply("login", response.status_code, response.json())
+
+        started = time.perf_counter()
+        i = 0
+        # cheap workloads are repeated for a while to get stable numbers
+        while i < args.warmup + args.requests or (
+            time.perf_counter() - started < args.min_duration
+        ):
+            if i == args.warmup:
+                started = time.perf_counter()
+            user = users[i % len(users)]
+            for op in user.plan(rng.choices(ops, weights)[0]):
+                call = user.call(op)
+                with CaptureQueriesContext(connection) as queries:
+                    request_started = time.perf_counter()
+                    response = send(call)
+                    latency = time.perf_counter() - request_started
+                status = response.status_code
+                ok = status == EXPECTED_STATUS[op]
+                user.apply(op, status, response.json() if ok else None)
+                if i >= args.warmup:
+                    results[op].add(latency, status, len(queries))
+                    results[op].failed += not ok
+            i += 1
+        elapsed = time.perf_counter() - started
+
+    for result in results.values():
+        result.elapsed = elapsed
+    return {op: result for op, result in results.items() if result.latencies}
+
+
+async def drive_http(port: int, workload: str, duration: float, args):
+    ops, weights = zip(*WORKLOADS[workload].items())
+    results = {op: LoadResult() for op in OPS}
+
+    async def register(user: VirtualUser) -> Connection:
+        conn = Connection(HOST, port)
+        for call in (user.registration(), user.call("login")):
+            status, _, content = await conn.request(
+                call.method, call.path, call.headers, call.body
+            )
+        user.apply("login", status, json.loads(content))
+        return conn
+
+    users = [VirtualUser(unique_name()) for _ in range(args.concurrency)]
+    connections = await asyncio.gather(*(register(user) for user in users))
+
+    async def worker(n: int, user: VirtualUser, conn: Connection):
+        rng = random.Random(args.seed + n)
+        try:
+            while time.perf_counter() < deadline:
+                for op in user.plan(rng.choices(ops, weights)[0]):
+                    call = user.call(op)
+                    request_started = time.perf_counter()
+                    try:
+                        status, headers, content = await conn.request(
+                            call.method, call.path, call.headers, call.body
+                        )
+                    except (OSError, asyncio.IncompleteReadError):
+                        results[op].errors += 1
+                        user.apply(op, 0, None)
+                        break
+                    latency = time.perf_counter() - request_started
+                    ok = status == EXPECTED_STATUS[op]
+                    user.apply(op, status, json.loads(content) if ok else None)
+                    results[op].add(latency, status, timing_queries(headers))
+                    results[op].failed += not ok
+        finally:
+            conn.close()
+
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(
+        *(
+            worker(n, user, conn)
+            for n, (user, conn) in enumerate(zip(users, connections))
+        )
+    )
+    elapsed = time.perf_counter() - started
+    for result in results.values():
+        result.elapsed = elapsed
+    return {op: result for op, result in results.items() if result.latencies}
+
+
+def run_http(workloads: List[str], db_name: str, args) -> Dict[str, Results]:
+    port = free_port()
+    server = start_server(
+        "api_service.wsgi:application",
+        port,
+        args.workers,
+        env={"DJANGO_DB_NAME": db_name},
+    )
+    try:
+        wait_for_port(port)
+        asyncio.run(drive_http(port, workloads[0], args.warmup_duration, args))
+        return {
+            workload: asyncio.run(
+                drive_http(port, workload, args.duration, args)
+            )
+            for workload in workloads
+        }
+    finally:
+        stop_server(server)
+
+
+def compare(summary: dict, base: dict, args) -> List[str]:
+    """Returns descriptions of metrics that regressed against base"""
+    problems = []
+    for metric in ("p95_ms", "p99_ms"):
+        limit = max(
+            base[metric] * (1 + args.latency_threshold),
+            base[metric] + args.latency_slack,
+        )
+        if summary[metric] > limit:
+            problems.append(f"{metric} {base[metric]} -> {summary[metric]}")
+    if summary["rps"] < base["rps"] * (1 - args.throughput_threshold):
+        problems.append(f"rps {base['rps']} -> {summary['rps']}")
+    # queries don't depend on the machine, any increase is a regression
+    if "queries" in base and summary.get("queries", 0) > base["queries"]:
+        problems.append(
+            f"queries {base['queries']} -> {summary.get('queries')}"
+        )
+    if summary["failed"] or summary["errors"]:
+        problems.append(
+            f"{summary['failed']} unexpected responses, "
+            f"{summary['errors']} connection errors "
+            f"(statuses: {summary['statuses']})"
+        )
+    return problems
+
+
+def report(mode: str, workload: str, results: Results, baseline, args):
+    """Prints results table; returns found regressions"""
+    total = merge(results)
+    print(
+        f"\n{mode} / {workload}: {len(total.latencies)} requests "
+        f"in {total.elapsed:.1f}s"
+    )
+    print(
+        f"{'operation':<10}{'requests':>9}{'failed':>8}{'rps':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+    )
+    summaries = {op: result.summary() for op, result in results.items()}
+    summaries["total"] = total.summary()
+    regressions = []
+    for op, summary in summaries.items():
+        key = f"{mode}:{workload}:{op}"
+        base = baseline.get(key)
+        problems = compare(summary, base, args) if base else []
+        regressions.extend(f"{key}: {problem}" for problem in problems)
+        print(
+            f"{op:<10}{summary['requests']:>9}{summary['failed']:>8}"
+            f"{summary['rps']:>9}{summary['p50_ms']:>9}"
+            f"{summary['p95_ms']:>9}{summary['p99_ms']:>9}"
+            f"{summary.get('queries', '-'):>9}"
+            + ("  << REGRESSION" if problems else "")
+        )
+    return regressions, {
+        f"{mode}:{workload}:{op}": {
+            metric: value
+            for metric, value in summary.items()
+            if metric not in ("statuses", "errors", "failed")
+        }
+        for op, summary in summaries.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument(
+        "--workload",
+        nargs="+",
+        choices=list(WORKLOADS),
+        default=list(WORKLOADS),
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=300,
+        help="operations per workload in inprocess mode",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=50,
+        help="unmeasured operations before inprocess run",
+    )
+    parser.add_argument(
+        "--users", type=int, default=8, help="virtual users in inprocess mode"
+    )
+    parser.add_argument(
+        "--min-duration",
+        type=float,
+        default=5,
+        help="minimal seconds of each inprocess workload",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=15,
+        help="seconds of load per workload in http mode",
+    )
+    parser.add_argument("--warmup-duration", type=float, default=3)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="concurrent connections (virtual users) in http mode",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=3, help="gunicorn workers"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--latency-threshold",
+        type=float,
+        default=0.25,
+        help="allowed relative growth of p95/p99 latency",
+    )
+    parser.add_argument(
+        "--latency-slack",
+        type=float,
+        default=1,
+        help="latency growth (ms) never reported as a regression",
+    )
+    parser.add_argument(
+        "--throughput-threshold",
+        type=float,
+        default=0.2,
+        help="allowed relative drop of throughput",
+    )
+    parser.add_argument(
+        "--keepdb", action="store_true", help="keep the test database"
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_service.settings")
+    import django
+
+    django.setup()
+
+    from django.db import connection
+
+    stored = {}
+    if args.baseline.exists():
+        stored = json.loads(args.baseline.read_text())
+    # queries differ between databases, so each has its own baseline
+    recorded = stored.setdefault(connection.vendor, {"results": {}})
+    baseline = {} if args.update_baseline else recorded["results"]
+
+    regressions, measured = [], {}
+    with test_database(args.keepdb) as db_name:
+        runs = {}
+        if "inprocess" in args.mode:
+            runs["inprocess"] = {
+                workload: run_inprocess(workload, args)
+                for workload in args.workload
+            }
+        if "http" in args.mode:
+            runs["http"] = run_http(args.workload, db_name, args)
+    for mode, workloads in runs.items():
+        for workload, results in workloads.items():
+            found, summaries = report(mode, workload, results, baseline, args)
+            regressions.extend(found)
+            measured.update(summaries)
+
+    if args.update_baseline:
+        recorded["results"].update(measured)
+        recorded["machine"] = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        }
+        args.baseline.write_text(
+            json.dumps(stored, indent=2, sort_keys=True) + "\n"
+        )
+        print(f"\nbaseline written to {args.baseline}")
+        return
+
+    # results without a baseline can't be checked, which must not pass
+    # for a clean run
+    unchecked = sorted(key for key in measured if key not in baseline)
+    if unchecked:
+        print("\n" + "!" * 72, file=sys.stderr)
+        print(
+            f"NO {connection.vendor} BASELINE in {args.baseline} "
+            "(record it with --update-baseline) for:",
+            file=sys.stderr,
+        )
+        for key in unchecked:
+            print(f"  {key}", file=sys.stderr)
+        print("!" * 72, file=sys.stderr)
+    if regressions:
+        print("\n" + "!" * 72, file=sys.stderr)
+        print("PERFORMANCE REGRESSION against the baseline:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        print("!" * 72, file=sys.stderr)
+    if unchecked or regressions:
+        sys.exit(1)
+    print("\nno regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
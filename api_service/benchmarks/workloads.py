@@ -0,0 +1,123 @@
+"""
+Workloads of the benchmark suite.
+
+Each virtual user keeps its own credentials and tokens and performs
+operations chosen at random according to the workload weights. An
+operation needing a token the user doesn't have (e.g. GET /api/me/ right
+after logout) is preceded by the request obtaining it, which is measured
+as well, so every workload is a realistic sequence of calls.
+"""
+
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+PASSWORD = "bench-Passw0rd!"
+
+WORKLOADS: Dict[str, Dict[str, int]] = {
+    # typical traffic: mostly authenticated reads
+    "mixed": {
+        "me": 60,
+        "refresh": 15,
+        "login": 10,
+        "me_put": 5,
+        "logout": 5,
+        "register": 5,
+    },
+    # token churn: credential checks and rotations only
+    "auth": {"login": 35, "refresh": 35, "logout": 15, "register": 15},
+    "read": {"me": 100},
+}
+
+OPS = ("register", "login", "refresh", "me", "me_put", "logout")
+
+EXPECTED_STATUS = {
+    "register": 201,
+    "login": 200,
+    "refresh": 200,
+    "me": 200,
+    "me_put": 200,
+    "logout": 200,
+}
+
+
+@dataclass
+class Call:
+    method: str
+    path: str
+    body: Optional[dict] = None
+    headers: Optional[Dict[str, str]] = None
+
+
+def unique_name() -> str:
+    return f"bench-{uuid.uuid4().hex[:16]}"
+
+
+class VirtualUser:
+    def __init__(self, name: str):
+        self.email = f"{name}@example.com"
+        self.username = name
+        self.access_token: Optional[str] = None
+        self.refresh_token: Optional[str] = None
+
+    def registration(self) -> Call:
+        return Call(
+            "POST",
+            "/api/register/",
+            {
+                "email": self.email,
+                "password": PASSWORD,
+                "username": self.username,
+            },
+        )
+
+    def plan(self, op: str) -> List[str]:
+        """Returns operations to perform for `op`, prerequisites first"""
+        if op in ("me", "me_put") and self.access_token is None:
+            return ["refresh" if self.refresh_token else "login", op]
+        if op in ("refresh", "logout") and self.refresh_token is None:
+            return ["login", op]
+        return [op]
+
+    def call(self, op: str) -> Call:
+        auth = {"Authorization": f"Bearer {self.access_token}"}
+        if op == "register":
+            # registration of a new account, user's own is kept
+            return VirtualUser(unique_name()).registration()
+        if op == "login":
+            return Call(
+                "POST",
+                "/api/login/",
+                {"email": self.email, "password": PASSWORD},
+            )
+        if op == "refresh":
+            return Call(
+                "POST", "/api/refresh/", {"refresh_token": self.refresh_token}
+            )
+        if op == "logout":
+            return Call(
+                "POST", "/api/logout/", {"refresh_token": self.refresh_token}
+            )
+        if op == "me":
+            return Call("GET", "/api/me/", headers=auth)
+        if op == "me_put":
+            self.username = unique_name()
+            return Call(
+                "PUT", "/api/me/", {"username": self.username}, headers=auth
+            )
+        raise ValueError(f"unknown operation: {op}")
+
+    def apply(self, op: str, status: int, body) -> None:
+        """Updates user's tokens according to the response"""
+        if status != EXPECTED_STATUS[op]:
+            # start over from login on any failure
+            self.access_token = self.refresh_token = None
+            return
+        if op in ("login", "refresh"):
+            self.access_token = body["access_token"]
+            self.refresh_token = str(body["refresh_token"])
+        elif op == "me_put":
+            # update revokes access tokens issued before it
+            self.access_token = None
+        elif op == "logout":
+            self.access_token = self.refresh_token = None
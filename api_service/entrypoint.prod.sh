@@ -1,5 +1,21 @@
 #!/usr/bin/env bash
 
-python manage.py collectstatic --noinput
-python manage.py migrate --noinput
-python -m gunicorn --bind 0.0.0.0:8000 --workers 3 api_service.wsgi
+# "release" is a one-shot job run to completion before web containers are
+# (re)started, so that they only start the server
+if [ "${1:-web}" = "release" ]; then
+    set -e
+    python manage.py migrate --noinput
+    python manage.py collectstatic --noinput
+    exit 0
+fi
+
+# workers write metrics to files of this directory, so that a scrape of
+# any of them reports totals of all workers; files of the previous run
+# are removed to start counting from zero
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# app, worker class and number of workers are chosen by gunicorn.conf.py
+# (ASGI app and workers when DJANGO_API_ASYNC_VIEWS is set)
+exec python -m gunicorn --bind 0.0.0.0:8000
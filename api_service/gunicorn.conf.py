@@ -0,0 +1,207 @@
+"""
+Server profile of the service: gunicorn settings derived from CPUs the
+process may use, each of which can be overridden with an environment
+variable (see README), so that one node is scaled without editing the
+entrypoint. Command line options take precedence over this file.
+"""
+
+import gc
+import math
+import os
+import resource
+import signal
+import socket
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+from prometheus_client import multiprocess
+
+
+def env_flag(name: str, default: str) -> bool:
+    return os.environ.get(name, default).lower() in ["1", "y", "yes", "true"]
+
+
+def cpu_count(cgroup: str = "/sys/fs/cgroup") -> int:
+    """CPUs of the affinity mask, limited by cgroup CPU quota of the
+    container (v2 or v1) when it has one"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    for quota_file, period_file in (
+        ("cpu.max", None),
+        ("cpu/cpu.cfs_quota_us", "cpu/cpu.cfs_period_us"),
+    ):
+        try:
+            values = (Path(cgroup) / quota_file).read_text().split()
+            if period_file is not None:
+                values.append((Path(cgroup) / period_file).read_text())
+            quota, period = values[0], int(values[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if quota not in ("max", "-1"):
+            return max(1, min(cpus, math.ceil(int(quota) / period)))
+        break
+    return cpus
+
+
+CPUS = cpu_count()
+
+# threads make workers wait for database and redis concurrently; ASGI
+# workers do that in their event loop
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS") or (
+    "uvicorn_worker.UvicornWorker"
+    if env_flag("DJANGO_API_ASYNC_VIEWS", "False")
+    else "gthread" if threads > 1 else "sync"
+)
+ASGI = "uvicorn" in worker_class.lower()
+# used when the app isn't given on the command line
+wsgi_app = "api_service.asgi:application" if ASGI else "api_service.wsgi"
+
+
+def default_workers(worker_class: str, cpus: int) -> int:
+    if "uvicorn" in worker_class.lower():
+        # an event loop keeps a CPU busy on its own
+        return cpus
+    if worker_class == "gthread":
+        return cpus + 1
+    # sync workers are blocked while waiting for database and redis
+    return 2 * cpus + 1
+
+
+workers = int(
+    os.environ.get("GUNICORN_WORKERS") or default_workers(worker_class, CPUS)
+)
+
+# workers are replaced after serving this many requests (0 never), so
+# that memory they leak or fragment is returned; jitter keeps them from
+# being replaced at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = int(
+    os.environ.get("GUNICORN_MAX_REQUESTS_JITTER") or max_requests // 10
+)
+# connections waiting to be accepted by a worker
+backlog = int(os.environ.get("GUNICORN_BACKLOG", "2048"))
+# seconds idle connections of nginx upstream are kept open (sync workers
+# close them); nginx has to close them first (see nginx.conf)
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# the app is imported once by the master and workers share its memory
+# (code reloading on HUP is lost: workers are forked from the same image)
+preload_app = env_flag("GUNICORN_PRELOAD", "True")
+# prime caches (and connect to databases) before accepting requests
+WARM_UP = env_flag("GUNICORN_WARM_UP", "False")
+
+# seconds between logs of memory of each worker and of listen backlog
+STATS_INTERVAL = float(os.environ.get("GUNICORN_STATS_INTERVAL", "60"))
+# worker using more memory (MiB) is replaced gracefully (0 never)
+MAX_WORKER_MEMORY = int(os.environ.get("GUNICORN_MAX_WORKER_MEMORY", "0"))
+
+if preload_app:
+    # collections while the app is imported would leave freed holes in
+    # pages shared with workers; objects are frozen before the first fork
+    gc.disable()
+
+
+def worker_memory() -> float:
+    """Resident memory of the process in MiB"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        # peak rather than current, where /proc isn't available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def listen_backlog(sock: socket.socket) -> Optional[Tuple[int, int]]:
+    """Connections waiting to be accepted and the maximum for a listening
+    TCP socket, from tcp_info (Linux); None for other sockets"""
+    if not hasattr(socket, "TCP_INFO") or sock.family not in (
+        socket.AF_INET,
+        socket.AF_INET6,
+    ):
+        return None
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    # tcpi_unacked and tcpi_sacked hold them for listening sockets
+    return struct.unpack_from("=II", info, 24)
+
+
+def report_stats(worker) -> None:
+    memory = worker_memory()
+    queues = [
+        queue
+        for queue in (
+            listen_backlog(listener.sock) for listener in worker.sockets
+        )
+        if queue is not None
+    ]
+    waiting = sum(queue[0] for queue in queues)
+    limit = sum(queue[1] for queue in queues)
+    log = worker.log.info
+    if limit and waiting >= limit // 2:
+        log = worker.log.warning
+    log(
+        "worker %s: %.1f MiB resident, %d of %d connections waiting",
+        worker.pid,
+        memory,
+        waiting,
+        limit,
+    )
+    if MAX_WORKER_MEMORY and memory > MAX_WORKER_MEMORY:
+        worker.log.warning(
+            "worker %s uses over %d MiB, replacing it",
+            worker.pid,
+            MAX_WORKER_MEMORY,
+        )
+        # graceful exit: the current request is finished
+        os.kill(worker.pid, signal.SIGTERM)
+
+
+def monitor(worker) -> None:
+    while True:
+        time.sleep(STATS_INTERVAL)
+        report_stats(worker)
+
+
+def when_ready(server):
+    # command line may have overridden the profile
+    server.log.info(
+        "%d %s workers (%d threads each) for %d CPUs",
+        server.cfg.workers,
+        server.cfg.worker_class_str,
+        server.cfg.threads,
+        CPUS,
+    )
+    if preload_app:
+        if WARM_UP:
+            from api.warmup import warm_up
+
+            warm_up()
+        # frozen objects are never examined by collections of workers,
+        # which would otherwise copy every page holding them
+        gc.freeze()
+        gc.enable()
+
+
+def post_worker_init(worker):
+    if WARM_UP:
+        from api.warmup import connect_databases, warm_up
+
+        if not preload_app:
+            warm_up()
+        connect_databases()
+    if STATS_INTERVAL:
+        threading.Thread(
+            target=monitor, args=(worker,), name="worker-stats", daemon=True
+        ).start()
+
+
+def child_exit(server, worker):
+    # gauges of the exited worker no longer count towards totals
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)